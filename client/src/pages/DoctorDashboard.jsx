@@ -389,6 +389,7 @@ const DoctorDashboard = () => {
           imageUrl: analysisResult.imageUrl,
           notes: notes,
           heatmap: analysisResult.heatmap,
+          modelVersion: analysisResult.model_version,
         }),
       });
 
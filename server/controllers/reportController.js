@@ -7,6 +7,10 @@ const path = require("path");
 const ML_SERVICE_URL =
   process.env.ML_SERVICE_URL || "http://localhost:8000/predict";
 
+// When the ML service mounts this server's uploads/ folder (ML_SHARED_UPLOAD_ROOT),
+// send the file's path instead of re-uploading it
+const ML_SHARED_UPLOADS = process.env.ML_SHARED_UPLOADS === "true";
+
 // @desc    Call Python ML Service for Prediction
 const getPrediction = async (imagePath) => {
   try {
@@ -16,6 +20,16 @@ const getPrediction = async (imagePath) => {
     // Convert relative path to absolute
     const absolutePath = path.resolve(imagePath);
 
+    if (ML_SHARED_UPLOADS) {
+      const response = await axios.post(ML_SERVICE_URL, null, {
+        params: {
+          image_path: path.relative(path.resolve("uploads"), absolutePath),
+        },
+        timeout: 60000,
+      });
+      return response.data;
+    }
+
     // Create form data with the image file
     const formData = new FormData();
     formData.append("file", fs.createReadStream(absolutePath));
@@ -30,6 +44,12 @@ const getPrediction = async (imagePath) => {
     return response.data;
   } catch (error) {
     console.error("ML Service Error:", error.message);
+    // Admission control: the ML service is at capacity and says when to retry
+    if (error.response && error.response.status === 429) {
+      const busy = new Error("ML service is busy. Please try again shortly.");
+      busy.retryAfter = error.response.headers["retry-after"];
+      throw busy;
+    }
     throw new Error("Unable to process image. ML service may be offline.");
   }
 };
@@ -61,9 +81,14 @@ exports.analyzeXray = async (req, res) => {
       confidence: mlResult.class_confidence,
       imageUrl: `/${imagePath}`,
       heatmap: mlResult.heatmap,
+      model_version: mlResult.model_version,
     });
   } catch (error) {
     console.error("Analyze Error:", error);
+    if (error.retryAfter) {
+      res.set("Retry-After", error.retryAfter);
+      return res.status(503).json({ message: error.message });
+    }
     res.status(500).json({ message: error.message || "Server Error" });
   }
 };
@@ -73,7 +98,7 @@ exports.analyzeXray = async (req, res) => {
 // @access  Private (Doctor only)
 exports.createReport = async (req, res) => {
   try {
-    const { patientId, prediction, confidence, imageUrl, notes, heatmap } =
+    const { patientId, prediction, confidence, imageUrl, notes, heatmap, modelVersion } =
       req.body;
 
     if (!patientId || !prediction || !imageUrl) {
@@ -88,6 +113,7 @@ exports.createReport = async (req, res) => {
       confidence,
       notes,
       heatmap,
+      modelVersion,
     });
 
     // Notify patient mapping
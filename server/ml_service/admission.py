@@ -0,0 +1,179 @@
+import math
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+
+
+class AdmissionRejected(Exception):
+    """A request turned away by AdmissionControl (HTTP 429 with Retry-After)."""
+
+    def __init__(self, lane, reason, retry_after_s):
+        super().__init__(f"Service busy ({lane} lane: {reason}), retry in {retry_after_s} s")
+        self.lane = lane
+        self.reason = reason
+        self.retry_after_s = retry_after_s
+
+
+class Lane:
+    """
+    One priority class of requests. `max_concurrency` caps its calls in
+    progress (0 = the controller's limit); new requests are rejected once
+    `max_queue` are waiting or the estimated wait exceeds `max_wait_s`.
+    """
+
+    def __init__(self, name, max_concurrency=0, max_queue=64, max_wait_s=20.0):
+        self.name = name
+        self.max_concurrency = int(max_concurrency)
+        self.max_queue = int(max_queue)
+        self.max_wait_s = float(max_wait_s)
+
+        self.waiting = deque()
+        self.inflight = 0
+
+        # Stats
+        self.admitted = 0
+        self.rejected = {"queue_full": 0, "wait": 0}
+        self.queue_wait_total = 0.0
+
+
+# --- ADMISSION CONTROL ---
+class AdmissionControl:
+    """
+    Bounded admission queue in front of the model, with priority lanes.
+
+    At most `max_concurrency` calls run at once (each lane also within its
+    own cap). Freed slots go to the waiting requests of the first lane in
+    `lanes` that can take one, so earlier lanes have priority, and a
+    lower-priority lane can use slots a higher one leaves idle up to its cap.
+    The wait of a new request is estimated from the calls queued ahead of it
+    (in its lane and all higher ones) and the recent time a call holds a slot,
+    tracked per kind ("heatmap" calls run Grad-CAM and take longer).
+    """
+
+    def __init__(self, lanes, max_concurrency, smoothing=0.2, initial_service_s=0.5):
+        self.lanes = {lane.name: lane for lane in lanes}
+        self.order = [lane.name for lane in lanes]
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.smoothing = smoothing
+        # Moving average of the time a call holds its slot, per kind
+        self.service_s = {}
+        self.initial_service_s = initial_service_s
+        self.inflight = 0
+
+    def _cap(self, lane):
+        return min(lane.max_concurrency or self.max_concurrency, self.max_concurrency)
+
+    def _cost(self, kind):
+        return self.service_s.get(kind, self.initial_service_s)
+
+    def estimated_wait_s(self, lane_name, kind="classify"):
+        """Expected queue wait of a request joining `lane_name` now."""
+        lane = self.lanes[lane_name]
+        ahead = [
+            waiter for name in self.order[:self.order.index(lane_name) + 1]
+            for waiter in self.lanes[name].waiting
+        ]
+        if not ahead and lane.inflight < self._cap(lane) and self.inflight < self.max_concurrency:
+            return 0.0
+        # The call in front of a full lane finishes after one service time on average
+        work = sum(self._cost(waiter[0]) for waiter in ahead) + self._cost(kind)
+        return work / self._cap(lane)
+
+    def check(self, lane_name, kind="classify"):
+        """Raises AdmissionRejected if a `kind` request would be turned away from `lane_name` now."""
+        lane = self.lanes[lane_name]
+        wait_s = self.estimated_wait_s(lane_name, kind)
+        reason = None
+        if len(lane.waiting) >= lane.max_queue:
+            reason = "queue_full"
+        elif wait_s > lane.max_wait_s:
+            reason = "wait"
+        if reason:
+            lane.rejected[reason] += 1
+            raise AdmissionRejected(lane_name, reason, max(1, math.ceil(wait_s)))
+        return wait_s
+
+    @asynccontextmanager
+    async def slot(self, lane_name, kind="classify", reject=True):
+        """
+        Holds one slot of `lane_name` for the body. With `reject`, raises
+        AdmissionRejected instead of queueing past the lane's limits. Yields a
+        dict whose "queue_wait_ms" is the time spent waiting for the slot.
+        """
+        lane = self.lanes[lane_name]
+        if reject:
+            self.check(lane_name, kind)
+        enqueued = time.perf_counter()
+        if lane.waiting or not self._free(lane):
+            future = asyncio.get_running_loop().create_future()
+            waiter = (kind, future)
+            lane.waiting.append(waiter)
+            try:
+                await future
+            except BaseException:
+                # Gave up while queued, or right after being granted the slot
+                if future.done() and not future.cancelled():
+                    self._release(lane)
+                elif waiter in lane.waiting:
+                    lane.waiting.remove(waiter)
+                raise
+        else:
+            self._acquire(lane)
+
+        waited = time.perf_counter() - enqueued
+        lane.admitted += 1
+        lane.queue_wait_total += waited
+        started = time.perf_counter()
+        try:
+            yield {"lane": lane_name, "queue_wait_ms": round(waited * 1000.0, 3)}
+        finally:
+            held = time.perf_counter() - started
+            previous = self.service_s.get(kind)
+            self.service_s[kind] = held if previous is None else previous + self.smoothing * (held - previous)
+            self._release(lane)
+
+    def _free(self, lane):
+        return lane.inflight < self._cap(lane) and self.inflight < self.max_concurrency
+
+    def _acquire(self, lane):
+        lane.inflight += 1
+        self.inflight += 1
+
+    def _release(self, lane):
+        lane.inflight -= 1
+        self.inflight -= 1
+        self._grant()
+
+    def _grant(self):
+        for name in self.order:
+            lane = self.lanes[name]
+            while lane.waiting and self._free(lane):
+                _, future = lane.waiting.popleft()
+                if future.done():
+                    continue
+                self._acquire(lane)
+                future.set_result(None)
+            if self.inflight >= self.max_concurrency:
+                return
+
+    def stats(self):
+        return {
+            "max_concurrency": self.max_concurrency,
+            "inflight": self.inflight,
+            "service_ms": {kind: round(s * 1000.0, 3) for kind, s in sorted(self.service_s.items())},
+            "lanes": {
+                name: {
+                    "max_concurrency": self._cap(lane),
+                    "max_queue": lane.max_queue,
+                    "max_wait_s": lane.max_wait_s,
+                    "queue_depth": len(lane.waiting),
+                    "inflight": lane.inflight,
+                    "estimated_wait_ms": round(self.estimated_wait_s(name) * 1000.0, 3),
+                    "admitted": lane.admitted,
+                    "rejected": dict(lane.rejected),
+                    "avg_queue_wait_ms": round(lane.queue_wait_total / lane.admitted * 1000.0, 3) if lane.admitted else 0.0,
+                }
+                for name, lane in self.lanes.items()
+            },
+        }
@@ -0,0 +1,220 @@
+import os
+import time
+import hashlib
+import tempfile
+
+import torch
+
+BACKENDS = ("eager", "torchscript", "compile", "onnx", "int8")
+
+# Batch sizes used by the load-time parity check: more than one, so a
+# backend that baked in a fixed batch dimension fails it
+PARITY_BATCH_SIZES = (1, 3)
+
+
+# --- INFERENCE BACKENDS ---
+# Every backend wraps an eager nn.Module and maps a normalized
+# [N, 3, 224, 224] float tensor to the model's logits, without gradients,
+# for any N. Grad-CAM always runs on the eager module (it needs autograd),
+# so only the no_grad forwards go through a backend.
+class EagerBackend:
+    name = "eager"
+
+    def __init__(self, model, device, **kwargs):
+        self.model = model
+        self.device = device
+
+    def __call__(self, batch):
+        with torch.no_grad():
+            return self.model(batch)
+
+    def verify(self, model, device, atol):
+        """Parity of this backend against eager `model`; raises ValueError on failure."""
+        return {"max_abs_diff": check_parity(self, model, device, atol=atol)}
+
+
+class TorchScriptBackend(EagerBackend):
+    """torch.jit.trace + freeze. Traced graphs keep the batch dimension dynamic."""
+    name = "torchscript"
+
+    def __init__(self, model, device, **kwargs):
+        super().__init__(model, device)
+        example = torch.randn(2, 3, 224, 224, device=device)
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example, check_trace=False)
+            self.model = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+
+class CompileBackend(EagerBackend):
+    """torch.compile with a dynamic batch dimension (compiled on first call)."""
+    name = "compile"
+
+    def __init__(self, model, device, **kwargs):
+        super().__init__(model, device)
+        self.model = torch.compile(model, dynamic=True)
+
+
+class OnnxRuntimeBackend(EagerBackend):
+    """
+    ONNX Runtime on CPU, from a graph exported with a dynamic batch axis.
+
+    With `cache_dir`, the exported .onnx file is kept there under a name
+    derived from the model weights and reused by later loads.
+    """
+    name = "onnx"
+
+    def __init__(self, model, device, cache_dir=None, label="model", **kwargs):
+        import onnxruntime as ort
+
+        self.device = device
+        path = self._export(model, device, cache_dir, label)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # Same CPU budget as the torch thread pool of this worker
+        options.intra_op_num_threads = torch.get_num_threads()
+        options.inter_op_num_threads = 1
+        try:
+            self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        finally:
+            if not cache_dir:
+                os.remove(path)
+        self.input_name = self.session.get_inputs()[0].name
+
+    @staticmethod
+    def _export(model, device, cache_dir, label):
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            path = os.path.join(cache_dir, f"{label}-{_state_digest(model)}.onnx")
+            if os.path.exists(path):
+                return path
+        else:
+            fd, path = tempfile.mkstemp(suffix=".onnx", prefix=f"{label}-")
+            os.close(fd)
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.onnx.export(
+            model,
+            (torch.randn(1, 3, 224, 224, device=device),),
+            tmp_path,
+            input_names=["input"],
+            output_names=["logits"],
+            dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+            opset_version=17,
+            dynamo=False
+        )
+        os.replace(tmp_path, path)
+        return path
+
+    def __call__(self, batch):
+        inputs = batch.detach().to("cpu", torch.float32).contiguous().numpy()
+        logits = self.session.run(None, {self.input_name: inputs})[0]
+        return torch.from_numpy(logits).to(self.device)
+
+
+class QuantizedBackend(EagerBackend):
+    """
+    INT8 static post-training quantization (CPU only), see quantization.py.
+
+    Calibrated on `calibration` (a list of preprocessed batches). Logits of
+    an int8 model are never within float tolerance of eager, so instead of
+    the logit check, parity is judged on the served decision: agreement of
+    the probabilities thresholded at `threshold` (the served one) on the
+    calibration images and the largest probability drift.
+    """
+    name = "int8"
+
+    def __init__(self, model, device, calibration=None, label="model", threshold=None,
+                 min_agreement=0.99, max_drift=0.05, **kwargs):
+        from quantization import quantize_static
+
+        if device != "cpu":
+            raise RuntimeError("int8 backend only runs on CPU")
+        if not calibration:
+            raise ValueError("int8 backend needs calibration images (ML_QUANT_CALIBRATION_DIR)")
+        if threshold is None:
+            raise ValueError("int8 backend needs the decision threshold to check parity at")
+        super().__init__(quantize_static(model, calibration), device)
+        self.calibration = calibration
+        self.label = label
+        self.threshold = threshold
+        self.min_agreement = min_agreement
+        self.max_drift = max_drift
+
+    def verify(self, model, device, atol):
+        from quantization import PROB_FNS, predict_probs, decision_parity, check_decision_parity
+
+        prob_fn = PROB_FNS[self.label]
+        report = decision_parity(
+            predict_probs(model, self.calibration, prob_fn),
+            predict_probs(self.model, self.calibration, prob_fn),
+            self.threshold
+        )
+        check_decision_parity(report, self.min_agreement, self.max_drift)
+        return report
+
+
+_BACKEND_CLASSES = {
+    cls.name: cls for cls in (EagerBackend, TorchScriptBackend, CompileBackend, OnnxRuntimeBackend, QuantizedBackend)
+}
+
+
+def _state_digest(model):
+    h = hashlib.sha256()
+    for name, tensor in model.state_dict().items():
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()[:16]
+
+
+def check_parity(backend, model, device, atol=1e-3):
+    """
+    Max absolute logit difference between `backend` and eager `model`.
+
+    Runs fixed random inputs at every size in PARITY_BATCH_SIZES and raises
+    ValueError if any difference exceeds `atol`.
+    """
+    generator = torch.Generator().manual_seed(0)
+    max_diff = 0.0
+    for n in PARITY_BATCH_SIZES:
+        batch = torch.randn(n, 3, 224, 224, generator=generator).to(device)
+        with torch.no_grad():
+            expected = model(batch)
+        actual = backend(batch)
+        if actual.shape != expected.shape:
+            raise ValueError(f"output shape {tuple(actual.shape)} != eager {tuple(expected.shape)} at batch {n}")
+        max_diff = max(max_diff, (actual.float() - expected.float()).abs().max().item())
+    if max_diff > atol:
+        raise ValueError(f"max |logit diff| {max_diff:.2e} exceeds {atol:.0e}")
+    return max_diff
+
+
+def load_backend(name, model, device, label="model", cache_dir=None, parity_atol=1e-3, **options):
+    """
+    Wrap eager `model` in backend `name` and verify it against eager outputs.
+
+    Extra `options` are passed to the backend (e.g. the int8 calibration
+    set and the decision threshold its parity is checked at). Returns
+    (backend, info). If the backend cannot be built or fails its parity
+    check, the eager backend is returned instead and `info` records why
+    ("fallback_reason").
+    """
+    if name not in _BACKEND_CLASSES:
+        raise ValueError(f"Unknown backend '{name}' (expected one of {', '.join(BACKENDS)})")
+
+    info = {"requested": name, "backend": "eager", "parity": None, "load_ms": 0.0}
+    if name == "eager":
+        return EagerBackend(model, device), info
+
+    started = time.perf_counter()
+    try:
+        backend = _BACKEND_CLASSES[name](model, device, cache_dir=cache_dir, label=label, **options)
+        info["parity"] = backend.verify(model, device, parity_atol)
+        info["backend"] = name
+        print(f"{label}: {name} backend ready (parity vs eager: {info['parity']})")
+    except Exception as e:
+        print(f"{label}: {name} backend unavailable, falling back to eager: {e}")
+        backend = EagerBackend(model, device)
+        info["fallback_reason"] = str(e)
+    info["load_ms"] = round((time.perf_counter() - started) * 1000.0, 1)
+    return backend, info
@@ -0,0 +1,133 @@
+import asyncio
+import time
+from collections import Counter
+
+
+# --- DYNAMIC MICRO-BATCHING ---
+class MicroBatcher:
+    """
+    Collects concurrent /predict uploads into small batches.
+
+    A batch is dispatched as soon as it holds `max_batch_size` items or the
+    oldest item has waited `max_wait_ms`, whichever comes first. `run_batch`
+    is an async callable taking a list of items and returning a list of
+    results in the same order (e.g. PneumoniaSystem.predict_batch awaited on
+    an InferencePool). Up to `max_concurrent_batches` batches run at once.
+    """
+
+    def __init__(self, run_batch, max_batch_size=16, max_wait_ms=5.0, max_concurrent_batches=1):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.max_concurrent_batches = max(1, int(max_concurrent_batches))
+
+        self._queue = None
+        self._slots = None
+        self._task = None
+        self._inflight = set()
+
+        # Stats
+        self._batch_sizes = Counter()
+        self._items = 0
+        self._batches = 0
+        self._queue_wait_total = 0.0
+        self._run_time_total = 0.0
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.max_concurrent_batches)
+        self._task = asyncio.create_task(self._collect_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+        # Fail anything still waiting in the queue
+        while self._queue and not self._queue.empty():
+            _, future, _ = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Batcher stopped"))
+
+    async def submit(self, item):
+        if self._task is None:
+            raise RuntimeError("Batcher not started")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future, time.perf_counter()))
+        return await future
+
+    async def _collect_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Wait for a free execution slot before forming the next batch, so
+            # requests keep accumulating while the model is busy.
+            await self._slots.acquire()
+            try:
+                batch = [await self._queue.get()]
+                deadline = loop.time() + self.max_wait
+                while len(batch) < self.max_batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        if self._queue.empty():
+                            break
+                        batch.append(self._queue.get_nowait())
+                        continue
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+            except BaseException:
+                self._slots.release()
+                raise
+
+            task = asyncio.create_task(self._dispatch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _dispatch(self, batch):
+        try:
+            # Drop callers that went away while queued
+            batch = [entry for entry in batch if not entry[1].done()]
+            if not batch:
+                return
+
+            started = time.perf_counter()
+            items = [item for item, _, _ in batch]
+            try:
+                results = await self.run_batch(items)
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            finished = time.perf_counter()
+
+            self._batches += 1
+            self._items += len(batch)
+            self._batch_sizes[len(batch)] += 1
+            self._run_time_total += finished - started
+            for (_, future, enqueued), result in zip(batch, results):
+                self._queue_wait_total += started - enqueued
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        return {
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "inflight_batches": len(self._inflight),
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "batches": self._batches,
+            "items": self._items,
+            "avg_batch_size": round(self._items / self._batches, 3) if self._batches else 0.0,
+            "batch_size_histogram": {str(k): v for k, v in sorted(self._batch_sizes.items())},
+            "avg_queue_wait_ms": round(self._queue_wait_total / self._items * 1000.0, 3) if self._items else 0.0,
+            "avg_batch_run_ms": round(self._run_time_total / self._batches * 1000.0, 3) if self._batches else 0.0,
+        }
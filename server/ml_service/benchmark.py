@@ -0,0 +1,465 @@
+"""
+Latency / throughput benchmark for the ML service, on synthetic images.
+
+Four suites:
+
+  system  calls PneumoniaSystem.predict_batch directly and reports batch
+          latency, images/s and per-stage timings for every mode,
+          resolution and batch size.
+  api     drives the FastAPI app in-process (httpx ASGI transport) at each
+          concurrency level and reports p50/p95/p99 request latency,
+          throughput and status codes.
+  model   compares the reference gate / classifier with their inference
+          build (pneumonia_network.inference_model: folded BatchNorm,
+          channels_last, fused CBAM): forward latency per batch size, the
+          Grad-CAM pass, and the max logit difference.
+  cam     Grad-CAM++ (explain.CamEngine) over a batch in one forward /
+          backward vs. one call per image: images/s of both, the speedup,
+          and the max difference between the batched and per-image maps.
+
+The system and api suites run in three modes: "heatmap" (PNG overlay),
+"no_heatmap" (explain=false) and "gate_rejected" (non-X-ray images), and
+report peak RSS (for api, of the process plus its worker processes). Without
+checkpoints, models with random weights are used; with random weights (or
+--force-gate) the gate threshold is forced so every image passes, or, in
+gate_rejected mode, fails the gate.
+
+    python benchmark.py --suite all --resolutions 512,1024,2048 --batch-sizes 1,4,16 --output bench.json
+
+The API suite runs with the service configuration from the ML_* environment
+variables (workers, backend, ...), except that the result cache is disabled
+unless --cache is given.
+"""
+import os
+import io
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+from contextlib import redirect_stdout, nullcontext
+
+import numpy as np
+import torch
+
+from synthetic_xray import synthetic_xray, synthetic_photo
+from heatmap_formats import HeatmapOptions
+
+MODES = ("heatmap", "no_heatmap", "gate_rejected")
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = np.asarray(values, dtype=np.float64)
+    return {
+        "mean": round(float(values.mean()), 3),
+        "p50": round(float(np.percentile(values, 50)), 3),
+        "p95": round(float(np.percentile(values, 95)), 3),
+        "p99": round(float(np.percentile(values, 99)), 3),
+        "min": round(float(values.min()), 3),
+        "max": round(float(values.max()), 3),
+    }
+
+
+# --- PEAK RSS ---
+def _rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class RssSampler:
+    """
+    Samples the resident set size of this process (plus `extra_pids()`)
+    every `interval` seconds while active. Where /proc is unavailable the
+    peak falls back to getrusage's lifetime maximum of this process.
+    """
+
+    def __init__(self, extra_pids=None, interval=0.01):
+        self.extra_pids = extra_pids or (lambda: [])
+        self.interval = interval
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        pids = {os.getpid(), *self.extra_pids()}
+        sizes = [_rss_bytes(pid) for pid in pids]
+        if any(size is None for size in sizes):
+            # ru_maxrss is KiB on Linux, bytes on macOS
+            scale = 1 if sys.platform == "darwin" else 1024
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+        return sum(sizes)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_bytes = max(self.peak_bytes, self._sample())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak_bytes = self._sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak_bytes = max(self.peak_bytes, self._sample())
+
+    @property
+    def peak_mb(self):
+        return round(self.peak_bytes / (1024 * 1024), 1)
+
+
+# --- INPUTS ---
+def resolve_checkpoints(cls_path, gate_path, tmp_dir):
+    """
+    Returns (cls_path, gate_path, random_weights). Missing checkpoints are
+    replaced by randomly initialized models saved under `tmp_dir`, so the
+    gate runs too.
+    """
+    if os.path.exists(cls_path) and os.path.exists(gate_path):
+        return cls_path, gate_path, False
+
+    from pneumonia_network import build_gate_model, build_pneumonia_model
+
+    print("Checkpoints not found, benchmarking models with random weights")
+    torch.manual_seed(0)
+    if not os.path.exists(cls_path):
+        cls_path = os.path.join(tmp_dir, "random_classifier.pt")
+        torch.save(build_pneumonia_model(weights_path=None).state_dict(), cls_path)
+    if not os.path.exists(gate_path):
+        gate_path = os.path.join(tmp_dir, "random_gate.pth")
+        torch.save(build_gate_model(weights_path=None).state_dict(), gate_path)
+    return cls_path, gate_path, True
+
+
+def make_images(mode, resolution, count, fmt="png", seed=0):
+    make = synthetic_photo if mode == "gate_rejected" else synthetic_xray
+    # Portrait 4:5, like most chest X-rays
+    width, height = resolution, int(resolution * 1.25)
+    return [make(width, height, seed=seed + i, fmt=fmt) for i in range(count)]
+
+
+def gate_threshold_for(mode, force_gate, default=0.9):
+    if not force_gate:
+        return default
+    # Probabilities never exceed 1.0, so 1.01 rejects everything
+    return 1.01 if mode == "gate_rejected" else 0.0
+
+
+def _quiet(enabled):
+    # The pipeline prints a line per image; keep the benchmark output readable
+    return redirect_stdout(io.StringIO()) if enabled else nullcontext()
+
+
+# --- SUITE: PneumoniaSystem.predict_batch ---
+def bench_system(system, modes, resolutions, batch_sizes, iterations, fmt, force_gate, quiet):
+    runs = []
+    for mode in modes:
+        system.gate_threshold = gate_threshold_for(mode, force_gate)
+        for resolution in resolutions:
+            for batch_size in batch_sizes:
+                images = make_images(mode, resolution, batch_size, fmt)
+                heatmaps = [HeatmapOptions() if mode == "heatmap" else None] * batch_size
+
+                with _quiet(quiet):
+                    system.predict_batch(images, heatmaps)  # warm-up
+
+                latencies, stages, outcomes = [], {}, {}
+                with RssSampler() as rss, _quiet(quiet):
+                    started = time.perf_counter()
+                    for _ in range(iterations):
+                        t0 = time.perf_counter()
+                        results = system.predict_batch(images, heatmaps, telemetry=True)
+                        latencies.append((time.perf_counter() - t0) * 1000.0)
+                        for result in results:
+                            for stage, ms in result.pop("_telemetry")["timings_ms"].items():
+                                stages.setdefault(stage, []).append(ms)
+                            outcome = "error" if "error" in result else ("classified" if result.get("is_xray") else "gate_rejected")
+                            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+                    elapsed = time.perf_counter() - started
+
+                run = {
+                    "mode": mode,
+                    "resolution": [resolution, int(resolution * 1.25)],
+                    "batch_size": batch_size,
+                    "iterations": iterations,
+                    "batch_latency_ms": percentiles(latencies),
+                    "images_per_s": round(batch_size * iterations / elapsed, 2),
+                    "stages_ms": {stage: percentiles(values) for stage, values in sorted(stages.items())},
+                    "outcomes": outcomes,
+                    "peak_rss_mb": rss.peak_mb,
+                }
+                runs.append(run)
+                print(f"system {mode:13s} {resolution:5d}px batch {batch_size:3d}: "
+                      f"p50 {run['batch_latency_ms']['p50']:9.1f} ms  {run['images_per_s']:7.2f} img/s  "
+                      f"rss {run['peak_rss_mb']:.0f} MB")
+    return runs
+
+
+# --- SUITE: reference vs inference-optimized models ---
+def _time_ms(fn, iterations):
+    fn()  # warm-up
+    samples = []
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000.0)
+    return percentiles(samples)
+
+
+def bench_models(cls_path, gate_path, batch_sizes, iterations, quiet):
+    from pneumonia_network import build_gate_model, build_pneumonia_model, inference_model
+    from explain import CamEngine
+
+    runs = []
+    builders = (("classifier", build_pneumonia_model, cls_path), ("gate", build_gate_model, gate_path))
+    for name, build, path in builders:
+        with _quiet(quiet):
+            reference = build(weights_path=path).eval()
+            optimized = inference_model(reference)
+        generator = torch.Generator().manual_seed(0)
+        for batch_size in batch_sizes:
+            batch = torch.randn(batch_size, 3, 224, 224, generator=generator)
+            with torch.no_grad():
+                max_diff = (optimized(batch) - reference(batch)).abs().max().item()
+                ref_ms = _time_ms(lambda: reference(batch), iterations)
+                opt_ms = _time_ms(lambda: optimized(batch), iterations)
+            run = {
+                "model": name,
+                "pass": "forward",
+                "batch_size": batch_size,
+                "reference_ms": ref_ms,
+                "optimized_ms": opt_ms,
+                "speedup": round(ref_ms["p50"] / opt_ms["p50"], 3),
+                "max_abs_logit_diff": max_diff,
+            }
+            runs.append(run)
+            print(f"model  {name:10s} forward batch {batch_size:3d}: reference {ref_ms['p50']:8.1f} ms  "
+                  f"optimized {opt_ms['p50']:8.1f} ms  x{run['speedup']:.2f}  diff {max_diff:.1e}")
+
+        if name == "classifier":
+            # Grad-CAM runs one gradient-enabled pass per image
+            image = torch.randn(1, 3, 224, 224, generator=generator)
+            ref_cam, opt_cam = CamEngine(reference), CamEngine(optimized)
+            ref_ms = _time_ms(lambda: ref_cam(image), iterations)
+            opt_ms = _time_ms(lambda: opt_cam(image), iterations)
+            cam_diff = float(np.abs(ref_cam(image)[1][0] - opt_cam(image)[1][0]).max())
+            runs.append({
+                "model": name,
+                "pass": "gradcam",
+                "batch_size": 1,
+                "reference_ms": ref_ms,
+                "optimized_ms": opt_ms,
+                "speedup": round(ref_ms["p50"] / opt_ms["p50"], 3),
+                "max_abs_cam_diff": cam_diff,
+            })
+            print(f"model  {name:10s} gradcam batch   1: reference {ref_ms['p50']:8.1f} ms  "
+                  f"optimized {opt_ms['p50']:8.1f} ms  x{runs[-1]['speedup']:.2f}  diff {cam_diff:.1e}")
+    return runs
+
+
+# --- SUITE: batched vs per-image Grad-CAM ---
+def bench_cam(cls_path, batch_sizes, iterations, optimize, quiet):
+    from pneumonia_network import build_pneumonia_model
+    from explain import CamEngine
+
+    with _quiet(quiet):
+        engine = CamEngine(build_pneumonia_model(weights_path=cls_path, optimize_for_inference=optimize).eval())
+    generator = torch.Generator().manual_seed(0)
+    runs = []
+    for batch_size in batch_sizes:
+        batch = torch.randn(batch_size, 3, 224, 224, generator=generator)
+        singles = [batch[i:i + 1] for i in range(batch_size)]
+        single_ms = _time_ms(lambda: [engine(image) for image in singles], iterations)
+        batched_ms = _time_ms(lambda: engine(batch), iterations)
+
+        probs, cams, _ = engine(batch)
+        per_image = [engine(image) for image in singles]
+        cam_diff = max(float(np.abs(cams[i] - result[1][0]).max()) for i, result in enumerate(per_image))
+        prob_diff = max(abs(probs[i] - result[0][0]) for i, result in enumerate(per_image))
+        run = {
+            "batch_size": batch_size,
+            "optimized": optimize,
+            "per_image_ms": single_ms,
+            "batched_ms": batched_ms,
+            "per_image_images_per_s": round(batch_size * 1000.0 / single_ms["p50"], 2),
+            "batched_images_per_s": round(batch_size * 1000.0 / batched_ms["p50"], 2),
+            "speedup": round(single_ms["p50"] / batched_ms["p50"], 3),
+            "max_abs_cam_diff": cam_diff,
+            "max_abs_prob_diff": prob_diff,
+        }
+        runs.append(run)
+        print(f"cam    batch {batch_size:3d}: per image {run['per_image_images_per_s']:7.2f} img/s  "
+              f"batched {run['batched_images_per_s']:7.2f} img/s  x{run['speedup']:.2f}  diff {cam_diff:.1e}")
+    return runs
+
+
+# --- SUITE: FastAPI app, in process ---
+async def _drive(client, images, params, concurrency, total):
+    latencies, statuses = [], {}
+    counter = iter(range(total))
+
+    async def worker():
+        for n in counter:
+            files = {"file": (f"image_{n}.png", images[n % len(images)], "application/octet-stream")}
+            t0 = time.perf_counter()
+            response = await client.post("/predict", params=params, files=files)
+            latencies.append((time.perf_counter() - t0) * 1000.0)
+            statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, statuses, time.perf_counter() - started
+
+
+async def bench_api(cls_path, gate_path, modes, resolutions, concurrencies, requests, fmt, force_gate, cache, quiet, tmp_dir):
+    try:
+        import httpx
+    except ImportError:
+        raise SystemExit("The api suite needs httpx (pip install httpx)")
+    import main
+
+    main.CLS_PATH, main.GATE_PATH = cls_path, gate_path
+    # Keep the benchmark's checkpoint copies out of the deployed registry
+    main.MODEL_REGISTRY_DIR = os.path.join(tmp_dir, "registry")
+    main.MODEL_WATCH_INTERVAL_S = 0
+    if not cache:
+        main.CACHE_MAX_MB = 0
+
+    runs = []
+    for mode in modes:
+        main.GATE_THRESHOLD = gate_threshold_for(mode, force_gate, main.GATE_THRESHOLD)
+        params = {"explain": "true" if mode == "heatmap" else "false"}
+        with _quiet(quiet):
+            async with main.app.router.lifespan_context(main.app):
+                worker_pids = lambda: [r["pid"] for r in main.deployment.pool.stats(memory=False)["replicas"]]
+                transport = httpx.ASGITransport(app=main.app)
+                async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+                    for resolution in resolutions:
+                        # Distinct images, so batches never see duplicate work
+                        images = make_images(mode, resolution, min(requests, 32), fmt)
+                        await _drive(client, images, params, 1, 2)  # warm-up
+                        for concurrency in concurrencies:
+                            with RssSampler(worker_pids) as rss:
+                                latencies, statuses, elapsed = await _drive(client, images, params, concurrency, requests)
+                            run = {
+                                "mode": mode,
+                                "resolution": [resolution, int(resolution * 1.25)],
+                                "concurrency": concurrency,
+                                "requests": requests,
+                                "latency_ms": percentiles(latencies),
+                                "requests_per_s": round(requests / elapsed, 2),
+                                "status_codes": statuses,
+                                "peak_rss_mb": rss.peak_mb,
+                            }
+                            runs.append(run)
+                            with redirect_stdout(sys.__stdout__):
+                                print(f"api    {mode:13s} {resolution:5d}px conc {concurrency:3d}: "
+                                      f"p50 {run['latency_ms']['p50']:9.1f} ms  p99 {run['latency_ms']['p99']:9.1f} ms  "
+                                      f"{run['requests_per_s']:7.2f} req/s  rss {run['peak_rss_mb']:.0f} MB")
+    return runs
+
+
+def _environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5
+        ).stdout.strip() or None
+    except Exception:
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "cuda": torch.cuda.is_available(),
+        "env": {k: v for k, v in sorted(os.environ.items()) if k.startswith("ML_")},
+    }
+
+
+def _int_list(text):
+    return [int(v) for v in text.split(",") if v.strip()]
+
+
+def main():
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Benchmark the pneumonia inference service on synthetic images")
+    parser.add_argument("--suite", choices=("system", "api", "model", "cam", "all"), default="all")
+    parser.add_argument("--modes", default=",".join(MODES), help=f"Comma-separated subset of {', '.join(MODES)}")
+    parser.add_argument("--resolutions", default="512,1024,2048", help="Image widths in px (height = 1.25 x width)")
+    parser.add_argument("--batch-sizes", default="1,4,16", help="system / model / cam suites: images per call")
+    parser.add_argument("--iterations", type=int, default=5, help="system / model / cam suites: timed calls per configuration")
+    parser.add_argument("--optimize", action="store_true", help="system / cam suites: load the inference build of the models (ML_OPTIMIZE_MODELS=1)")
+    parser.add_argument("--concurrency", default="1,8,32", help="api suite: concurrent clients")
+    parser.add_argument("--requests", type=int, default=64, help="api suite: requests per configuration")
+    parser.add_argument("--format", choices=("png", "jpeg"), default="png", help="Encoding of the synthetic uploads")
+    parser.add_argument("--threads", type=int, default=0, help="torch intra-op threads for the system suite (0 = default)")
+    parser.add_argument("--force-gate", action="store_true", help="Force gate pass/reject even with real checkpoints")
+    parser.add_argument("--cache", action="store_true", help="api suite: keep the result cache enabled")
+    parser.add_argument("--cls-path", default=os.path.join(base_dir, "..", "ml_model", "classifier", "best_pneumonia_model.pt"))
+    parser.add_argument("--gate-path", default=os.path.join(base_dir, "..", "ml_model", "gate", "xray_gate_efficientnet_b0.pth"))
+    parser.add_argument("--verbose", action="store_true", help="Keep the per-image log lines of the pipeline")
+    parser.add_argument("--output", help="Write the JSON results here")
+    args = parser.parse_args()
+
+    modes = [m for m in args.modes.split(",") if m]
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        parser.error(f"unknown modes: {', '.join(sorted(unknown))}")
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    report = {"environment": _environment(), "config": vars(args), "system": [], "api": [], "model": [], "cam": []}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cls_path, gate_path, random_weights = resolve_checkpoints(args.cls_path, args.gate_path, tmp_dir)
+        force_gate = args.force_gate or random_weights
+        report["random_weights"] = random_weights
+
+        if args.suite in ("system", "all"):
+            from pneumonia_system import PneumoniaSystem
+
+            with _quiet(not args.verbose):
+                started = time.perf_counter()
+                system = PneumoniaSystem(cls_path=cls_path, gate_path=gate_path, optimize_models=args.optimize)
+                report["system_load_ms"] = round((time.perf_counter() - started) * 1000.0, 1)
+            report["system"] = bench_system(
+                system, modes, _int_list(args.resolutions), _int_list(args.batch_sizes),
+                args.iterations, args.format, force_gate, not args.verbose
+            )
+            del system
+
+        if args.suite in ("model", "all"):
+            report["model"] = bench_models(cls_path, gate_path, _int_list(args.batch_sizes), args.iterations, not args.verbose)
+
+        if args.suite in ("cam", "all"):
+            report["cam"] = bench_cam(cls_path, _int_list(args.batch_sizes), args.iterations, args.optimize, not args.verbose)
+
+        if args.suite in ("api", "all"):
+            report["api"] = asyncio.run(bench_api(
+                cls_path, gate_path, modes, _int_list(args.resolutions), _int_list(args.concurrency),
+                args.requests, args.format, force_gate, args.cache, not args.verbose, tmp_dir
+            ))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,462 @@
+"""
+Offline bulk scoring of an image archive with PneumoniaSystem.
+
+Walks a directory tree, decodes the images in loader processes (with
+prefetching) and runs them through the gate and the classifier in batches,
+appending one row per image to a CSV file or a Parquet dataset:
+
+    python bulk_score.py /data/archive --output scores.csv --batch-size 32 --workers 4
+    python bulk_score.py /data/archive --output scores.parquet --heatmap-dir heatmaps/
+
+Rows are written as they are scored, so an interrupted run resumes where it
+stopped when started again with the same output: images already in the
+output are skipped. The checkpoint file next to the output
+(<output>.checkpoint.json) records the model fingerprint, and resuming with
+other weights or gate settings is refused (use --overwrite).
+
+With --feature-store, the classifier's backbone feature maps of every scored
+image are kept too (float16, memory-mapped, by image hash; feature_store.py).
+After a fine-tune of the CBAM / classifier head, or with another gate
+threshold, --head-only re-scores the images found there by running only the
+head over their stored maps, in large batches; the others get a full pass:
+
+    python bulk_score.py /data/archive --output scores.csv --feature-store /data/features
+    python bulk_score.py /data/archive --output rescored.csv --feature-store /data/features --head-only --cls-path tuned.pt
+
+Gate-rejected images have no stored maps: a lower gate threshold sends those
+that now pass it through a full pass.
+"""
+import os
+import io
+import sys
+import csv
+import json
+import time
+import base64
+import argparse
+from contextlib import redirect_stdout, nullcontext
+
+import torch
+
+from preprocessing import prepare_image
+from heatmap_formats import HeatmapOptions, OVERLAY_FORMATS
+from quantization import list_images
+from result_cache import weights_fingerprint
+from feature_store import FeatureStore, image_key, backbone_fingerprint, score_features
+
+COLUMNS = (
+    "path", "status", "xray_confidence", "classification", "class_confidence",
+    "image_width", "image_height", "heatmap_path", "error",
+)
+HEATMAP_EXTENSIONS = {"png": ".png", "jpeg": ".jpg", "webp": ".webp"}
+
+
+# --- LOADER (runs in worker processes) ---
+class ImageFiles(torch.utils.data.Dataset):
+    """
+    Reads and decodes one image per item: (relative path, PreparedImage or
+    None, error, content hash or None).
+    """
+
+    def __init__(self, root, paths, draft=True, keep_source=False):
+        self.root = root
+        self.paths = paths
+        self.draft = draft
+        # The encoded bytes are only needed again to render overlays
+        self.keep_source = keep_source
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        path = self.paths[index]
+        try:
+            with open(os.path.join(self.root, path), "rb") as f:
+                data = f.read()
+        except OSError as e:
+            return path, None, f"Cannot read file: {e.strerror or e}", None
+        prepared = prepare_image(data, draft=self.draft)
+        if prepared is None:
+            return path, None, "Invalid Image Format", None
+        if not self.keep_source:
+            prepared.source = None
+        return path, prepared, None, image_key(data)
+
+
+def _collate(items):
+    return items
+
+
+def _init_loader_worker(worker_id):
+    # Decoding is single-threaded PIL work; leave the cores to inference
+    torch.set_num_threads(1)
+
+
+# --- OUTPUT ---
+class CsvSink:
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._writer = None
+        # Rows on disk from this run
+        self.written = 0
+
+    def scored_paths(self):
+        if not os.path.exists(self.path):
+            return set()
+        # Drop a row cut short by an interruption, it is scored again
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+        with open(self.path, newline="") as f:
+            return {row["path"] for row in csv.DictReader(f)}
+
+    def write(self, rows):
+        if self._file is None:
+            is_new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            self._file = open(self.path, "a", newline="")
+            self._writer = csv.DictWriter(self._file, fieldnames=COLUMNS)
+            if is_new:
+                self._writer.writeheader()
+        self._writer.writerows(rows)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.written += len(rows)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class ParquetSink:
+    """
+    Parquet dataset directory with one part file per `flush_rows` rows. A
+    part is only renamed into place once complete, so an interruption loses
+    at most the rows that were not flushed yet.
+    """
+
+    def __init__(self, path, flush_rows=2048):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("Parquet output needs pyarrow (pip install pyarrow), or use a .csv output")
+        self.pa, self.pq = pa, pq
+        self.path = path
+        self.flush_rows = flush_rows
+        self.schema = pa.schema([
+            ("path", pa.string()), ("status", pa.string()), ("xray_confidence", pa.float64()),
+            ("classification", pa.string()), ("class_confidence", pa.float64()),
+            ("image_width", pa.int64()), ("image_height", pa.int64()),
+            ("heatmap_path", pa.string()), ("error", pa.string()),
+        ])
+        self._rows = []
+        # Rows in complete part files from this run (buffered ones not included)
+        self.written = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _parts(self):
+        return sorted(name for name in os.listdir(self.path) if name.startswith("part-") and name.endswith(".parquet"))
+
+    def scored_paths(self):
+        paths = set()
+        for name in self._parts():
+            paths.update(self.pq.read_table(os.path.join(self.path, name), columns=["path"]).column("path").to_pylist())
+        return paths
+
+    def write(self, rows):
+        self._rows.extend(rows)
+        if len(self._rows) >= self.flush_rows:
+            self._flush()
+
+    def _flush(self):
+        if not self._rows:
+            return
+        table = self.pa.Table.from_pylist(self._rows, schema=self.schema)
+        part = os.path.join(self.path, f"part-{len(self._parts()):05d}.parquet")
+        self.pq.write_table(table, part + ".tmp")
+        os.replace(part + ".tmp", part)
+        self.written += len(self._rows)
+        self._rows = []
+
+    def close(self):
+        self._flush()
+
+
+def open_sink(path, flush_rows):
+    if path.lower().endswith(".parquet"):
+        return ParquetSink(path, flush_rows)
+    return CsvSink(path)
+
+
+def _remove_output(path):
+    if os.path.isdir(path):
+        for name in os.listdir(path):
+            if name.startswith("part-"):
+                os.remove(os.path.join(path, name))
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+# --- SCORING ---
+def _row(path, result, load_error):
+    if "error" in result:
+        status = "invalid_image"
+    elif result.get("is_xray") is False:
+        status = "gate_rejected"
+    else:
+        status = "ok"
+    return {
+        "path": path,
+        "status": status,
+        "xray_confidence": result.get("xray_confidence"),
+        "classification": result.get("classification"),
+        "class_confidence": result.get("class_confidence"),
+        "image_width": result.get("image_width"),
+        "image_height": result.get("image_height"),
+        "heatmap_path": None,
+        "error": load_error or result.get("error"),
+    }
+
+
+def _save_heatmap(heatmap_dir, path, result, fmt):
+    if not result.get("heatmap"):
+        return None
+    out = os.path.join(heatmap_dir, path + HEATMAP_EXTENSIONS[fmt])
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "wb") as f:
+        f.write(base64.b64decode(result["heatmap"]))
+    return os.path.relpath(out, heatmap_dir)
+
+
+def _classification(pneumonia_prob):
+    # Same rule and rounding as PneumoniaSystem
+    if pneumonia_prob >= 0.5:
+        return "Pneumonia", round(pneumonia_prob, 4)
+    return "Normal", round(1.0 - pneumonia_prob, 4)
+
+
+def head_only_results(system, store, keys, gate_threshold, batch_size):
+    """
+    Results for the images of `keys` that `store` can score without the
+    backbone (None for the others): gate-rejected ones from their stored gate
+    probability, the rest through the classifier head over their stored maps.
+    A store built without a gate (meta "gate" None) rejects nothing, like the
+    pipeline it was built with.
+    """
+    gated = store.meta.get("gate") is not None
+    results = [None] * len(keys)
+    scored = []
+    for n, key in enumerate(keys):
+        entry = store.get(key) if key else None
+        if entry is None:
+            continue
+        base = {
+            "xray_confidence": entry["xray_confidence"],
+            "image_width": entry["image_width"],
+            "image_height": entry["image_height"],
+        }
+        if gated and entry["xray_confidence"] < gate_threshold:
+            results[n] = {**base, "is_xray": False, "message": "This image is not a chest X-ray. Please upload a chest X-ray image."}
+        elif entry["row"] is not None:
+            results[n] = {**base, "is_xray": True}
+            scored.append((n, entry["row"]))
+
+    if scored:
+        probs = score_features(system.cls_model, store, [row for _, row in scored], batch_size, system.device)
+        for (n, _), prob in zip(scored, probs):
+            results[n]["classification"], results[n]["class_confidence"] = _classification(prob)
+    return results
+
+
+def _quiet(enabled):
+    # The pipeline prints a line per image
+    return redirect_stdout(io.StringIO()) if enabled else nullcontext()
+
+
+def main():
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Score a directory tree of chest X-rays into CSV / Parquet")
+    parser.add_argument("root", help="Directory scanned recursively for images")
+    parser.add_argument("--output", required=True, help="scores.csv, or scores.parquet for a Parquet dataset directory")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1), help="Decoding processes (0 = decode inline)")
+    parser.add_argument("--prefetch", type=int, default=4, help="Batches prefetched per decoding process")
+    parser.add_argument("--heatmap-dir", help="Also render Grad-CAM overlays into this directory (mirrors the archive tree)")
+    parser.add_argument("--heatmap-format", choices=OVERLAY_FORMATS, default="png")
+    parser.add_argument("--heatmap-max-edge", type=int, default=0)
+    parser.add_argument("--heatmap-quality", type=int, default=90)
+    parser.add_argument("--limit", type=int, default=0, help="Only the first N images of the tree (0 = all)")
+    parser.add_argument("--flush-rows", type=int, default=2048, help="Parquet: rows per part file")
+    parser.add_argument("--overwrite", action="store_true", help="Start over instead of resuming an existing output")
+    parser.add_argument("--backend", default="eager", help="Inference backend, as ML_BACKEND")
+    parser.add_argument("--gate-threshold", type=float, default=0.9)
+    parser.add_argument("--feature-store", help="Keep the backbone feature maps of scored images in this directory")
+    parser.add_argument("--head-only", action="store_true", help="Re-score images already in --feature-store with the classifier head only")
+    parser.add_argument("--head-batch-size", type=int, default=512, help="--head-only: stored maps per head batch")
+    parser.add_argument("--full-decode", action="store_true", help="Decode JPEGs at full resolution (ML_JPEG_DRAFT=0)")
+    parser.add_argument("--cls-path", default=os.path.join(base_dir, "..", "ml_model", "classifier", "best_pneumonia_model.pt"))
+    parser.add_argument("--gate-path", default=os.path.join(base_dir, "..", "ml_model", "gate", "xray_gate_efficientnet_b0.pth"))
+    parser.add_argument("--verbose", action="store_true", help="Keep the per-image log lines of the pipeline")
+    args = parser.parse_args()
+    if args.head_only and not args.feature_store:
+        parser.error("--head-only needs --feature-store")
+
+    draft = not args.full_decode
+    fingerprint = weights_fingerprint([args.cls_path, args.gate_path]) + (":draft" if draft else "") + f":{args.backend}:{args.gate_threshold}"
+    checkpoint_path = args.output.rstrip("/") + ".checkpoint.json"
+
+    if args.overwrite:
+        _remove_output(args.output)
+    elif os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            previous = json.load(f)
+        if previous.get("fingerprint") != fingerprint:
+            raise SystemExit(f"{args.output} was scored with other weights or settings; use --overwrite or another --output")
+
+    sink = open_sink(args.output, args.flush_rows)
+    scored = sink.scored_paths()
+    paths = [os.path.relpath(p, args.root) for p in list_images(args.root, args.limit)]
+    todo = [p for p in paths if p not in scored]
+    print(f"{len(paths)} images under {args.root}, {len(paths) - len(todo)} already scored, {len(todo)} to go")
+
+    heatmap = None
+    if args.heatmap_dir:
+        heatmap = HeatmapOptions(args.heatmap_format, args.heatmap_max_edge, args.heatmap_quality)
+
+    from pneumonia_system import PneumoniaSystem
+
+    with _quiet(not args.verbose):
+        system = PneumoniaSystem(
+            cls_path=args.cls_path, gate_path=args.gate_path, backend=args.backend,
+            gate_threshold=args.gate_threshold, jpeg_draft=draft
+        )
+
+    store = None
+    if args.feature_store:
+        try:
+            store = FeatureStore(args.feature_store, meta={
+                # The maps depend on the backbone and decoding, the stored gate
+                # probabilities on the gate (None: no gate loaded, every image
+                # passed with a placeholder probability of 0)
+                "backbone": backbone_fingerprint(system.cls_model),
+                "gate": weights_fingerprint([args.gate_path]) if system.gate_model is not None else None,
+                "draft": draft,
+            })
+        except ValueError as e:
+            raise SystemExit(str(e))
+        print(f"Feature store {args.feature_store}: {len(store)} images")
+
+    def save_checkpoint():
+        # Only rows the sink has made durable: Parquet buffers up to --flush-rows
+        with open(checkpoint_path, "w") as f:
+            json.dump({
+                "root": os.path.abspath(args.root),
+                "fingerprint": fingerprint,
+                "scored": len(scored) + sink.written,
+                "total": len(paths),
+                "updated": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            }, f, indent=2)
+
+    counts = {}
+    done = failed = 0
+    started = last_report = time.perf_counter()
+    save_checkpoint()
+
+    def record(rows):
+        nonlocal done
+        for row in rows:
+            counts[row["status"]] = counts.get(row["status"], 0) + 1
+        sink.write(rows)
+        done += len(rows)
+
+    try:
+        if args.head_only and heatmap is None:
+            # Only hashing the files: images found in the store skip decoding and the backbone
+            keys = []
+            for path in todo:
+                try:
+                    with open(os.path.join(args.root, path), "rb") as f:
+                        keys.append(image_key(f.read()))
+                except OSError:
+                    keys.append(None)
+            remaining = []
+            for i in range(0, len(todo), args.head_batch_size):
+                chunk = slice(i, i + args.head_batch_size)
+                results = head_only_results(system, store, keys[chunk], args.gate_threshold, args.head_batch_size)
+                record([_row(path, result, None) for path, result in zip(todo[chunk], results) if result is not None])
+                remaining.extend(path for path, result in zip(todo[chunk], results) if result is None)
+            print(f"{done} images re-scored from stored feature maps, {len(remaining)} need a full pass")
+            todo = remaining
+        elif args.head_only:
+            print("--head-only does not apply with --heatmap-dir (Grad-CAM needs the images), scoring in full")
+
+        loader = torch.utils.data.DataLoader(
+            ImageFiles(args.root, todo, draft=draft, keep_source=heatmap is not None),
+            batch_size=args.batch_size,
+            num_workers=args.workers,
+            prefetch_factor=args.prefetch if args.workers else None,
+            collate_fn=_collate,
+            worker_init_fn=_init_loader_worker,
+        )
+
+        for batch in loader:
+            names = [path for path, _, _, _ in batch]
+            try:
+                with _quiet(not args.verbose):
+                    results = system.predict_prepared(
+                        [prepared for _, prepared, _, _ in batch],
+                        [heatmap if prepared is not None else None for _, prepared, _, _ in batch],
+                        features=store is not None
+                    )
+            except Exception as e:
+                # Not recorded, so a rerun retries these images
+                print(f"Batch failed ({names[0]} ...): {e}")
+                failed += len(batch)
+                continue
+
+            if store is not None:
+                # Decoded images only; gate-rejected ones are stored without maps
+                store.add([
+                    (key, result.get("_features"), {
+                        "xray_confidence": result["xray_confidence"],
+                        "image_width": prepared.size[0],
+                        "image_height": prepared.size[1],
+                    })
+                    for (_, prepared, _, key), result in zip(batch, results)
+                    if key is not None and "xray_confidence" in result
+                ])
+
+            rows = []
+            for (path, _, load_error, _), result in zip(batch, results):
+                result.pop("_features", None)
+                row = _row(path, result, load_error)
+                if heatmap is not None:
+                    row["heatmap_path"] = _save_heatmap(args.heatmap_dir, path, result, heatmap.format)
+                rows.append(row)
+            record(rows)
+
+            now = time.perf_counter()
+            if now - last_report >= 10.0:
+                last_report = now
+                save_checkpoint()
+                print(f"{len(scored) + done}/{len(paths)} scored, {done / (now - started):.1f} images/s")
+    except KeyboardInterrupt:
+        print("Interrupted, rerun the same command to resume")
+    finally:
+        # Parquet writes its last part here
+        sink.close()
+        save_checkpoint()
+        if store is not None:
+            store.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"Scored {done} images in {elapsed:.1f}s ({done / elapsed if elapsed else 0.0:.1f} images/s): {counts}")
+    if failed:
+        print(f"{failed} images failed and were not recorded; rerun to retry them")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
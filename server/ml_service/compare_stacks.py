@@ -0,0 +1,430 @@
+"""
+Side-by-side run of the two serving stacks on the same images:
+
+  torch  main.py's pipeline, PneumoniaSystem.predict_batch (X-ray gate, then
+         the EfficientNetB0+CBAM classifier at 0.5)
+  keras  model_service.py's 3-class model (Normal / Not_Xray / Pneumonia)
+         with its 0.70 confidence rule (model_service.interpret)
+
+Both run in batches of --batch-size after one warm-up batch, each in its own
+process (with its own interpreter if the stacks live in different
+environments), and the report covers decision agreement, calibration and
+per-stage latency / throughput / memory of each:
+
+    python compare_stacks.py --images chest_xray/test --output compare.json
+    python compare_stacks.py --count 64 --batch-size 8 --torch-python venv-torch/bin/python --keras-python venv-tf/bin/python
+
+Decisions are normal, pneumonia, not_xray, uncertain (Keras only: top class
+below 0.70) and error. Labels come from the parent directory name: NORMAL,
+PNEUMONIA, and anything else counts as not an X-ray; without NORMAL/ or
+PNEUMONIA/ folders, or with synthetic images (--count X-rays plus a quarter
+as many photos, when --images is not given), only the gate is scored.
+
+The pneumonia probability compared is the one each stack's class decision
+uses: the torch classifier's sigmoid, and P(Pneumonia) / (P(Normal) +
+P(Pneumonia)) for the Keras model. Calibration (Brier score, 10-bin ECE) is
+computed on labeled images the stack accepted as X-rays.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from collections import Counter
+from contextlib import redirect_stdout
+
+import numpy as np
+
+STACKS = ("torch", "keras")
+DECISIONS = ("normal", "pneumonia", "not_xray", "uncertain", "error")
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+CLASS_LABELS = {"normal": "normal", "pneumonia": "pneumonia"}
+# Stages charged in full to every image of a batch (metrics.shared_stage)
+TORCH_BATCHED_STAGES = ("preprocess", "gate_forward", "classifier_forward")
+
+
+def _percentiles(values):
+    if not values:
+        return None
+    values = np.asarray(values, dtype=np.float64)
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"mean": round(float(values.mean()), 3), "p50": round(float(p50), 3), "p95": round(float(p95), 3), "p99": round(float(p99), 3)}
+
+
+def _rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), 1)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _peak_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / (1024 * 1024), 1)
+
+
+# --- INPUTS ---
+def labeled_images(folder, limit=0):
+    """(paths, labels) of the images under `folder`, sorted; see the module docstring for labels."""
+    found = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        label = CLASS_LABELS.get(os.path.basename(root).lower(), "not_xray")
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                found.append((os.path.join(root, name), label))
+    if limit:
+        found = found[:limit]
+    paths = [path for path, _ in found]
+    labels = [label for _, label in found]
+    if not any(label in CLASS_LABELS.values() for label in labels):
+        labels = [None] * len(paths)
+    return paths, labels
+
+
+def synthetic_images(folder, count, resolution, fmt="png"):
+    """`count` synthetic X-rays and count // 4 photos written to `folder`; labels "xray" / "not_xray"."""
+    from synthetic_xray import synthetic_xray, synthetic_photo
+
+    paths, labels = [], []
+    # Portrait 4:5, like most chest X-rays
+    width, height = resolution, int(resolution * 1.25)
+    for i in range(count + count // 4):
+        is_xray = i < count
+        data = (synthetic_xray if is_xray else synthetic_photo)(width, height, seed=i, fmt=fmt)
+        path = os.path.join(folder, f"{'xray' if is_xray else 'photo'}-{i:04d}.{fmt}")
+        with open(path, "wb") as f:
+            f.write(data)
+        paths.append(path)
+        labels.append("xray" if is_xray else "not_xray")
+    return paths, labels
+
+
+def _batches(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+# --- WORKERS (run in the stack's own interpreter) ---
+def _timed_batches(paths, batch_size, run_batch):
+    """
+    Runs `run_batch(paths) -> (outputs, stage_ms)` over all batches after one
+    warm-up batch. Returns (outputs, batch latencies, stage ms totals, seconds).
+    """
+    batches = _batches(paths, batch_size)
+    run_batch(batches[0])  # warm-up
+    outputs, latencies, stages = [], [], {}
+    started = time.perf_counter()
+    for batch in batches:
+        t0 = time.perf_counter()
+        batch_outputs, stage_ms = run_batch(batch)
+        latencies.append((time.perf_counter() - t0) * 1000.0)
+        outputs.extend(batch_outputs)
+        for stage, ms in stage_ms.items():
+            stages[stage] = stages.get(stage, 0.0) + ms
+    return outputs, latencies, stages, time.perf_counter() - started
+
+
+def _torch_worker(paths, config):
+    import torch
+
+    if config["threads"]:
+        torch.set_num_threads(config["threads"])
+    from benchmark import resolve_checkpoints
+    from heatmap_formats import HeatmapOptions
+    from pneumonia_system import PneumoniaSystem
+
+    info = {"framework": f"torch {torch.__version__}", "threads": torch.get_num_threads(), "rss_after_import_mb": _rss_mb()}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cls_path, gate_path, random_weights = resolve_checkpoints(config["cls_path"], config["gate_path"], tmp_dir)
+        started = time.perf_counter()
+        with redirect_stdout(sys.stderr):
+            system = PneumoniaSystem(cls_path=cls_path, gate_path=gate_path, backend=config["backend"], optimize_models=config["optimize"])
+    info.update(load_ms=round((time.perf_counter() - started) * 1000.0, 1), rss_after_load_mb=_rss_mb(), random_weights=random_weights)
+
+    def run_batch(batch):
+        images = []
+        for path in batch:
+            with open(path, "rb") as f:
+                images.append(f.read())
+        heatmaps = [HeatmapOptions() if config["heatmaps"] else None] * len(images)
+        with redirect_stdout(sys.stderr):
+            results = system.predict_batch(images, heatmaps, telemetry=True)
+
+        outputs, stage_ms = [], {}
+        for result in results:
+            timings = result.pop("_telemetry")["timings_ms"]
+            for stage, ms in timings.items():
+                if stage in TORCH_BATCHED_STAGES:
+                    stage_ms[stage] = max(stage_ms.get(stage, 0.0), ms)
+                else:
+                    stage_ms[stage] = stage_ms.get(stage, 0.0) + ms
+            if "error" in result:
+                outputs.append({"decision": "error", "p_xray": None, "p_pneumonia": None})
+            elif not result["is_xray"]:
+                outputs.append({"decision": "not_xray", "p_xray": result["xray_confidence"], "p_pneumonia": None})
+            else:
+                confidence = result["class_confidence"]
+                pneumonia = result["classification"] == "Pneumonia"
+                outputs.append({
+                    "decision": "pneumonia" if pneumonia else "normal",
+                    "p_xray": result["xray_confidence"],
+                    "p_pneumonia": confidence if pneumonia else round(1.0 - confidence, 4),
+                })
+        return outputs, stage_ms
+
+    return info, _timed_batches(paths, config["batch_size"], run_batch)
+
+
+def _keras_worker(paths, config):
+    import tensorflow as tf
+
+    if config["threads"]:
+        tf.config.threading.set_intra_op_parallelism_threads(config["threads"])
+    import model_service
+    from keras_serving import load_image
+
+    info = {"framework": f"tensorflow {tf.__version__}", "threads": config["threads"] or None, "rss_after_import_mb": _rss_mb()}
+    model_service.MODEL_PATH = config["keras_model"]
+    started = time.perf_counter()
+    with redirect_stdout(sys.stderr):
+        model_service.load_model()
+    predictor = model_service.predictor
+    info.update(load_ms=round((time.perf_counter() - started) * 1000.0, 1), rss_after_load_mb=_rss_mb())
+
+    normal, not_xray, pneumonia = (model_service.CLASS_NAMES.index(name) for name in ("Normal", "Not_Xray", "Pneumonia"))
+    decisions = {"Normal": "normal", "Pneumonia": "pneumonia", "Invalid Image": "not_xray", "Uncertain": "uncertain"}
+
+    def run_batch(batch):
+        outputs, images, rows = [None] * len(batch), [], []
+        t0 = time.perf_counter()
+        for k, path in enumerate(batch):
+            try:
+                images.append(load_image(path, predictor.input_size))
+                rows.append(k)
+            except Exception:
+                outputs[k] = {"decision": "error", "p_xray": None, "p_pneumonia": None}
+        t1 = time.perf_counter()
+        probabilities = predictor.forward(images) if images else []
+        t2 = time.perf_counter()
+
+        for k, probs in zip(rows, probabilities):
+            diagnosis = model_service.interpret(probs)["diagnosis"]
+            class_total = float(probs[normal] + probs[pneumonia])
+            outputs[k] = {
+                "decision": decisions[diagnosis],
+                "p_xray": round(1.0 - float(probs[not_xray]), 4),
+                # Gate-rejected images get no class probability, as in the torch stack
+                "p_pneumonia": round(float(probs[pneumonia]) / class_total, 4) if diagnosis != "Invalid Image" and class_total > 0 else None,
+            }
+        return outputs, {"decode_resize": (t1 - t0) * 1000.0, "forward": (t2 - t1) * 1000.0}
+
+    return info, _timed_batches(paths, config["batch_size"], run_batch)
+
+
+def run_worker(stack, manifest_path, result_path):
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    paths, config = manifest["paths"], manifest["config"]
+    worker = _torch_worker if stack == "torch" else _keras_worker
+    info, (outputs, latencies, stages, elapsed) = worker(paths, config)
+
+    info.update({
+        "python": platform.python_version(),
+        "images": len(paths),
+        "batch_size": config["batch_size"],
+        "seconds": round(elapsed, 3),
+        "images_per_s": round(len(paths) / elapsed, 2) if elapsed else None,
+        "batch_latency_ms": _percentiles(latencies),
+        "stage_ms_per_image": {stage: round(ms / len(paths), 3) for stage, ms in sorted(stages.items())},
+        "peak_rss_mb": _peak_rss_mb(),
+    })
+    with open(result_path, "w") as f:
+        json.dump({"stack": info, "outputs": outputs}, f)
+
+
+# --- REPORT ---
+def _expected_calibration_error(probs, targets, bins=10):
+    edges = np.linspace(0.0, 1.0, bins + 1)
+    which = np.clip(np.digitize(probs, edges[1:-1]), 0, bins - 1)
+    error = 0.0
+    for b in range(bins):
+        mask = which == b
+        if mask.any():
+            error += mask.mean() * abs(probs[mask].mean() - targets[mask].mean())
+    return float(error)
+
+
+def calibration(outputs, labels):
+    """Accuracy, gate errors and (on accepted X-rays with a class label) Brier score / ECE."""
+    labeled = [(o, y) for o, y in zip(outputs, labels) if y is not None]
+    if not labeled:
+        return None
+    ratio = lambda a, b: round(a / b, 4) if b else None
+    non_xrays = [o for o, y in labeled if y == "not_xray"]
+    xrays = [o for o, y in labeled if y != "not_xray"]
+    report = {
+        "labeled_images": len(labeled),
+        "not_xray_detected": ratio(sum(o["decision"] == "not_xray" for o in non_xrays), len(non_xrays)),
+        "xray_rejected": ratio(sum(o["decision"] == "not_xray" for o in xrays), len(xrays)),
+        "uncertain": ratio(sum(o["decision"] == "uncertain" for o, _ in labeled), len(labeled)),
+        "errors": sum(o["decision"] == "error" for o, _ in labeled),
+    }
+
+    classed = [(o, y) for o, y in labeled if y in CLASS_LABELS.values()]
+    if classed:
+        # Uncertain, rejected and failed images count as wrong
+        report["accuracy"] = ratio(sum(o["decision"] == y for o, y in labeled), len(labeled))
+        scored = [(o["p_pneumonia"], y == "pneumonia") for o, y in classed if o["p_pneumonia"] is not None]
+        if scored:
+            probs = np.asarray([p for p, _ in scored], dtype=np.float64)
+            targets = np.asarray([t for _, t in scored], dtype=np.float64)
+            report.update({
+                "scored_images": len(scored),
+                "brier": round(float(np.mean((probs - targets) ** 2)), 4),
+                "ece": round(_expected_calibration_error(probs, targets), 4),
+                "accuracy_at_0.5": round(float(np.mean((probs >= 0.5) == targets)), 4),
+            })
+    return report
+
+
+def agreement(torch_outputs, keras_outputs, paths, max_listed=20):
+    """Decision agreement between the stacks, overall, at the gate and on the class."""
+    n = len(paths)
+    matrix = {a: {b: 0 for b in DECISIONS} for a in DECISIONS}
+    disagreements = []
+    for path, t, k in zip(paths, torch_outputs, keras_outputs):
+        matrix[t["decision"]][k["decision"]] += 1
+        if t["decision"] != k["decision"] and len(disagreements) < max_listed:
+            disagreements.append({"path": path, "torch": t, "keras": k})
+
+    gate_pairs = [(t, k) for t, k in zip(torch_outputs, keras_outputs) if "error" not in (t["decision"], k["decision"])]
+    both = [(t["p_pneumonia"], k["p_pneumonia"]) for t, k in gate_pairs if t["p_pneumonia"] is not None and k["p_pneumonia"] is not None]
+    diffs = np.abs(np.asarray([a - b for a, b in both], dtype=np.float64))
+    return {
+        "images": n,
+        "decisions": round(sum(matrix[d][d] for d in DECISIONS) / n, 4) if n else None,
+        "gate": round(sum((t["decision"] == "not_xray") == (k["decision"] == "not_xray") for t, k in gate_pairs) / len(gate_pairs), 4) if gate_pairs else None,
+        # On images both stacks accepted as X-rays, each class at p >= 0.5
+        "class_at_0.5": round(sum((a >= 0.5) == (b >= 0.5) for a, b in both) / len(both), 4) if both else None,
+        "both_accepted": len(both),
+        "mean_abs_prob_diff": round(float(diffs.mean()), 4) if both else None,
+        "max_abs_prob_diff": round(float(diffs.max()), 4) if both else None,
+        # torch decision -> keras decision -> images (empty rows and columns dropped)
+        "matrix": {a: {b: c for b, c in row.items() if c} for a, row in matrix.items() if any(row.values())},
+        "disagreements": disagreements,
+    }
+
+
+def _run_stack(stack, python, manifest_path, tmp_dir, verbose):
+    result_path = os.path.join(tmp_dir, f"{stack}.json")
+    command = [python, os.path.abspath(__file__), "--worker", stack, "--manifest", manifest_path, "--result", result_path]
+    print(f"Running the {stack} stack ({python})...")
+    proc = subprocess.run(command, cwd=os.path.dirname(os.path.abspath(__file__)), stderr=None if verbose else subprocess.PIPE, text=True)
+    if proc.returncode != 0:
+        tail = (proc.stderr or "").strip().splitlines()[-15:]
+        print(f"The {stack} stack failed (exit {proc.returncode}):\n  " + "\n  ".join(tail))
+        return None
+    with open(result_path) as f:
+        return json.load(f)
+
+
+def _print_summary(report):
+    for stack, result in report["stacks"].items():
+        info = result["stack"]
+        latency = info["batch_latency_ms"]
+        stages = "  ".join(f"{stage} {ms:.1f}" for stage, ms in info["stage_ms_per_image"].items())
+        print(f"{stack:6s} {info['images_per_s']:7.2f} img/s  batch p50 {latency['p50']:.1f} ms  p95 {latency['p95']:.1f} ms  "
+              f"load {info['load_ms']:.0f} ms  rss {info['rss_after_load_mb']} MB (peak {info['peak_rss_mb']} MB)")
+        print(f"       ms/image: {stages}")
+        cal = report["calibration"].get(stack)
+        if cal:
+            print(f"       " + "  ".join(f"{k} {v}" for k, v in cal.items()))
+    agree = report.get("agreement")
+    if agree:
+        print(f"Agreement: decisions {agree['decisions']}  gate {agree['gate']}  class {agree['class_at_0.5']} "
+              f"(on {agree['both_accepted']} accepted by both)  mean |dp| {agree['mean_abs_prob_diff']}")
+        print(f"  torch -> keras: {agree['matrix']}")
+
+
+def main():
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Compare the Keras and PyTorch pneumonia pipelines on the same images")
+    parser.add_argument("--images", help="Folder of images (labels from NORMAL/ and PNEUMONIA/ subfolders); default: synthetic images")
+    parser.add_argument("--limit", type=int, default=0, help="Only the first N images of --images (0 = all)")
+    parser.add_argument("--count", type=int, default=32, help="Synthetic X-rays (plus a quarter as many photos)")
+    parser.add_argument("--resolution", type=int, default=1024, help="Synthetic image width in px (height = 1.25 x width)")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--stacks", default=",".join(STACKS), help=f"Comma-separated subset of {', '.join(STACKS)}")
+    parser.add_argument("--threads", type=int, default=0, help="Intra-op threads for both frameworks (0 = default)")
+    parser.add_argument("--torch-python", default=sys.executable, help="Interpreter with torch installed")
+    parser.add_argument("--keras-python", default=sys.executable, help="Interpreter with tensorflow installed")
+    parser.add_argument("--keras-model", default=os.path.join(base_dir, "..", "ml_model", "chest_xray_pneumonia_final.keras"))
+    parser.add_argument("--cls-path", default=os.path.join(base_dir, "..", "ml_model", "classifier", "best_pneumonia_model.pt"))
+    parser.add_argument("--gate-path", default=os.path.join(base_dir, "..", "ml_model", "gate", "xray_gate_efficientnet_b0.pth"))
+    parser.add_argument("--backend", default="eager", help="torch stack: inference backend (ML_BACKEND)")
+    parser.add_argument("--optimize", action="store_true", help="torch stack: inference build of the models (ML_OPTIMIZE_MODELS=1)")
+    parser.add_argument("--heatmaps", action="store_true", help="torch stack: render PNG Grad-CAM overlays, as /predict does by default")
+    parser.add_argument("--verbose", action="store_true", help="Show the stacks' own log output")
+    parser.add_argument("--output", help="Write the JSON report here")
+    parser.add_argument("--worker", choices=STACKS, help=argparse.SUPPRESS)
+    parser.add_argument("--manifest", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        return run_worker(args.worker, args.manifest, args.result)
+
+    stacks = [s for s in args.stacks.split(",") if s]
+    unknown = set(stacks) - set(STACKS)
+    if unknown:
+        parser.error(f"unknown stacks: {', '.join(sorted(unknown))}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.images:
+            paths, labels = labeled_images(args.images, args.limit)
+            if not paths:
+                raise SystemExit(f"No images under {args.images}")
+        else:
+            paths, labels = synthetic_images(tmp_dir, args.count, args.resolution)
+        print(f"{len(paths)} images, batches of {args.batch_size}")
+
+        config = {k: v for k, v in vars(args).items() if k not in ("worker", "manifest", "result")}
+        manifest_path = os.path.join(tmp_dir, "manifest.json")
+        with open(manifest_path, "w") as f:
+            json.dump({"paths": paths, "config": config}, f)
+
+        pythons = {"torch": args.torch_python, "keras": args.keras_python}
+        results = {}
+        for stack in stacks:
+            result = _run_stack(stack, pythons[stack], manifest_path, tmp_dir, args.verbose)
+            if result:
+                results[stack] = result
+
+    report = {
+        "config": config,
+        "labels": dict(Counter(str(label) for label in labels)),
+        "stacks": results,
+        "calibration": {stack: calibration(result["outputs"], labels) for stack, result in results.items()},
+    }
+    if "torch" in results and "keras" in results:
+        report["agreement"] = agreement(results["torch"]["outputs"], results["keras"]["outputs"], paths)
+    for stack, result in results.items():
+        result["outputs"] = [{"path": path, **output} for path, output in zip(paths, result["outputs"])]
+    _print_summary(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+    if len(results) < len(stacks):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -51,6 +51,67 @@ def g_mean_metric(y_true, y_pred):
     spec = tn / (tn + fp + K.epsilon())
     return K.sqrt(sens * spec)
 
+# The two functions above are per-batch values that Keras averages over the
+# batches, which is not the F2 / G-mean of the whole dataset. The streaming
+# versions below accumulate the confusion matrix instead (and the functions
+# stay for models saved with them).
+
+class ConfusionMatrixMetric(tf.keras.metrics.Metric):
+    """Streaming TP / FP / TN / FN counts of a sigmoid output at `threshold`."""
+
+    def __init__(self, name="confusion_matrix", threshold=0.5, **kwargs):
+        super().__init__(name=name, **kwargs)
+        self.threshold = threshold
+        self.tp = self.add_weight(name="tp", initializer="zeros")
+        self.fp = self.add_weight(name="fp", initializer="zeros")
+        self.tn = self.add_weight(name="tn", initializer="zeros")
+        self.fn = self.add_weight(name="fn", initializer="zeros")
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        y_true = tf.reshape(tf.cast(y_true, tf.bool), [-1])
+        y_pred = tf.reshape(y_pred > self.threshold, [-1])
+        weight = tf.ones_like(y_true, tf.float32) if sample_weight is None else tf.reshape(tf.cast(sample_weight, tf.float32), [-1])
+        count = lambda mask: tf.reduce_sum(tf.where(mask, weight, 0.0))
+        self.tp.assign_add(count(y_true & y_pred))
+        self.fp.assign_add(count(~y_true & y_pred))
+        self.tn.assign_add(count(~y_true & ~y_pred))
+        self.fn.assign_add(count(y_true & ~y_pred))
+
+    def counts(self):
+        return {"tp": self.tp, "fp": self.fp, "tn": self.tn, "fn": self.fn}
+
+    def result(self):
+        return self.tp + self.fp + self.tn + self.fn
+
+    def reset_state(self):
+        for v in (self.tp, self.fp, self.tn, self.fn):
+            v.assign(0.0)
+
+    def get_config(self):
+        return {**super().get_config(), "threshold": self.threshold}
+
+class F2Score(ConfusionMatrixMetric):
+    """F2 (recall weighted over precision) over all samples seen."""
+
+    def __init__(self, name="f2_score", threshold=0.5, **kwargs):
+        super().__init__(name=name, threshold=threshold, **kwargs)
+
+    def result(self):
+        p = self.tp / (self.tp + self.fp + K.epsilon())
+        r = self.tp / (self.tp + self.fn + K.epsilon())
+        return 5 * p * r / (4 * p + r + K.epsilon())
+
+class GMean(ConfusionMatrixMetric):
+    """Geometric mean of sensitivity and specificity over all samples seen."""
+
+    def __init__(self, name="g_mean", threshold=0.5, **kwargs):
+        super().__init__(name=name, threshold=threshold, **kwargs)
+
+    def result(self):
+        sens = self.tp / (self.tp + self.fn + K.epsilon())
+        spec = self.tn / (self.tn + self.fp + K.epsilon())
+        return tf.sqrt(sens * spec)
+
 # ==========================================
 # 3. CBAM IMPLEMENTATION
 # ==========================================
@@ -88,10 +149,11 @@ def cbam_block(x, ratio=8):
 # 4. MODEL BUILDER
 # ==========================================
 
-def build_model():
+def build_model(base_weights='imagenet'):
+    # base_weights=None skips the ImageNet download when a checkpoint is loaded afterwards
     inputs = Input(shape=(CONFIG['img_size'], CONFIG['img_size'], 3))
     
-    base = EfficientNetB0(include_top=False, weights='imagenet', input_tensor=inputs)
+    base = EfficientNetB0(include_top=False, weights=base_weights, input_tensor=inputs)
     # Note: User code set base.trainable = True. 
     # Whether we need to set it to verify weights depends. 
     # Usually loading weights will overwrite trainable status or just weights.
@@ -114,6 +176,6 @@ def build_model():
     model.compile(
         optimizer=Adam(learning_rate=CONFIG['lr']),
         loss=focal_loss(gamma=CONFIG['gamma'], alpha=CONFIG['alpha']),
-        metrics=['accuracy', tf.keras.metrics.Recall(name='recall'), f2_score_metric, g_mean_metric]
+        metrics=['accuracy', tf.keras.metrics.Recall(name='recall'), F2Score(), GMean()]
     )
     return model
@@ -0,0 +1,94 @@
+import functools
+
+import numpy as np
+import torch
+
+
+# --- SINGLE-PASS CLASSIFY + EXPLAIN ---
+class CamEngine:
+    """
+    Grad-CAM++ engine for the single-logit EfficientNetB0WithCBAM.
+
+    `model` exposes forward_features (backbone up to the CAM target layer,
+    base.features[-1]) and forward_head (CBAM + pooling + classifier); eager
+    modules and traced snapshots both do. Each call runs the backbone once
+    without autograd, then the head with the feature maps as the only tensor
+    that requires grad. The sigmoid probability comes from that same forward
+    and the logit is differentiated with respect to the feature maps alone
+    (no parameter gradients, no backbone backward, no second forward).
+    Matches pytorch_grad_cam's GradCAMPlusPlus with ClassifierOutputTarget(0);
+    samples whose Grad-CAM++ map is not finite fall back to plain Grad-CAM
+    weights computed from the same gradients. A batch is explained in one
+    forward/backward; the maps of a sample do not depend on the others.
+    """
+
+    def __init__(self, model):
+        self.model = model
+
+    def __call__(self, tensor):
+        """
+        Returns (pneumonia_probs, cams, methods) for an [N, 3, H, W] batch.
+
+        `cams` is an [N, H, W] float32 array scaled to [0, 1];
+        `methods` holds "gradcam++" or "gradcam" per sample.
+        """
+        with torch.no_grad():
+            activations = self.model.forward_features(tensor)
+        with torch.enable_grad():
+            activations.requires_grad_(True)
+            logits = self.model.forward_head(activations)
+            # ClassifierOutputTarget(0): the single logit of every sample
+            grads = torch.autograd.grad(logits[:, 0].sum(), activations)[0]
+
+        probs = torch.sigmoid(logits.detach())[:, 0].tolist()
+        activations = activations.detach()
+
+        with torch.no_grad():
+            cams = self._cam(activations, self._gradcam_plusplus_weights(activations, grads))
+            finite = torch.isfinite(cams).flatten(1).all(dim=1)
+            methods = ["gradcam++" if ok else "gradcam" for ok in finite.tolist()]
+            if not finite.all():
+                fallback = self._cam(activations, grads.mean(dim=(2, 3)))
+                cams = torch.where(finite[:, None, None], cams, fallback)
+
+        return probs, self._scale(cams.cpu().numpy(), tensor.shape[-1], tensor.shape[-2]), methods
+
+    @staticmethod
+    def _gradcam_plusplus_weights(activations, grads):
+        # Equation 19 in https://arxiv.org/abs/1710.11063
+        grads_power_2 = grads ** 2
+        grads_power_3 = grads_power_2 * grads
+        sum_activations = activations.sum(dim=(2, 3), keepdim=True)
+        aij = grads_power_2 / (2 * grads_power_2 + sum_activations * grads_power_3 + 1e-6)
+        aij = torch.where(grads != 0, aij, torch.zeros_like(aij))
+        return (grads.clamp(min=0) * aij).sum(dim=(2, 3))
+
+    @staticmethod
+    def _cam(activations, weights):
+        return (weights[:, :, None, None] * activations).sum(dim=1).clamp(min=0)
+
+    @staticmethod
+    def _scale(cams, width, height):
+        # Same min-max scaling + bilinear resize as
+        # pytorch_grad_cam.utils.image.scale_cam_image, for the whole batch at once
+        cams = np.float32(cams)
+        cams = cams - cams.min(axis=(1, 2), keepdims=True)
+        cams = cams / (1e-7 + cams.max(axis=(1, 2), keepdims=True))
+        rows, cols = _resize_matrices(cams.shape[1], cams.shape[2], height, width)
+        cams = rows @ cams @ cols
+        cams = cams - cams.min(axis=(1, 2), keepdims=True)
+        return np.float32(cams / (1e-7 + cams.max(axis=(1, 2), keepdims=True)))
+
+
+@functools.lru_cache(maxsize=8)
+def _resize_matrices(height, width, out_height, out_width):
+    """
+    cv2.resize (bilinear) from (height, width) to (out_height, out_width) as
+    rows @ image @ cols: the interpolation is separable and linear, so
+    resizing identity matrices yields its weights.
+    """
+    import cv2
+
+    rows = cv2.resize(np.eye(height, dtype=np.float32), (height, out_height))
+    cols = cv2.resize(np.eye(width, dtype=np.float32), (out_width, width))
+    return rows, cols
@@ -0,0 +1,172 @@
+"""
+On-disk store of the classifier's backbone feature maps, for re-scoring
+images with only the head (CBAM + pooling + classifier) after a head
+fine-tune or a threshold change, without running the backbone again.
+
+A store is a directory with:
+
+    meta.json       shape and dtype of one entry, and the fingerprints of the
+                    backbone and gate (plus decode settings) it was built with
+    features.f16    float16 maps (1280x7x7 = 125 KB per image), memory-mapped
+    index.jsonl     one line per image: content hash, row in features.f16 (or
+                    null for gate-rejected images), gate probability and size
+
+Entries are keyed by the SHA-256 of the image file, so renamed or moved files
+are still found. Maps are written before their index line, so an interrupted
+writer leaves at most unindexed rows, which are reused.
+"""
+import os
+import json
+import hashlib
+
+import numpy as np
+import torch
+
+FEATURE_SHAPE = (1280, 7, 7)
+
+
+def image_key(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def backbone_fingerprint(model):
+    """Short hash of the classifier backbone's weights (model.base.features)."""
+    h = hashlib.sha256()
+    for name, tensor in model.base.features.state_dict().items():
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()[:16]
+
+
+# --- FEATURE STORE ---
+class FeatureStore:
+    """
+    Opens (or creates) the store at `path`. `meta` holds what the stored
+    values depend on (backbone / gate fingerprints, decode settings); a
+    non-empty store built with different values raises ValueError.
+    """
+
+    def __init__(self, path, meta=None, shape=FEATURE_SHAPE, grow_rows=1024):
+        self.path = path
+        self.grow_rows = int(grow_rows)
+        os.makedirs(path, exist_ok=True)
+        self._meta_path = os.path.join(path, "meta.json")
+        self._data_path = os.path.join(path, "features.f16")
+        self._index_path = os.path.join(path, "index.jsonl")
+
+        stored = None
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                stored = json.load(f)
+        self._entries = self._read_index()
+        if stored and self._entries:
+            if tuple(stored["shape"]) != tuple(shape):
+                raise ValueError(f"Feature store {path} holds {stored['shape']} maps, not {list(shape)}")
+            changed = sorted(k for k, v in (meta or {}).items() if stored.get(k) != v)
+            if changed:
+                raise ValueError(f"Feature store {path} was built with another {', '.join(changed)}; use a new store")
+        self.meta = {**(stored or {}), **(meta or {}), "shape": list(shape), "dtype": "float16"}
+        with open(self._meta_path, "w") as f:
+            json.dump(self.meta, f, indent=2)
+
+        self.shape = tuple(shape)
+        self._row_bytes = int(np.prod(self.shape)) * 2
+        self._rows = 1 + max((e["row"] for e in self._entries.values() if e["row"] is not None), default=-1)
+        self._map = None
+        self._capacity = 0
+        self._index_file = None
+
+    def _read_index(self):
+        entries = {}
+        if not os.path.exists(self._index_path):
+            return entries
+        with open(self._index_path, "rb+") as f:
+            data = f.read()
+            # Drop a line cut short by an interruption
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+                data = data[:data.rfind(b"\n") + 1]
+        for line in data.splitlines():
+            entry = json.loads(line)
+            entries[entry.pop("key")] = entry
+        return entries
+
+    def _mapped(self, rows):
+        """The maps file as a (capacity, *shape) memmap holding at least `rows` rows."""
+        if self._map is not None and rows <= self._capacity:
+            return self._map
+        capacity = os.path.getsize(self._data_path) // self._row_bytes if os.path.exists(self._data_path) else 0
+        if rows > capacity:
+            # Grow in steps so appends don't remap on every batch
+            capacity = rows + self.grow_rows
+            with open(self._data_path, "ab") as f:
+                f.truncate(capacity * self._row_bytes)
+        self._map = np.memmap(self._data_path, dtype=np.float16, mode="r+", shape=(capacity,) + self.shape)
+        self._capacity = capacity
+        return self._map
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """{"row", "xray_confidence", "image_width", "image_height"} of an image, or None."""
+        return self._entries.get(key)
+
+    def add(self, items):
+        """
+        Stores (key, maps, info) items: `maps` a `shape` array (None for images
+        without maps, e.g. gate-rejected) and `info` the entry's other fields.
+        """
+        items = [(key, maps, info) for key, maps, info in items]
+        with_maps = [i for i, (_, maps, _) in enumerate(items) if maps is not None]
+        rows = {}
+        if with_maps:
+            start = self._rows
+            data = self._mapped(start + len(with_maps))
+            for offset, i in enumerate(with_maps):
+                data[start + offset] = items[i][1]
+                rows[i] = start + offset
+            data.flush()
+            self._rows = start + len(with_maps)
+
+        if self._index_file is None:
+            self._index_file = open(self._index_path, "a")
+        for i, (key, _, info) in enumerate(items):
+            entry = {**info, "row": rows.get(i)}
+            self._entries[key] = entry
+            self._index_file.write(json.dumps({"key": key, **entry}) + "\n")
+        self._index_file.flush()
+        os.fsync(self._index_file.fileno())
+
+    def features(self, rows):
+        """float16 array of the maps at `rows`, in that order (a copy)."""
+        return np.asarray(self._mapped(self._rows)[np.asarray(rows, dtype=np.int64)])
+
+    def stats(self):
+        return {
+            "images": len(self._entries),
+            "feature_rows": self._rows,
+            "bytes": self._rows * self._row_bytes,
+        }
+
+    def close(self):
+        if self._index_file is not None:
+            self._index_file.close()
+            self._index_file = None
+        self._map = None
+
+
+def score_features(model, store, rows, batch_size=512, device="cpu"):
+    """
+    Pneumonia probabilities for stored maps: only `model.forward_head` (CBAM,
+    pooling, classifier) runs, over `batch_size` maps at a time.
+    """
+    probs = []
+    with torch.no_grad():
+        for i in range(0, len(rows), batch_size):
+            maps = torch.from_numpy(store.features(rows[i:i + batch_size])).to(device=device, dtype=torch.float32)
+            probs.extend(torch.sigmoid(model.forward_head(maps))[:, 0].tolist())
+    return probs
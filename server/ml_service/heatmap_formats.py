@@ -0,0 +1,115 @@
+import time
+import base64
+from collections import namedtuple
+
+import numpy as np
+from PIL import Image
+
+from overlay import OverlayRenderer
+from metrics import stage_of
+
+# Overlays are encoded images; cam_* formats send the CAM grid itself
+# (model input resolution, row-major) for the client to colorize and blend.
+OVERLAY_FORMATS = ("png", "jpeg", "webp")
+CAM_FORMATS = ("cam_uint8", "cam_float16")
+HEATMAP_FORMATS = OVERLAY_FORMATS + CAM_FORMATS
+
+
+class HeatmapOptions(namedtuple("HeatmapOptions", ["format", "max_edge", "quality"])):
+    """
+    How the Grad-CAM result is returned.
+
+    format:   one of HEATMAP_FORMATS
+    max_edge: cap on the longest output edge in pixels (0 = no cap)
+    quality:  JPEG/WebP quality, 1-100 (ignored by the other formats)
+    """
+    __slots__ = ()
+
+    def __new__(cls, format="png", max_edge=0, quality=90):
+        if format not in HEATMAP_FORMATS:
+            raise ValueError(f"Unknown heatmap format '{format}' (expected one of {', '.join(HEATMAP_FORMATS)})")
+        max_edge = int(max_edge or 0)
+        if max_edge < 0:
+            raise ValueError("heatmap max edge must be >= 0")
+        quality = int(quality)
+        if not 1 <= quality <= 100:
+            raise ValueError("heatmap quality must be between 1 and 100")
+        return super().__new__(cls, format, max_edge, quality)
+
+    def cache_token(self):
+        return f"{self.format}:{self.max_edge}:{self.quality}"
+
+
+def _fit(width, height, max_edge):
+    if not max_edge or max(width, height) <= max_edge:
+        return width, height
+    scale = max_edge / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def encode_heatmap(load_image, grayscale_cam, options, renderer=None, timer=None):
+    """
+    Turn a [H, W] CAM in [0, 1] into the response fields for `options`.
+
+    `load_image(max_edge)` returns the full-resolution RGB PIL image (or a
+    reduced decode no smaller than `max_edge`); it is only called for
+    overlay formats. An optional metrics.StageTimer records the "overlay"
+    (full-image load, resize and render) and "encode" stages.
+
+    Returns a dict with "heatmap" (base64 payload), "heatmap_format",
+    "heatmap_shape" ([height, width] of the payload), "heatmap_bytes"
+    (size before base64), "heatmap_encode_ms" (CAM to payload) and
+    "heatmap_peak_bytes" (peak working memory of the render).
+    """
+    # OpenCV is only loaded once the first heatmap is encoded
+    import cv2
+
+    started = time.perf_counter()
+    stage = stage_of(timer)
+
+    if options.format in CAM_FORMATS:
+        with stage("encode"):
+            h, w = grayscale_cam.shape
+            out_w, out_h = _fit(w, h, options.max_edge)
+            cam = grayscale_cam
+            if (out_w, out_h) != (w, h):
+                cam = cv2.resize(cam, (out_w, out_h), interpolation=cv2.INTER_AREA)
+            if options.format == "cam_uint8":
+                raw = np.clip(cam * 255.0 + 0.5, 0, 255).astype(np.uint8).tobytes()
+            else:
+                raw = cam.astype(np.float16).tobytes()
+            peak_bytes = cam.nbytes + len(raw)
+    else:
+        with stage("overlay"):
+            pil_img = load_image(options.max_edge)
+            out_w, out_h = _fit(pil_img.width, pil_img.height, options.max_edge)
+            if (out_w, out_h) != pil_img.size:
+                pil_img = pil_img.resize((out_w, out_h), Image.BILINEAR)
+
+            # The only full-frame buffer: the image, overlaid in place as BGR
+            frame = np.array(pil_img)
+            render_bytes = (renderer or OverlayRenderer()).render(frame, grayscale_cam)
+
+        with stage("encode"):
+            if options.format == "png":
+                success, buffer = cv2.imencode('.png', frame)
+            elif options.format == "jpeg":
+                success, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, options.quality])
+            else:
+                success, buffer = cv2.imencode('.webp', frame, [cv2.IMWRITE_WEBP_QUALITY, options.quality])
+            if not success:
+                raise RuntimeError(f"cv2.imencode failed for {options.format}")
+            raw = buffer.reshape(-1).data
+            peak_bytes = frame.nbytes + max(render_bytes, 2 * len(raw))
+
+    with stage("encode"):
+        payload = base64.b64encode(raw).decode('utf-8')
+
+    return {
+        "heatmap": payload,
+        "heatmap_format": options.format,
+        "heatmap_shape": [out_h, out_w],
+        "heatmap_bytes": len(raw),
+        "heatmap_encode_ms": round((time.perf_counter() - started) * 1000.0, 3),
+        "heatmap_peak_bytes": peak_bytes,
+    }
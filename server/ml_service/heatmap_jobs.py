@@ -0,0 +1,128 @@
+import time
+import uuid
+import asyncio
+
+
+# --- DEFERRED GRAD-CAM JOBS ---
+class HeatmapJobs:
+    """
+    Background queue for heatmaps requested with /predict?defer_heatmap=true.
+
+    `compute` is an async callable returning the heatmap response fields
+    ("heatmap", "heatmap_format", ...) for the submitted arguments. At most
+    `max_concurrency` jobs run at once; the rest wait their turn. Finished
+    jobs are kept for `ttl_seconds` and then dropped, after which
+    /heatmap/{id} answers 404.
+
+    Queued jobs hold their upload, so at most `max_pending` of them, and
+    `max_pending_mb` of uploads (queued and running), are kept: a new job
+    evicts the oldest queued ones (status "evicted") until it fits.
+    """
+
+    def __init__(self, compute, max_concurrency=2, ttl_seconds=600, max_pending=256, max_pending_mb=256):
+        self.compute = compute
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.ttl_seconds = float(ttl_seconds)
+        self.max_pending = max(1, int(max_pending))
+        self.max_pending_bytes = int(max_pending_mb * 1024 * 1024)
+
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        self._jobs = {}
+        self._tasks = set()
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def submit(self, data, *args):
+        """Queues a job for the upload `data` (plus `compute`'s other arguments)."""
+        self._purge_expired()
+        self._make_room(len(data))
+        job_id = uuid.uuid4().hex
+        self._jobs[job_id] = {"status": "pending", "result": {}, "created": time.time(), "finished": None, "bytes": len(data)}
+        self.submitted += 1
+
+        task = asyncio.create_task(self._run(job_id, (data,) + args))
+        self._jobs[job_id]["task"] = task
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job_id
+
+    def _held_bytes(self):
+        return sum(job["bytes"] for job in self._jobs.values() if job["status"] in ("pending", "running"))
+
+    def _make_room(self, size):
+        # Oldest queued jobs first; running ones finish. A single upload over
+        # the byte budget is still taken once nothing else is queued
+        queued = [job for job in self._jobs.values() if job["status"] == "pending"]
+        held = self._held_bytes()
+        while queued and (len(queued) >= self.max_pending or held + size > self.max_pending_bytes):
+            job = queued.pop(0)
+            held -= job["bytes"]
+            job.pop("task").cancel()
+            job["status"] = "evicted"
+            job["error"] = "Dropped to make room for newer heatmap jobs"
+            job["finished"] = time.time()
+            self.evicted += 1
+
+    async def _run(self, job_id, args):
+        job = self._jobs[job_id]
+        async with self._slots:
+            job["status"] = "running"
+            try:
+                job["result"] = await self.compute(*args)
+                job["status"] = "done"
+                self.completed += 1
+            except Exception as e:
+                print(f"Heatmap job {job_id} failed: {e}")
+                job["status"] = "failed"
+                job["error"] = str(e)
+                self.failed += 1
+            finally:
+                job["finished"] = time.time()
+                job.pop("task", None)
+
+    def get(self, job_id):
+        self._purge_expired()
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        result = {"job_id": job_id, "status": job["status"], "heatmap": None, **job["result"]}
+        if "error" in job:
+            result["error"] = job["error"]
+        return result
+
+    def _purge_expired(self):
+        cutoff = time.time() - self.ttl_seconds
+        expired = [job_id for job_id, job in self._jobs.items() if job["finished"] and job["finished"] < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+        self.expired += len(expired)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._jobs.clear()
+
+    def stats(self):
+        self._purge_expired()
+        statuses = [job["status"] for job in self._jobs.values()]
+        return {
+            "max_concurrency": self.max_concurrency,
+            "ttl_seconds": self.ttl_seconds,
+            "max_pending": self.max_pending,
+            "max_pending_mb": round(self.max_pending_bytes / (1024 * 1024), 3),
+            "pending": statuses.count("pending"),
+            "running": statuses.count("running"),
+            "pending_bytes": self._held_bytes(),
+            "stored": len(self._jobs),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
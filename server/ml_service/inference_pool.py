@@ -0,0 +1,143 @@
+import os
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import torch
+
+from shared_weights import process_memory
+
+# Per-worker state. In process mode every worker process has exactly one
+# executor thread; in thread mode every replica gets its own executor thread.
+# Either way the replica lives in the thread that runs its requests.
+_local = threading.local()
+
+
+def _pin_threads(num_threads):
+    torch.set_num_threads(num_threads)
+    try:
+        # Only allowed before the first parallel op in the process
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+
+def _init_worker(system_cls, system_kwargs, num_threads):
+    _pin_threads(num_threads)
+    _local.replica = system_cls(**system_kwargs)
+
+
+def _call_replica(method, args, kwargs):
+    return getattr(_local.replica, method)(*args, **kwargs)
+
+
+def _worker_info():
+    return {
+        "pid": os.getpid(),
+        "thread": threading.current_thread().name,
+        "torch_threads": torch.get_num_threads(),
+        "device": _local.replica.device,
+        "backend": getattr(_local.replica, "backend_info", None),
+        "model_source": getattr(_local.replica, "model_source", None),
+        "startup_ms": getattr(_local.replica, "startup_timings", None),
+        "shared_weights": getattr(_local.replica, "shared_weights", None),
+    }
+
+
+# --- MODEL-REPLICA WORKER POOL ---
+class InferencePool:
+    """
+    Runs PneumoniaSystem calls off the event loop on a fixed set of replicas.
+
+    Each worker owns one replica and executes one call at a time, so the
+    torch intra-op budget (`threads_per_worker`) times `workers` bounds the
+    cores in use. `mode="process"` gives every replica its own interpreter
+    (no GIL contention in pre/post-processing); `mode="thread"` keeps all
+    replicas in this process.
+    """
+
+    def __init__(self, system_cls, system_kwargs=None, workers=1, threads_per_worker=None, mode="thread"):
+        if mode not in ("thread", "process"):
+            raise ValueError(f"Unknown worker mode: {mode}")
+        self.system_cls = system_cls
+        self.system_kwargs = dict(system_kwargs or {})
+        self.workers = max(1, int(workers))
+        if not threads_per_worker:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // self.workers)
+        self.threads_per_worker = int(threads_per_worker)
+        self.mode = mode
+
+        self._executors = []
+        self._inflight = []
+        self._completed = []
+        self._info = []
+
+    async def start(self):
+        initargs = (self.system_cls, self.system_kwargs, self.threads_per_worker)
+        for i in range(self.workers):
+            if self.mode == "process":
+                # spawn: a fresh interpreter never inherits the parent's torch thread pools
+                executor = ProcessPoolExecutor(
+                    max_workers=1,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=initargs
+                )
+            else:
+                if i == 0:
+                    # Intra-op threads are shared by the whole process in thread mode
+                    _pin_threads(self.threads_per_worker)
+                executor = ThreadPoolExecutor(
+                    max_workers=1,
+                    thread_name_prefix=f"ml-worker-{i}",
+                    initializer=_init_worker,
+                    initargs=initargs
+                )
+            self._executors.append(executor)
+            self._inflight.append(0)
+            self._completed.append(0)
+
+        # Force every replica to load now rather than on the first request
+        loop = asyncio.get_running_loop()
+        self._info = await asyncio.gather(*[
+            loop.run_in_executor(executor, _worker_info) for executor in self._executors
+        ])
+        print(f"Inference pool ready: {self.workers} {self.mode} worker(s) x {self.threads_per_worker} thread(s)")
+
+    async def run(self, method, *args, **kwargs):
+        """Await `replica.<method>(*args, **kwargs)` on the least busy worker."""
+        if not self._executors:
+            raise RuntimeError("Inference pool not started")
+        idx = min(range(len(self._executors)), key=lambda i: self._inflight[i])
+        self._inflight[idx] += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executors[idx], _call_replica, method, args, kwargs)
+        finally:
+            self._inflight[idx] -= 1
+            self._completed[idx] += 1
+
+    def shutdown(self, wait=True):
+        for executor in self._executors:
+            executor.shutdown(wait=wait)
+        self._executors = []
+
+    def stats(self, memory=True):
+        """
+        Pool configuration and per-replica state. With `memory`, every
+        replica also reports the current memory of its process in bytes
+        (rss / pss / shared / private; thread replicas share one process).
+        """
+        replicas = []
+        for info, inflight, completed in zip(self._info, self._inflight, self._completed):
+            replica = {**info, "inflight": inflight, "completed": completed}
+            if memory:
+                replica["memory"] = process_memory(info["pid"])
+            replicas.append(replica)
+        return {
+            "mode": self.mode,
+            "workers": self.workers,
+            "threads_per_worker": self.threads_per_worker,
+            "replicas": replicas,
+        }
@@ -0,0 +1,211 @@
+"""
+Evaluation (and optional fine-tuning) of custom_model.build_model() with a
+tf.data input pipeline and whole-dataset metrics.
+
+Images are decoded and resized in parallel, the 224x224 uint8 tensors are
+cached on disk after the first pass (so re-validating a checkpoint skips
+decoding entirely), and batches are prefetched while the model runs:
+
+    python keras_eval.py chest_xray/test --weights model.weights.h5 --cache-dir /tmp/xray-cache
+    python keras_eval.py chest_xray/test --weights model.keras --passes 2 --output eval.json
+    python keras_eval.py chest_xray/val --train-dir chest_xray/train --epochs 3 --save tuned.weights.h5
+
+Labels come from the parent directory name: NORMAL (0) and PNEUMONIA (1);
+images elsewhere are skipped. Accuracy, precision, recall, specificity, F2,
+G-mean and AUC are computed from confusion counts accumulated over the whole
+dataset (custom_model.ConfusionMatrixMetric), not averaged per batch.
+
+A run interrupted while writing the disk cache leaves a .lockfile next to it;
+delete the cache files (or use another --cache-dir) before the next run.
+"""
+import os
+import json
+import time
+import hashlib
+import argparse
+
+import numpy as np
+import tensorflow as tf
+
+from custom_model import CONFIG, build_model, focal_loss, ConfusionMatrixMetric, F2Score, GMean, f2_score_metric, g_mean_metric
+
+# Formats tf.io.decode_image reads
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif")
+CLASS_LABELS = {"normal": 0, "pneumonia": 1}
+
+
+def labeled_images(folder, limit=0):
+    """(paths, labels) of the NORMAL / PNEUMONIA images under `folder`, sorted."""
+    paths, labels = [], []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        label = CLASS_LABELS.get(os.path.basename(root).lower())
+        if label is None:
+            continue
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(root, name))
+                labels.append(label)
+                if limit and len(paths) >= limit:
+                    return paths, labels
+    return paths, labels
+
+
+# --- INPUT PIPELINE ---
+def _decode(path, label, size):
+    image = tf.io.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+    image = tf.image.resize(image, (size, size))
+    # Cached as uint8: a quarter of the float32 size on disk
+    return tf.cast(tf.round(tf.clip_by_value(image, 0.0, 255.0)), tf.uint8), label
+
+
+def _to_model_input(image, label):
+    # EfficientNetB0 rescales internally and takes raw 0-255 pixels
+    return tf.cast(image, tf.float32), tf.cast(label, tf.float32)
+
+
+def make_dataset(paths, labels, batch_size=32, cache_dir=None, shuffle=False, size=CONFIG["img_size"]):
+    """
+    tf.data pipeline: parallel decode + resize, cache (on disk under
+    `cache_dir`, keyed by the files and size, else in memory), optional
+    shuffling after the cache, batching and prefetching.
+    """
+    ds = tf.data.Dataset.from_tensor_slices((paths, np.asarray(labels, np.int32)))
+    ds = ds.map(lambda p, y: _decode(p, y, size), num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        # A changed file list, image or size gets a new cache file
+        entries = [str(size)] + [f"{p}:{os.stat(p).st_mtime_ns}" for p in paths]
+        key = hashlib.sha256("\n".join(entries).encode()).hexdigest()[:16]
+        ds = ds.cache(os.path.join(cache_dir, f"images-{key}"))
+    else:
+        ds = ds.cache()
+    if shuffle:
+        ds = ds.shuffle(min(len(paths), 2048), reshuffle_each_iteration=True)
+    ds = ds.map(_to_model_input, num_parallel_calls=tf.data.AUTOTUNE)
+    return ds.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+# --- MODEL ---
+def load_model(weights):
+    """A full .keras model, or build_model() with a weights file (.weights.h5 / checkpoint)."""
+    if weights and weights.endswith(".keras"):
+        custom_objects = {
+            "focal_loss_fixed": focal_loss(gamma=CONFIG["gamma"], alpha=CONFIG["alpha"]),
+            "f2_score_metric": f2_score_metric, "g_mean_metric": g_mean_metric,
+            "F2Score": F2Score, "GMean": GMean,
+        }
+        return tf.keras.models.load_model(weights, custom_objects=custom_objects, compile=False, safe_mode=False)
+    model = build_model(base_weights=None if weights else "imagenet")
+    if weights:
+        model.load_weights(weights)
+    return model
+
+
+def evaluation_metrics(threshold=0.5):
+    return [ConfusionMatrixMetric(threshold=threshold), F2Score(threshold=threshold), GMean(threshold=threshold), tf.keras.metrics.AUC(name="auc")]
+
+
+def evaluate(model, ds, threshold=0.5):
+    """One pass over `ds`: whole-dataset metrics plus images/s."""
+    metrics = evaluation_metrics(threshold)
+    forward = tf.function(lambda x: model(x, training=False))
+
+    images = 0
+    started = time.perf_counter()
+    for x, y in ds:
+        scores = forward(x)
+        for metric in metrics:
+            metric.update_state(y, scores)
+        images += int(x.shape[0])
+    elapsed = time.perf_counter() - started
+
+    confusion, f2, g_mean, auc = metrics
+    tp, fp, tn, fn = (float(v.numpy()) for v in confusion.counts().values())
+    ratio = lambda a, b: a / b if b else 0.0
+    return {
+        "images": images,
+        "seconds": round(elapsed, 3),
+        "images_per_s": round(ratio(images, elapsed), 2),
+        "threshold": threshold,
+        "confusion": {"tp": int(tp), "fp": int(fp), "tn": int(tn), "fn": int(fn)},
+        "accuracy": round(ratio(tp + tn, tp + fp + tn + fn), 4),
+        "precision": round(ratio(tp, tp + fp), 4),
+        "recall": round(ratio(tp, tp + fn), 4),
+        "specificity": round(ratio(tn, tn + fp), 4),
+        "f2": round(float(f2.result().numpy()), 4),
+        "g_mean": round(float(g_mean.result().numpy()), 4),
+        "auc": round(float(auc.result().numpy()), 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate / fine-tune the Keras EfficientNet+CBAM model with tf.data")
+    parser.add_argument("eval_dir", help="Folder with NORMAL/ and PNEUMONIA/ subfolders")
+    parser.add_argument("--weights", help=".keras model or weights file for build_model() (default: ImageNet backbone, untrained head)")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--cache-dir", help="Cache decoded 224x224 images here across runs (default: in memory, this run only)")
+    parser.add_argument("--passes", type=int, default=1, help="Evaluation passes; later passes read the cache")
+    parser.add_argument("--threshold", type=float, default=0.5, help="Decision threshold on the sigmoid output")
+    parser.add_argument("--limit", type=int, default=0, help="Only the first N images (0 = all)")
+    parser.add_argument("--train-dir", help="Fine-tune on this folder before evaluating")
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--save", help="Where to save the fine-tuned weights (.weights.h5 or .keras)")
+    parser.add_argument("--output", help="Write the report as JSON")
+    args = parser.parse_args()
+
+    paths, labels = labeled_images(args.eval_dir, args.limit)
+    if not paths:
+        raise SystemExit(f"No NORMAL / PNEUMONIA images under {args.eval_dir}")
+    print(f"{len(paths)} images ({sum(labels)} pneumonia) under {args.eval_dir}")
+    eval_ds = make_dataset(paths, labels, args.batch_size, args.cache_dir)
+
+    model = load_model(args.weights)
+    report = {"eval_dir": args.eval_dir, "weights": args.weights, "batch_size": args.batch_size, "passes": []}
+
+    if args.train_dir:
+        train_paths, train_labels = labeled_images(args.train_dir)
+        if not train_paths:
+            raise SystemExit(f"No NORMAL / PNEUMONIA images under {args.train_dir}")
+        train_ds = make_dataset(train_paths, train_labels, args.batch_size, args.cache_dir, shuffle=True)
+        # Recompiled so training reports the streaming metrics too
+        model.compile(
+            optimizer=tf.keras.optimizers.Adam(learning_rate=CONFIG["lr"]),
+            loss=focal_loss(gamma=CONFIG["gamma"], alpha=CONFIG["alpha"]),
+            metrics=["accuracy", tf.keras.metrics.Recall(name="recall"), F2Score(), GMean()]
+        )
+        started = time.perf_counter()
+        history = model.fit(train_ds, validation_data=eval_ds, epochs=args.epochs, verbose=2)
+        elapsed = time.perf_counter() - started
+        report["fine_tune"] = {
+            "train_dir": args.train_dir,
+            "images": len(train_paths),
+            "epochs": args.epochs,
+            "images_per_s": round(len(train_paths) * args.epochs / elapsed, 2),
+            "history": {k: [round(float(v), 4) for v in values] for k, values in history.history.items()},
+        }
+        if args.save:
+            if args.save.endswith(".keras"):
+                model.save(args.save)
+            else:
+                model.save_weights(args.save)
+            print(f"Fine-tuned model saved to {args.save}")
+
+    for n in range(max(1, args.passes)):
+        result = evaluate(model, eval_ds, args.threshold)
+        report["passes"].append(result)
+        print(f"Pass {n + 1}: {result['images']} images in {result['seconds']}s ({result['images_per_s']} images/s)")
+    result = report["passes"][-1]
+    print(f"  accuracy {result['accuracy']}  precision {result['precision']}  recall {result['recall']}  "
+          f"specificity {result['specificity']}  F2 {result['f2']}  G-mean {result['g_mean']}  AUC {result['auc']}")
+    print(f"  confusion {result['confusion']}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
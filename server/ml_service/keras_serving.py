@@ -0,0 +1,151 @@
+"""
+Serving core for the Keras model behind model_service.py.
+
+The model runs through one traced tf.function with a fixed input signature
+(a uint8 batch of any size; scaling to [0, 1] happens inside the graph)
+instead of model.predict(), which sets up Keras's whole predict loop on every
+call. Concurrent requests (Flask serves them on threads) are coalesced into
+batches by a single batching thread.
+"""
+import time
+import queue
+import threading
+from collections import Counter, deque
+from concurrent.futures import Future
+
+import numpy as np
+from PIL import Image
+
+INPUT_SIZE = (224, 224)
+
+
+def load_image(source, size=INPUT_SIZE):
+    """
+    One image as a (height, width, 3) uint8 array: resized first, then made
+    RGB, like the original preprocessing (grayscale X-rays are resized on one
+    channel and broadcast instead of converted).
+    """
+    img = Image.open(source)
+    img = img.resize(size)
+    if img.mode == "L":
+        gray = np.asarray(img)
+        return np.broadcast_to(gray[..., None], gray.shape + (3,))
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return np.asarray(img)
+
+
+def _percentiles(values):
+    if not values:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0}
+    p50, p95, p99 = np.percentile(np.fromiter(values, dtype=np.float64), [50, 95, 99])
+    return {"p50": round(p50, 3), "p95": round(p95, 3), "p99": round(p99, 3)}
+
+
+# --- BATCHED GRAPH PREDICTOR ---
+class KerasBatchPredictor:
+    """
+    Coalesces concurrent `predict_image()` calls into batches for a Keras
+    model. A batch runs as soon as it holds `max_batch_size` images or the
+    oldest one has waited `max_wait_ms`; while a batch runs, the next one
+    fills up. Returns the model's output row for each image.
+    """
+
+    def __init__(self, model, max_batch_size=16, max_wait_ms=5.0, latency_window=1000):
+        import tensorflow as tf
+
+        height, width = (model.input_shape[1] or INPUT_SIZE[1]), (model.input_shape[2] or INPUT_SIZE[0])
+        self.input_size = (width, height)
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+
+        @tf.function(input_signature=[tf.TensorSpec([None, height, width, 3], tf.uint8)])
+        def forward(images):
+            return model(tf.cast(images, tf.float32) / 255.0, training=False)
+
+        self._forward = forward
+        # Trace (and run) the graph once now, not on the first request
+        started = time.perf_counter()
+        self._forward(np.zeros((1, height, width, 3), np.uint8))
+        self.warmup_ms = round((time.perf_counter() - started) * 1000.0, 1)
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=latency_window)
+
+        # Stats
+        self._batch_sizes = Counter()
+        self._items = 0
+        self._batches = 0
+        self._queue_wait_total = 0.0
+        self._run_time_total = 0.0
+        self._preprocess_total = 0.0
+
+        self._thread = threading.Thread(target=self._collect_loop, name="keras-batcher", daemon=True)
+        self._thread.start()
+
+    def predict_image(self, source):
+        """Decode `source` (path or file object) and block until its batch ran."""
+        started = time.perf_counter()
+        image = load_image(source, self.input_size)
+        enqueued = time.perf_counter()
+        future = Future()
+        self._queue.put((image, future, enqueued))
+        result = future.result()
+        with self._lock:
+            self._preprocess_total += enqueued - started
+            self._latencies.append((time.perf_counter() - started) * 1000.0)
+        return result
+
+    def forward(self, images):
+        """Model outputs for a list of load_image() arrays, run as one batch now."""
+        return self._forward(np.stack(images)).numpy()
+
+    def _collect_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                try:
+                    batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        started = time.perf_counter()
+        try:
+            outputs = self.forward([image for image, _, _ in batch])
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        finished = time.perf_counter()
+
+        with self._lock:
+            self._batches += 1
+            self._items += len(batch)
+            self._batch_sizes[len(batch)] += 1
+            self._run_time_total += finished - started
+            self._queue_wait_total += sum(started - enqueued for _, _, enqueued in batch)
+        for (_, future, _), output in zip(batch, outputs):
+            future.set_result(output)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000.0,
+                "warmup_ms": self.warmup_ms,
+                "batches": self._batches,
+                "items": self._items,
+                "avg_batch_size": round(self._items / self._batches, 3) if self._batches else 0.0,
+                "batch_size_histogram": {str(k): v for k, v in sorted(self._batch_sizes.items())},
+                "avg_preprocess_ms": round(self._preprocess_total / self._items * 1000.0, 3) if self._items else 0.0,
+                "avg_queue_wait_ms": round(self._queue_wait_total / self._items * 1000.0, 3) if self._items else 0.0,
+                "avg_batch_run_ms": round(self._run_time_total / self._batches * 1000.0, 3) if self._batches else 0.0,
+                # Decode to result, over the last `latency_window` requests
+                "latency_ms": _percentiles(self._latencies),
+            }
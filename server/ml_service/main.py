@@ -1,270 +1,698 @@
 import os
-import io
-import cv2
-import torch
-import numpy as np
-import base64
-from PIL import Image, ImageOps
+import json
+import time
+import asyncio
+_import_started = time.perf_counter()
+from typing import List, Optional
 from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from contextlib import asynccontextmanager
-import torch.nn as nn
-from torchvision import transforms, models
-from pytorch_grad_cam import GradCAM, GradCAMPlusPlus
-from pytorch_grad_cam.utils.model_targets import ClassifierOutputTarget
-from pytorch_grad_cam.utils.image import show_cam_on_image
-
-# Import the new model architecture
-from pneumonia_network import build_pneumonia_model, get_cam_target_layer
-
-# --- CORE LOGIC ENGINE ---
-class PneumoniaSystem:
-    def __init__(self, cls_path="best_pneumonia_model.pt", gate_path="xray_gate_efficientnet_b0.pth"):
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        print(f"Loading models on {self.device}...")
-        
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        cls_full_path = cls_path if os.path.isabs(cls_path) else os.path.join(base_dir, cls_path)
-        gate_full_path = gate_path if os.path.isabs(gate_path) else os.path.join(base_dir, gate_path)
-        
-        # =========================================================
-        # 1. LOAD GATE MODEL (EfficientNet-B0)
-        # =========================================================
-        print("Initializing X-ray Gate Model...")
-        self.gate_model = models.efficientnet_b0(weights='IMAGENET1K_V1')
-        
-        # Replace classifier for binary task: [non_xray, xray]
-        in_features = self.gate_model.classifier[1].in_features
-        self.gate_model.classifier[1] = nn.Linear(in_features, 2)
-        
-        if os.path.exists(gate_full_path):
-            try:
-                self.gate_model.load_state_dict(torch.load(gate_full_path, map_location=self.device))
-                print(f"Successfully loaded Gate Model from {gate_full_path}")
-            except Exception as e:
-                print(f"Error loading Gate Model: {e}")
-                self.gate_model = None # Disable gate if load fails
-        else:
-            print(f"Warning: Gate Model weights not found at {gate_full_path}")
-            self.gate_model = None
-        if self.gate_model:
-            self.gate_model.to(self.device).eval()
-            
-        # Gate Preprocessing: Resize to 224x224 (Standard EfficientNet)
-        self.gate_transform = transforms.Compose([
-            transforms.Resize((224, 224)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-        ])
-        
-        # =========================================================
-        # 2. BUILD PNEUMONIA CLASSIFIER (EfficientNetB0 + CBAM)
-        # =========================================================
-        print("Building EfficientNetB0 + CBAM Classifier...")
-        
-        try:
-            if os.path.exists(cls_full_path):
-                self.cls_model = build_pneumonia_model(device=self.device, weights_path=cls_full_path)
-                self.cls_model.eval()
-            else:
-                print(f"Warning: Classifier weights not found at {cls_full_path}")
-                # Build without weights just in case, but it won't predict well
-                self.cls_model = build_pneumonia_model(device=self.device, weights_path=None)
-        except Exception as e:
-            print(f"Error loading Classifier: {e}")
-            raise e
-        
-        # =========================================================
-        # TRANSFORMS (Standard ImageNet)
-        # =========================================================
-        self.cls_transform = transforms.Compose([
-            transforms.Resize((224, 224)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+
+from pneumonia_system import PneumoniaSystem
+from batching import MicroBatcher
+from inference_pool import InferencePool
+from result_cache import ResultCache
+from heatmap_jobs import HeatmapJobs
+from heatmap_formats import HeatmapOptions
+from metrics import Metrics
+from uploads import expand_uploads, open_shared_upload
+from shared_weights import DEFAULT_DIR as SHARED_DEFAULT_DIR
+from model_registry import ModelRegistry, CheckpointWatcher, Deployment
+from admission import AdmissionControl, AdmissionRejected, Lane
+from synthetic_xray import synthetic_xray
+IMPORT_MS = round((time.perf_counter() - _import_started) * 1000.0, 1)
+
+# --- FASTAPI APP ---
+# The model version in service (pool, batcher, cache), and replaced versions
+# still finishing their calls
+deployment = None
+retiring = set()
+model_registry = None
+checkpoint_watcher = None
+# Versions in the order they were activated
+model_history = []
+heatmap_jobs = None
+admission = None
+startup_timings = {"imports_ms": IMPORT_MS}
+
+# Prometheus metrics, served on /metrics
+metrics = Metrics()
+metrics.describe("request_duration_seconds", "histogram", "End-to-end /predict latency")
+metrics.describe("stage_duration_seconds", "histogram", "Per-image time spent in each inference stage (batched stages count in full per image)")
+metrics.describe("requests_total", "counter", "Requests by outcome")
+metrics.describe("batch_images_total", "counter", "Images scored through /predict/batch by status")
+metrics.describe("gate_rejections_total", "counter", "Images rejected by the X-ray gate")
+metrics.describe("cam_fallbacks_total", "counter", "Heatmaps that fell back from Grad-CAM++ (gradcam), from a batched pass to one per image (per_image) or were dropped (error)")
+metrics.describe("errors_total", "counter", "Errors by kind")
+metrics.describe("batch_queue_depth", "gauge", "Uploads waiting for a micro-batch")
+metrics.describe("batches_inflight", "gauge", "Micro-batches being processed")
+metrics.describe("batches_total", "counter", "Micro-batches dispatched")
+metrics.describe("batched_images_total", "counter", "Images dispatched in micro-batches")
+metrics.describe("worker_inflight", "gauge", "Calls running on each model replica")
+metrics.describe("worker_memory_bytes", "gauge", "Memory of each replica's process by kind (rss, pss = shared pages split between processes, shared, private)")
+metrics.describe("cache_bytes", "gauge", "Serialized size of the in-memory result cache")
+metrics.describe("cache_lookups_total", "counter", "Result cache lookups by result")
+metrics.describe("heatmap_jobs", "gauge", "Deferred heatmap jobs by status")
+metrics.describe("model_reloads_total", "counter", "Model version swaps by trigger and outcome")
+metrics.describe("admission_wait_seconds", "histogram", "Time requests waited for an inference slot, by lane")
+metrics.describe("admission_rejections_total", "counter", "Requests turned away with 429, by lane and reason")
+metrics.describe("admission_queue_depth", "gauge", "Requests waiting for an inference slot, by lane")
+metrics.describe("admission_inflight", "gauge", "Inference calls holding a slot, by lane")
+
+# Checkpoint overrides (default: the server/ml_model folder) and the gate's
+# X-ray probability threshold
+CLS_PATH = os.environ.get("ML_CLS_PATH") or None
+GATE_PATH = os.environ.get("ML_GATE_PATH") or None
+GATE_THRESHOLD = float(os.environ.get("ML_GATE_THRESHOLD", "0.9"))
+
+# Most heatmap images explained by one Grad-CAM forward/backward (0 = the whole batch)
+CAM_BATCH_SIZE = int(os.environ.get("ML_CAM_BATCH_SIZE", "2"))
+
+# Micro-batching: gather concurrent uploads for up to N images or T ms
+BATCH_MAX_SIZE = int(os.environ.get("ML_BATCH_MAX_SIZE", "16"))
+BATCH_MAX_WAIT_MS = float(os.environ.get("ML_BATCH_MAX_WAIT_MS", "5"))
+
+# Model replicas: "thread" or "process" workers, each with a pinned torch thread budget
+WORKERS = int(os.environ.get("ML_WORKERS", "1"))
+WORKER_MODE = os.environ.get("ML_WORKER_MODE", "thread")
+THREADS_PER_WORKER = int(os.environ.get("ML_THREADS_PER_WORKER", "0")) or None
+
+# Result cache: in-memory LRU (0 disables the cache) plus optional on-disk tier
+CACHE_MAX_MB = float(os.environ.get("ML_CACHE_MAX_MB", "256"))
+CACHE_DIR = os.environ.get("ML_CACHE_DIR") or None
+
+# Deferred heatmaps: /predict returns a job id, the overlay is fetched from /heatmap/{id}
+DEFER_HEATMAPS = os.environ.get("ML_DEFER_HEATMAPS", "0") == "1"
+HEATMAP_JOB_CONCURRENCY = int(os.environ.get("ML_HEATMAP_JOB_CONCURRENCY", "2"))
+HEATMAP_JOB_TTL_S = float(os.environ.get("ML_HEATMAP_JOB_TTL_S", "600"))
+HEATMAP_JOB_MAX_PENDING = int(os.environ.get("ML_HEATMAP_JOB_MAX_PENDING", "256"))
+HEATMAP_JOB_MAX_PENDING_MB = float(os.environ.get("ML_HEATMAP_JOB_MAX_PENDING_MB", "256"))
+
+# Default heatmap payload: png | jpeg | webp overlay, or cam_uint8 | cam_float16 grid
+HEATMAP_FORMAT = os.environ.get("ML_HEATMAP_FORMAT", "png")
+HEATMAP_MAX_EDGE = int(os.environ.get("ML_HEATMAP_MAX_EDGE", "0"))
+HEATMAP_QUALITY = int(os.environ.get("ML_HEATMAP_QUALITY", "90"))
+
+# /predict/batch: images per request (zip members included), size limit per
+# image and per request (uploaded, and again once extracted), and how many of
+# one request's images may wait for inference at once
+BATCH_UPLOAD_MAX_FILES = int(os.environ.get("ML_BATCH_UPLOAD_MAX_FILES", "500"))
+BATCH_UPLOAD_MAX_FILE_MB = float(os.environ.get("ML_BATCH_UPLOAD_MAX_FILE_MB", "50"))
+BATCH_UPLOAD_MAX_MB = float(os.environ.get("ML_BATCH_UPLOAD_MAX_MB", "512"))
+BATCH_UPLOAD_WINDOW = int(os.environ.get("ML_BATCH_UPLOAD_WINDOW", "0")) or 2 * BATCH_MAX_SIZE * WORKERS
+
+# Shared upload volume: /predict?image_path=<relative path> reads the image from
+# this directory (memory-mapped) instead of a multipart upload; unset disables it
+SHARED_UPLOAD_ROOT = os.environ.get("ML_SHARED_UPLOAD_ROOT") or None
+
+# Working-memory budget of one overlay render (strip height adapts to it)
+OVERLAY_MEMORY_MB = float(os.environ.get("ML_OVERLAY_MEMORY_MB", "32"))
+
+# Inference backend for the no_grad forwards: eager, torchscript, compile or onnx.
+# Checked against eager at load (max |logit diff| <= ATOL), eager on failure.
+BACKEND = os.environ.get("ML_BACKEND", "eager")
+BACKEND_CACHE_DIR = os.environ.get("ML_BACKEND_CACHE_DIR") or None
+BACKEND_PARITY_ATOL = float(os.environ.get("ML_BACKEND_PARITY_ATOL", "1e-3"))
+
+# ML_BACKEND=int8: calibration images for static quantization, and the decision
+# parity (vs fp32, on those images) required to keep it instead of falling back
+QUANT_CALIBRATION_DIR = os.environ.get("ML_QUANT_CALIBRATION_DIR") or None
+QUANT_CALIBRATION_LIMIT = int(os.environ.get("ML_QUANT_CALIBRATION_LIMIT", "64"))
+QUANT_MIN_AGREEMENT = float(os.environ.get("ML_QUANT_MIN_AGREEMENT", "0.99"))
+QUANT_MAX_DRIFT = float(os.environ.get("ML_QUANT_MAX_DRIFT", "0.05"))
+
+# Optional ready-to-run snapshot (see snapshot.py); used instead of the
+# checkpoints when it was built from them
+MODEL_SNAPSHOT_DIR = os.environ.get("ML_MODEL_SNAPSHOT_DIR") or None
+
+# Opt-in torch profiler: fraction of inference batches traced, and where the
+# Chrome traces go (default: <tmp>/pneumonia-profiles)
+PROFILE_SAMPLE_RATE = float(os.environ.get("ML_PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.environ.get("ML_PROFILE_DIR") or None
+
+# Inference build of both models: BatchNorm folded into the convs, channels_last,
+# fused CBAM (checked against the reference model at load)
+OPTIMIZE_MODELS = os.environ.get("ML_OPTIMIZE_MODELS", "0") == "1"
+
+# Share the finished models between worker processes through memory-mapped
+# files in ML_SHARED_WEIGHTS_DIR (default /dev/shm/pneumonia-weights)
+SHARED_WEIGHTS = os.environ.get("ML_SHARED_WEIGHTS", "0") == "1"
+SHARED_WEIGHTS_DIR = os.environ.get("ML_SHARED_WEIGHTS_DIR") or None
+
+# Decode JPEGs at reduced size (DCT scaling) for the 224x224 model input
+JPEG_DRAFT = os.environ.get("ML_JPEG_DRAFT", "1") == "1"
+
+# Model registry: versioned copies of the checkpoints (default: ml_model/registry,
+# newest N kept), and how often the checkpoint paths are polled for a new
+# version to hot-swap in (0 disables watching; /models/reload still works)
+MODEL_REGISTRY_DIR = os.environ.get("ML_MODEL_REGISTRY_DIR") or None
+MODEL_REGISTRY_KEEP = int(os.environ.get("ML_MODEL_REGISTRY_KEEP", "5"))
+MODEL_WATCH_INTERVAL_S = float(os.environ.get("ML_MODEL_WATCH_INTERVAL_S", "10"))
+
+# Admission control: at most N inference calls in progress (default: one full
+# micro-batch per replica), in priority lanes. "interactive" (/predict) is
+# served first; "bulk" (/predict/batch, ?lane=bulk, deferred heatmaps) gets at
+# most its own cap. A lane answers 429 + Retry-After once its queue holds
+# MAX_QUEUE requests or the estimated wait exceeds MAX_WAIT_S.
+ADMISSION = os.environ.get("ML_ADMISSION", "1") == "1"
+ADMISSION_MAX_CONCURRENCY = int(os.environ.get("ML_ADMISSION_MAX_CONCURRENCY", "0")) or BATCH_MAX_SIZE * WORKERS
+ADMISSION_INTERACTIVE_CONCURRENCY = int(os.environ.get("ML_ADMISSION_INTERACTIVE_CONCURRENCY", "0"))
+ADMISSION_INTERACTIVE_MAX_QUEUE = int(os.environ.get("ML_ADMISSION_INTERACTIVE_MAX_QUEUE", "64"))
+ADMISSION_INTERACTIVE_MAX_WAIT_S = float(os.environ.get("ML_ADMISSION_INTERACTIVE_MAX_WAIT_S", "20"))
+ADMISSION_BULK_CONCURRENCY = int(os.environ.get("ML_ADMISSION_BULK_CONCURRENCY", "0")) or max(1, ADMISSION_MAX_CONCURRENCY // 2)
+ADMISSION_BULK_MAX_QUEUE = int(os.environ.get("ML_ADMISSION_BULK_MAX_QUEUE", "256"))
+ADMISSION_BULK_MAX_WAIT_S = float(os.environ.get("ML_ADMISSION_BULK_MAX_WAIT_S", "120"))
+LANES = ("interactive", "bulk")
+
+def _system_kwargs(cls_path, gate_path):
+    return {
+        "cls_path": cls_path,
+        "gate_path": gate_path,
+        "gate_threshold": GATE_THRESHOLD,
+        "cam_batch_size": CAM_BATCH_SIZE,
+        "optimize_models": OPTIMIZE_MODELS,
+        "shared_weights_dir": (SHARED_WEIGHTS_DIR or SHARED_DEFAULT_DIR) if SHARED_WEIGHTS else None,
+        "overlay_memory_mb": OVERLAY_MEMORY_MB,
+        "jpeg_draft": JPEG_DRAFT,
+        "backend": BACKEND,
+        "backend_cache_dir": BACKEND_CACHE_DIR,
+        "backend_parity_atol": BACKEND_PARITY_ATOL,
+        "quant_calibration_dir": QUANT_CALIBRATION_DIR,
+        "quant_calibration_limit": QUANT_CALIBRATION_LIMIT,
+        "quant_min_agreement": QUANT_MIN_AGREEMENT,
+        "quant_max_drift": QUANT_MAX_DRIFT,
+        "snapshot_dir": MODEL_SNAPSHOT_DIR,
+        "profile_sample_rate": PROFILE_SAMPLE_RATE,
+        "profile_dir": PROFILE_DIR,
+    }
+
+async def _deploy(version):
+    """Loads a registered version into a new pool and warms it up (not in service yet)."""
+    cls_path, gate_path = model_registry.paths(version)
+    timings = {}
+    started = time.perf_counter()
+    pool = InferencePool(
+        PneumoniaSystem,
+        _system_kwargs(cls_path, gate_path),
+        workers=WORKERS,
+        threads_per_worker=THREADS_PER_WORKER,
+        mode=WORKER_MODE
+    )
+    try:
+        await pool.start()
+        timings["pool_start_ms"] = round((time.perf_counter() - started) * 1000.0, 1)
+
+        # Warm-up batch: the first forwards and Grad-CAM pass are slow, and a
+        # version that cannot score an image never goes into service
+        started = time.perf_counter()
+        warmup = await asyncio.gather(*[
+            pool.run("predict_batch", [synthetic_xray(512, 512, seed=n)], [HeatmapOptions()])
+            for n in range(pool.workers)
         ])
+        for results in warmup:
+            if "error" in results[0]:
+                raise RuntimeError(f"Warm-up batch failed: {results[0]['error']}")
+        timings["warmup_ms"] = round((time.perf_counter() - started) * 1000.0, 1)
+    except BaseException:
+        pool.shutdown(wait=False)
+        raise
 
-    def predict(self, image_bytes):
-        # Convert bytes to PIL Image
+    async def run_batch(items):
+        images, heatmaps = zip(*items)
+        results = await pool.run("predict_batch", list(images), list(heatmaps), telemetry=True)
+        # Stage timings and events go to /metrics, not into responses or the cache
+        for result in results:
+            metrics.observe_telemetry(result.pop("_telemetry", {}))
+        return results
+
+    batcher = MicroBatcher(
+        run_batch,
+        max_batch_size=BATCH_MAX_SIZE,
+        max_wait_ms=BATCH_MAX_WAIT_MS,
+        max_concurrent_batches=pool.workers
+    )
+    await batcher.start()
+
+    cache = None
+    if CACHE_MAX_MB > 0:
+        cache = ResultCache(
+            # The version is the weights fingerprint. Draft decoding, the backend
+            # and the optimized build shift the probabilities slightly and the
+            # gate threshold changes decisions, so they are part of the key too
+            version + (":draft" if JPEG_DRAFT else "")
+            + (":optimized" if OPTIMIZE_MODELS else "") + f":{BACKEND}:{GATE_THRESHOLD}",
+            max_bytes=int(CACHE_MAX_MB * 1024 * 1024),
+            disk_dir=CACHE_DIR
+        )
+    return Deployment(version, pool, batcher, cache, timings)
+
+# Serializes loads so two reloads never race to swap
+_swap_lock = asyncio.Lock()
+
+async def _activate(version, trigger):
+    """
+    Puts a registered version into service: it is loaded and warmed up next
+    to the live deployment, then swapped in. Calls already running finish on
+    the previous deployment, which is shut down in the background afterwards.
+    """
+    global deployment
+    async with _swap_lock:
+        if deployment and deployment.version == version:
+            return deployment
         try:
-            pil_img = Image.open(io.BytesIO(image_bytes)).convert('RGB')
-            # Fix EXIF rotation (ensures Python sees the same orientation as the browser)
-            pil_img = ImageOps.exif_transpose(pil_img)
+            new = await _deploy(version)
         except Exception:
-            return {"error": "Invalid Image Format"}
-            
-        # =========================================================
-        # STEP 1: GATE CHECK (Is this an X-ray?)
-        # =========================================================
-        xray_confidence = 0.0
-        
-        if self.gate_model:
-            gate_tensor = self.gate_transform(pil_img).unsqueeze(0).to(self.device)
-            with torch.no_grad():
-                gate_output = self.gate_model(gate_tensor)
-                gate_probs = torch.softmax(gate_output, dim=1) # [non_xray_prob, xray_prob]
-                
-                # Index 1 is "xray" based on user description
-                xray_prob = gate_probs[0][1].item()
-                
-                xray_confidence = xray_prob
-                
-                # Threshold check
-                if xray_prob < 0.9:
-                    print(f"Gate Rejection: Not an X-ray (Confidence: {xray_prob:.4f})")
-                    return {
-                        "is_xray": False,
-                        "xray_confidence": round(xray_prob, 4),
-                        "message": "This image is not a chest X-ray. Please upload a chest X-ray image."
-                    }
-                else:
-                    print(f"Gate Passed: Is X-ray (Confidence: {xray_prob:.4f})")
-                    
-        # =========================================================
-        # STEP 2: CLASSIFY (EfficientNetB0 - Single Logit)
-        # =========================================================
-        tensor = self.cls_transform(pil_img).unsqueeze(0).to(self.device)
-        
-        with torch.no_grad():
-            output = self.cls_model(tensor)
-            # Sigmoid for binary output
-            pneumonia_prob = torch.sigmoid(output).item()
-        
-        # Threshold 0.5
-        if pneumonia_prob >= 0.5:
-            classification = "Pneumonia"
-            class_confidence = pneumonia_prob
-        else:
-            classification = "Normal"
-            class_confidence = 1.0 - pneumonia_prob
-        
-        # =========================================================
-        # STEP 3: GRAD-CAM (Heatmap)
-        # =========================================================
-        heatmap_base64 = None
-        try:
-            # =========================================================
-            # Target Layer
-            # =========================================================
-            target_layers = [get_cam_target_layer(self.cls_model)]
-            
-            # For Binary Classifier (Single Output):
-            # The output is a single logit. High value = Pneumonia. Low value = Normal.
-            # We want to visualize what parts contribute to the output.
-            # ClassifierOutputTarget(0) targets the 0-th index (the only one).
-            
-            if classification == "Pneumonia":
-                print("Explaining PNEUMONIA prediction (GradCAM++ in progress...)")
-            else:
-                print("Explaining NORMAL prediction (GradCAM++ in progress...)")
-                
-            targets = [ClassifierOutputTarget(0)]
-                
-            # Robust CAM Generation with Fallback
-            tensor.requires_grad = True
-            try:
-                cam_algo = GradCAMPlusPlus(model=self.cls_model, target_layers=target_layers)
-                grayscale_cam = cam_algo(input_tensor=tensor, targets=targets)[0, :]
-                print("GradCAM++ Success")
-            except Exception as e_plus:
-                print(f"GradCAM++ Failed ({e_plus}), falling back to standard GradCAM")
-                cam_algo = GradCAM(model=self.cls_model, target_layers=target_layers)
-                grayscale_cam = cam_algo(input_tensor=tensor, targets=targets)[0, :]
-                print("GradCAM Fallback Success")
-                
-            # =========================================================
-            # POST-CAM PROCESSING
-            # =========================================================
-            # Base image: float32 [0, 1], RGB (required by show_cam_on_image)
-            orig_np = np.array(pil_img).astype(np.float32) / 255.0
-            h, w = orig_np.shape[:2]
-            if len(orig_np.shape) == 2:
-                orig_np = np.stack([orig_np, orig_np, orig_np], axis=-1)
-            
-            # Resize CAM to image size
-            cam_resized = cv2.resize(grayscale_cam, (w, h), interpolation=cv2.INTER_CUBIC)
-            
-            # Normalize to [0, 1]
-            cam_min, cam_max = cam_resized.min(), cam_resized.max()
-            if cam_max > cam_min:
-                cam_normalized = (cam_resized - cam_min) / (cam_max - cam_min)
-            else:
-                cam_normalized = np.zeros_like(cam_resized).astype(np.float32)
-            
-            # Overlay
-            overlay_rgb = show_cam_on_image(
-                orig_np, cam_normalized,
-                use_rgb=True,
-                colormap=cv2.COLORMAP_JET,
-                image_weight=0.5
-            )
-            
-            overlay_bgr = cv2.cvtColor(overlay_rgb, cv2.COLOR_RGB2BGR)
-            success, buffer = cv2.imencode('.png', overlay_bgr)
-            if success:
-                heatmap_base64 = base64.b64encode(buffer).decode('utf-8')
-            
-        except Exception as cam_err:
-            print(f"Grad-CAM CRASHED: {cam_err}")
-            import traceback
-            traceback.print_exc()
-            
-        print(f"Analysis Complete: Class={classification} ({class_confidence:.2%})")
-        return {
-            "is_xray": True,
-            "xray_confidence": round(xray_confidence, 4),
-            "classification": classification,
-            "class_confidence": round(class_confidence, 4),
-            "image_width": pil_img.width,
-            "image_height": pil_img.height,
-            "heatmap": heatmap_base64
-        }
+            metrics.inc("model_reloads_total", trigger=trigger, outcome="failed")
+            # A version that never served is not kept as a rollback target
+            if version not in model_history:
+                model_registry.remove(version)
+            raise
+        previous, deployment = deployment, new
+        new.activated_at = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+        model_history.append(version)
+        metrics.inc("model_reloads_total", trigger=trigger, outcome="ok")
+        print(f"Serving model version {version}" + (f" (replacing {previous.version})" if previous else ""))
 
-# --- FASTAPI APP ---
-ml_system = None
+        if previous:
+            retiring.add(previous)
+            task = asyncio.create_task(previous.retire())
+            task.add_done_callback(lambda _: retiring.discard(previous))
+        model_registry.prune(protect={new.version, *(d.version for d in retiring)})
+    return new
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    global ml_system
+def _checkpoint_paths():
     base_dir = os.path.dirname(os.path.abspath(__file__))
     
     # Path to models in the server/ml_model folder
     # NOTE: Changed to .pt extension to match new model file
-    cls_path = os.path.join(base_dir, "..", "ml_model", "classifier", "best_pneumonia_model.pt")
+    cls_path = CLS_PATH or os.path.join(base_dir, "..", "ml_model", "classifier", "best_pneumonia_model.pt")
     
     # Gate model assumed path
-    gate_path = os.path.join(base_dir, "..", "ml_model", "gate", "xray_gate_efficientnet_b0.pth")
-    
-    ml_system = PneumoniaSystem(
-        cls_path=cls_path, 
-        gate_path=gate_path
+    gate_path = GATE_PATH or os.path.join(base_dir, "..", "ml_model", "gate", "xray_gate_efficientnet_b0.pth")
+    return cls_path, gate_path
+
+async def _reload_from_checkpoints(trigger):
+    # Registering copies (and hashes) the checkpoints, off the event loop
+    version = await asyncio.to_thread(model_registry.register, *_checkpoint_paths())
+    return await _activate(version, trigger)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global deployment, model_registry, checkpoint_watcher, heatmap_jobs, admission
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    model_registry = ModelRegistry(
+        MODEL_REGISTRY_DIR or os.path.join(base_dir, "..", "ml_model", "registry"),
+        keep=MODEL_REGISTRY_KEEP
+    )
+
+    await _reload_from_checkpoints("startup")
+    startup_timings.update(deployment.timings)
+
+    if ADMISSION:
+        admission = AdmissionControl([
+            Lane("interactive", ADMISSION_INTERACTIVE_CONCURRENCY, ADMISSION_INTERACTIVE_MAX_QUEUE, ADMISSION_INTERACTIVE_MAX_WAIT_S),
+            Lane("bulk", ADMISSION_BULK_CONCURRENCY, ADMISSION_BULK_MAX_QUEUE, ADMISSION_BULK_MAX_WAIT_S),
+        ], max_concurrency=ADMISSION_MAX_CONCURRENCY)
+
+    if MODEL_WATCH_INTERVAL_S > 0:
+        checkpoint_watcher = CheckpointWatcher(
+            _checkpoint_paths(),
+            lambda: _reload_from_checkpoints("watcher"),
+            interval_s=MODEL_WATCH_INTERVAL_S
+        )
+        checkpoint_watcher.start()
+
+    heatmap_jobs = HeatmapJobs(
+        _compute_heatmap,
+        max_concurrency=HEATMAP_JOB_CONCURRENCY,
+        ttl_seconds=HEATMAP_JOB_TTL_S,
+        max_pending=HEATMAP_JOB_MAX_PENDING,
+        max_pending_mb=HEATMAP_JOB_MAX_PENDING_MB
     )
     yield
-    ml_system = None
+    if checkpoint_watcher:
+        await checkpoint_watcher.stop()
+        checkpoint_watcher = None
+    await heatmap_jobs.stop()
+    heatmap_jobs = None
+    admission = None
+    # Under the lock, so a reload still loading finishes before shutting down
+    async with _swap_lock:
+        current, deployment = deployment, None
+    await asyncio.gather(current.retire(), *[d.retire() for d in list(retiring)])
+    model_history.clear()
+
+async def _classify(contents, heatmap, lane="interactive", reject=True):
+    """
+    Scores one image in admission `lane` (see admission.py); raises
+    AdmissionRejected with `reject` when the lane is over its limits.
+    Cached results skip the queue; a caller coalesced onto another one's
+    computation reports the time it waited for that result.
+    """
+    item = (contents, heatmap)
+    arrived = time.perf_counter()
+    waited = {"computed": False, "queue_wait_ms": 0.0}
+
+    async def compute():
+        waited["computed"] = True
+        if not admission:
+            return await live.batcher.submit(item)
+        try:
+            async with admission.slot(lane, "heatmap" if heatmap else "classify", reject) as ticket:
+                waited.update(ticket)
+                metrics.observe("admission_wait_seconds", ticket["queue_wait_ms"] / 1000.0, lane=lane)
+                return await live.batcher.submit(item)
+        except AdmissionRejected as e:
+            metrics.inc("admission_rejections_total", lane=lane, reason=e.reason)
+            raise
+
+    # The whole call stays on the deployment it started on, even if a new
+    # model version is swapped in meanwhile
+    with deployment.using() as live:
+        if live.cache:
+            key = live.cache.key_for(contents, variant=heatmap.cache_token() if heatmap else "classify")
+            try:
+                result = await live.cache.get_or_compute(key, compute)
+            except AdmissionRejected:
+                if waited["computed"]:
+                    raise
+                # Coalesced onto a call its own lane turned away: this
+                # caller's lane decides for it
+                result = await compute()
+        else:
+            result = await compute()
+    result["model_version"] = live.version
+    if waited["computed"]:
+        result["queue_wait_ms"] = waited["queue_wait_ms"]
+    else:
+        # Served from the cache, or by a computation another caller started
+        result["queue_wait_ms"] = round((time.perf_counter() - arrived) * 1000.0, 3)
+    return result
+
+async def _compute_heatmap(contents, heatmap):
+    # Deferred overlays queue behind interactive uploads but are never rejected
+    result = await _classify(contents, heatmap, lane="bulk", reject=False)
+    return {k: v for k, v in result.items() if k.startswith("heatmap") or k == "model_version"}
 
 app = FastAPI(title="Pneumonia Detection API", lifespan=lifespan)
 
+def _open_shared(image_path):
+    if not SHARED_UPLOAD_ROOT:
+        raise HTTPException(status_code=400, detail="image_path ingestion is disabled (ML_SHARED_UPLOAD_ROOT is not set)")
+    try:
+        return open_shared_upload(SHARED_UPLOAD_ROOT, image_path)
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Image file not found")
+    except (ValueError, OSError) as e:
+        raise HTTPException(status_code=400, detail=f"Cannot read image_path: {getattr(e, 'strerror', None) or e}")
+
 @app.post("/predict")
-async def predict(file: UploadFile = File(...)):
-    if not ml_system:
+async def predict(
+    file: Optional[UploadFile] = File(None),
+    image_path: Optional[str] = None,
+    explain: bool = True,
+    defer_heatmap: bool = DEFER_HEATMAPS,
+    heatmap_format: str = HEATMAP_FORMAT,
+    heatmap_max_edge: int = HEATMAP_MAX_EDGE,
+    heatmap_quality: int = HEATMAP_QUALITY,
+    lane: str = "interactive"
+):
+    if not deployment:
         raise HTTPException(status_code=503, detail="ML System not initialized")
+    if lane not in LANES:
+        raise HTTPException(status_code=400, detail=f"Unknown lane {lane!r}, expected one of {', '.join(LANES)}")
+
+    heatmap = None
+    if explain:
+        try:
+            heatmap = HeatmapOptions(heatmap_format, heatmap_max_edge, heatmap_quality)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
     
-    contents = await file.read()
+    shared = None
+    if image_path is not None:
+        if file is not None:
+            raise HTTPException(status_code=400, detail="Send either a file or image_path, not both")
+        shared = _open_shared(image_path)
+        # Process workers get a copy: an mmap cannot be sent to them
+        contents = shared if WORKER_MODE == "thread" else shared[:]
+    elif file is not None:
+        contents = await file.read()
+    else:
+        raise HTTPException(status_code=400, detail="No file or image_path provided")
     
+    started = time.perf_counter()
+    outcome = "error"
     try:
-        result = ml_system.predict(contents)
+        result = await _classify(contents, None if defer_heatmap else heatmap, lane)
         if "error" in result:
+             outcome = "invalid_image"
              raise HTTPException(status_code=400, detail=result["error"])
         
         # Check if rejected by gate
         if result.get("is_xray") is False:
+             outcome = "gate_rejected"
              return result
+
+        if heatmap and defer_heatmap:
+            # The job outlives the request (and the mmap)
+            result["heatmap_job"] = heatmap_jobs.submit(shared[:] if shared else contents, heatmap)
+        outcome = "ok"
         return result
+    except AdmissionRejected as e:
+        outcome = "rejected"
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after_s)})
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Prediction error: {e}")
+        if outcome == "error":
+            metrics.inc("errors_total", kind="predict")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        # `shared` is not closed here: the mapping goes away with its last
+        # reference, since a cached computation can outlive this request
+        metrics.observe("request_duration_seconds", time.perf_counter() - started, endpoint="/predict")
+        metrics.inc("requests_total", endpoint="/predict", outcome=outcome)
+
+async def _score_upload(index, filename, contents, error, heatmap, defer_heatmap, window, lane):
+    """One /predict/batch image as an NDJSON record; never raises."""
+    record = {"index": index, "filename": filename}
+    if error:
+        return {**record, "status": "invalid_image", "error": error}
+
+    async with window:
+        try:
+            # Admitted as a whole: the images wait for slots instead of failing
+            result = await _classify(contents, None if defer_heatmap else heatmap, lane, reject=False)
+        except Exception as e:
+            print(f"Prediction error ({filename}): {e}")
+            metrics.inc("errors_total", kind="predict_batch")
+            return {**record, "status": "error", "error": str(e)}
+
+    if "error" in result:
+        status = "invalid_image"
+    elif result.get("is_xray") is False:
+        status = "gate_rejected"
+    else:
+        status = "ok"
+        if heatmap and defer_heatmap:
+            result = {**result, "heatmap_job": heatmap_jobs.submit(contents, heatmap)}
+    return {**record, "status": status, **result}
+
+async def _stream_batch(images, heatmap, defer_heatmap, lane):
+    started = time.perf_counter()
+    outcome = "disconnected"
+    # All images are queued at once so the micro-batcher can fill its batches;
+    # the window keeps one large upload from flooding the queue
+    window = asyncio.Semaphore(BATCH_UPLOAD_WINDOW)
+    tasks = [
+        asyncio.ensure_future(_score_upload(i, filename, contents, error, heatmap, defer_heatmap, window, lane))
+        for i, (filename, contents, error) in enumerate(images)
+    ]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            record = await finished
+            metrics.inc("batch_images_total", status=record["status"])
+            yield json.dumps(record) + "\n"
+        outcome = "ok"
+    finally:
+        # Client went away: drop the images that are still queued
+        for task in tasks:
+            task.cancel()
+        metrics.observe("request_duration_seconds", time.perf_counter() - started, endpoint="/predict/batch")
+        metrics.inc("requests_total", endpoint="/predict/batch", outcome=outcome)
+
+@app.post("/predict/batch")
+async def predict_batch(
+    files: List[UploadFile] = File(...),
+    explain: bool = True,
+    defer_heatmap: bool = DEFER_HEATMAPS,
+    heatmap_format: str = HEATMAP_FORMAT,
+    heatmap_max_edge: int = HEATMAP_MAX_EDGE,
+    heatmap_quality: int = HEATMAP_QUALITY,
+    lane: str = "bulk"
+):
+    """
+    Scores many images (several `files`, or zip archives of images) in one
+    request. Results stream back as NDJSON, one line per image in completion
+    order, each carrying the image's `index` in the upload.
+    """
+    if not deployment:
+        raise HTTPException(status_code=503, detail="ML System not initialized")
+    if lane not in LANES:
+        raise HTTPException(status_code=400, detail=f"Unknown lane {lane!r}, expected one of {', '.join(LANES)}")
+
+    heatmap = None
+    if explain:
+        try:
+            heatmap = HeatmapOptions(heatmap_format, heatmap_max_edge, heatmap_quality)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    max_bytes = int(BATCH_UPLOAD_MAX_MB * 1024 * 1024)
+    uploads = []
+    remaining = max_bytes
+    for file in files:
+        # Never more than the request's budget (+1 byte to notice the excess) in memory
+        contents = await file.read(remaining + 1)
+        remaining -= len(contents)
+        if remaining < 0:
+            raise HTTPException(status_code=413, detail=f"Upload exceeds {BATCH_UPLOAD_MAX_MB:g} MB (ML_BATCH_UPLOAD_MAX_MB)")
+        uploads.append((file.filename, contents))
+    try:
+        images = expand_uploads(uploads, BATCH_UPLOAD_MAX_FILES, int(BATCH_UPLOAD_MAX_FILE_MB * 1024 * 1024), max_bytes)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    del uploads
+    if not images:
+        raise HTTPException(status_code=400, detail="No images in the upload")
+
+    if admission:
+        try:
+            admission.check(lane, "heatmap" if heatmap and not defer_heatmap else "classify")
+        except AdmissionRejected as e:
+            metrics.inc("admission_rejections_total", lane=lane, reason=e.reason)
+            metrics.inc("requests_total", endpoint="/predict/batch", outcome="rejected")
+            raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after_s)})
+
+    return StreamingResponse(_stream_batch(images, heatmap, defer_heatmap, lane), media_type="application/x-ndjson")
+
+@app.get("/heatmap/{job_id}")
+def get_heatmap(job_id: str):
+    job = heatmap_jobs.get(job_id) if heatmap_jobs else None
+    if job is None:
+        raise HTTPException(status_code=404, detail="Heatmap job not found or expired")
+    return job
 
 @app.get("/health")
 def health():
-    return {"status": "healthy", "models": ["EfficientNet-B0 (Gate)", "EfficientNetB0+CBAM"]}
+    # Backend actually serving each model (replicas are built identically)
+    replicas = deployment.pool.stats(memory=False)["replicas"] if deployment else []
+    backend = replicas[0]["backend"] if replicas else None
+    return {
+        "status": "healthy",
+        "models": ["EfficientNet-B0 (Gate)", "EfficientNetB0+CBAM"],
+        "backend": backend,
+        "model_version": deployment.version if deployment else None
+    }
+
+# --- MODEL VERSIONS ---
+@app.get("/models")
+def list_models():
+    return {
+        "active": deployment.info() if deployment else None,
+        # Replaced versions still finishing their calls
+        "draining": [d.info() for d in retiring],
+        "history": model_history,
+        "registry": model_registry.versions() if model_registry else [],
+        "watch_interval_s": MODEL_WATCH_INTERVAL_S if checkpoint_watcher else None,
+    }
+
+@app.post("/models/reload")
+async def reload_models():
+    """
+    Registers the checkpoints currently at the model paths and swaps them in
+    if they are a new version (what the watcher does on a change).
+    """
+    if not deployment:
+        raise HTTPException(status_code=503, detail="ML System not initialized")
+    try:
+        live = await _reload_from_checkpoints("reload")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Model reload failed, still serving {deployment.version}: {e}")
+    return live.info()
+
+@app.post("/models/rollback")
+async def rollback_models(version: Optional[str] = None):
+    """
+    Swaps a registered `version` back in; by default the version served
+    before the current one. The watcher only reacts to the checkpoint files
+    changing again, so a rollback sticks until the next deploy.
+    """
+    if not deployment:
+        raise HTTPException(status_code=503, detail="ML System not initialized")
+    if version is None:
+        previous = [v for v in model_history if v != deployment.version]
+        if not previous:
+            raise HTTPException(status_code=409, detail="No previous model version to roll back to")
+        version = previous[-1]
+    if version not in model_registry:
+        raise HTTPException(status_code=404, detail=f"Model version {version} is not in the registry")
+    try:
+        live = await _activate(version, "rollback")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Rollback failed, still serving {deployment.version}: {e}")
+    return live.info()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    gauges, counters = {}, {}
+    if deployment:
+        batching = deployment.batcher.stats()
+        gauges["batch_queue_depth"] = batching["queue_depth"]
+        gauges["batches_inflight"] = batching["inflight_batches"]
+        counters["batches_total"] = batching["batches"]
+        counters["batched_images_total"] = batching["items"]
+        replicas = deployment.pool.stats()["replicas"]
+        gauges["worker_inflight"] = [({"worker": str(n)}, r["inflight"]) for n, r in enumerate(replicas)]
+        gauges["worker_memory_bytes"] = [
+            ({"worker": str(n), "kind": kind}, value)
+            for n, r in enumerate(replicas) if r["memory"]
+            for kind, value in r["memory"].items()
+        ]
+    if deployment and deployment.cache:
+        cache = deployment.cache.stats()
+        gauges["cache_bytes"] = cache["bytes"]
+        counters["cache_lookups_total"] = [
+            ({"result": "memory_hit"}, cache["memory_hits"]),
+            ({"result": "disk_hit"}, cache["disk_hits"]),
+            ({"result": "coalesced"}, cache["coalesced"]),
+            ({"result": "miss"}, cache["misses"]),
+        ]
+    if admission:
+        lanes = admission.stats()["lanes"]
+        gauges["admission_queue_depth"] = [({"lane": name}, lane["queue_depth"]) for name, lane in lanes.items()]
+        gauges["admission_inflight"] = [({"lane": name}, lane["inflight"]) for name, lane in lanes.items()]
+    if heatmap_jobs:
+        jobs = heatmap_jobs.stats()
+        gauges["heatmap_jobs"] = [({"status": "pending"}, jobs["pending"]), ({"status": "running"}, jobs["running"])]
+    return PlainTextResponse(metrics.render(gauges, counters), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats")
+def stats():
+    return {
+        "model": deployment.info() if deployment else None,
+        "batching": deployment.batcher.stats() if deployment else None,
+        "workers": deployment.pool.stats() if deployment else None,
+        "cache": deployment.cache.stats() if deployment and deployment.cache else None,
+        "heatmap_jobs": heatmap_jobs.stats() if heatmap_jobs else None,
+        "admission": admission.stats() if admission else None,
+        # Per-replica phases are under workers.replicas[].startup_ms
+        "startup": startup_timings
+    }
 
 if __name__ == "__main__":
     import uvicorn
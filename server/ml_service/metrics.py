@@ -0,0 +1,197 @@
+import os
+import time
+import random
+import tempfile
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+# Latency buckets in seconds, from sub-millisecond decodes to multi-second CAMs
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# --- PER-STAGE TIMING (inference side) ---
+class StageTimer:
+    """
+    Accumulates wall time per named stage, in milliseconds.
+
+    Every stage is also a torch.profiler.record_function range, so sampled
+    profiler traces show the same stage names.
+    """
+
+    def __init__(self):
+        self.timings = {}
+
+    def stage(self, name):
+        return shared_stage(name, [self])
+
+    def add(self, name, ms):
+        self.timings[name] = self.timings.get(name, 0.0) + ms
+
+
+@contextmanager
+def shared_stage(name, timers):
+    """Time one stage (e.g. a batched forward) and charge it to every timer."""
+    started = time.perf_counter()
+    try:
+        with torch.profiler.record_function(name):
+            yield
+    finally:
+        elapsed = (time.perf_counter() - started) * 1000.0
+        for timer in timers:
+            timer.add(name, elapsed)
+
+
+def _no_stage(name):
+    return nullcontext()
+
+
+def stage_of(timer):
+    """`timer.stage`, or a no-op stage context when `timer` is None."""
+    return timer.stage if timer else _no_stage
+
+
+class SampledProfiler:
+    """
+    Captures a torch profiler trace for a random `sample_rate` fraction of
+    calls and writes it to `out_dir` as a Chrome trace (chrome://tracing,
+    Perfetto). `sample_rate=0` disables it at no cost.
+    """
+
+    def __init__(self, sample_rate=0.0, out_dir=None):
+        self.sample_rate = float(sample_rate)
+        self.out_dir = out_dir or os.path.join(tempfile.gettempdir(), "pneumonia-profiles")
+        self.captured = 0
+
+    def maybe_profile(self, label="predict_batch"):
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return nullcontext()
+        return self._profile(label)
+
+    @contextmanager
+    def _profile(self, label):
+        from torch.profiler import profile, ProfilerActivity
+
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        with profile(activities=activities, record_shapes=True) as prof:
+            yield
+        try:
+            os.makedirs(self.out_dir, exist_ok=True)
+            path = os.path.join(self.out_dir, f"{label}-{int(time.time() * 1000)}-{os.getpid()}.json")
+            prof.export_chrome_trace(path)
+            self.captured += 1
+            print(f"Profiler trace written to {path}")
+        except Exception as e:
+            print(f"Could not write profiler trace: {e}")
+
+
+# --- PROMETHEUS METRICS (API side) ---
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Metrics:
+    """
+    In-process registry rendered in the Prometheus text exposition format.
+
+    Histograms and counters are keyed by (name, labels). Everything is
+    updated from the event loop, so no locking is needed. Values owned by
+    other components (queue depth, cache hits, ...) are passed to render()
+    as gauges/counters read at scrape time.
+    """
+
+    def __init__(self, namespace="pneumonia"):
+        self.namespace = namespace
+        self._help = {}
+        self._histograms = {}
+        self._counters = {}
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe_telemetry(self, telemetry):
+        """Record the "_telemetry" of one PneumoniaSystem result."""
+        for stage, ms in telemetry.get("timings_ms", {}).items():
+            self.observe("stage_duration_seconds", ms / 1000.0, stage=stage)
+        for event in telemetry.get("events", ()):
+            if event == "gate_rejection":
+                self.inc("gate_rejections_total")
+            elif event.startswith("cam_fallback:"):
+                self.inc("cam_fallbacks_total", reason=event.split(":", 1)[1])
+            elif event.startswith("error:"):
+                self.inc("errors_total", kind=event.split(":", 1)[1])
+
+    def render(self, gauges=None, counters=None):
+        """
+        Text exposition of every metric. `gauges` / `counters` map a metric
+        name to a value, or to a list of (labels dict, value).
+        """
+        lines = []
+        seen = set()
+
+        def header(name, kind):
+            if name in seen:
+                return
+            seen.add(name)
+            full = f"{self.namespace}_{name}"
+            text = self._help.get(name, (kind, name))[1]
+            lines.append(f"# HELP {full} {text}")
+            lines.append(f"# TYPE {full} {kind}")
+
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            header(name, "histogram")
+            full = f"{self.namespace}_{name}"
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append(f"{full}_bucket{_labels(labels + (('le', _number(bound)),))} {count}")
+            lines.append(f"{full}_bucket{_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+            lines.append(f"{full}_sum{_labels(labels)} {_number(histogram.sum)}")
+            lines.append(f"{full}_count{_labels(labels)} {histogram.count}")
+
+        for (name, labels), value in sorted(self._counters.items()):
+            header(name, "counter")
+            lines.append(f"{self.namespace}_{name}{_labels(labels)} {_number(value)}")
+
+        for kind, values in (("gauge", gauges or {}), ("counter", counters or {})):
+            for name, value in values.items():
+                header(name, kind)
+                samples = value if isinstance(value, list) else [({}, value)]
+                for labels, sample in samples:
+                    lines.append(f"{self.namespace}_{name}{_labels(tuple(sorted(labels.items())))} {_number(sample)}")
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,220 @@
+"""
+Versioned checkpoints and live model swaps for the FastAPI service.
+
+Every checkpoint pair (classifier + gate) the service loads is first copied
+into the registry directory as `<root>/<version>/`, the version being the
+weights fingerprint of the pair. Models are only ever loaded from these
+copies: overwriting a checkpoint in place never reaches a running model (they
+are memory-mapped), and any kept version can be loaded again for a rollback.
+
+A Deployment is one version in service (replica pool, micro-batcher, result
+cache). A new version is loaded and warmed up next to the live one, swapped
+in, and the old deployment is shut down once its last call finished.
+"""
+import os
+import re
+import json
+import time
+import shutil
+import asyncio
+import tempfile
+from contextlib import contextmanager
+
+from result_cache import weights_fingerprint
+
+VERSION_PATTERN = re.compile(r"[0-9a-f]{16}")
+
+
+# --- VERSIONED CHECKPOINTS ---
+class ModelRegistry:
+    """Immutable copies of the checkpoint pairs, keeping the `keep` newest versions."""
+
+    def __init__(self, root, keep=5):
+        self.root = root
+        self.keep = max(1, int(keep))
+        os.makedirs(root, exist_ok=True)
+
+    def register(self, cls_path, gate_path):
+        """Copy a checkpoint pair into the registry (if new) and return its version."""
+        staging = tempfile.mkdtemp(prefix=".staging-", dir=self.root)
+        try:
+            copies = []
+            for path in (cls_path, gate_path):
+                copy = os.path.join(staging, os.path.basename(path))
+                # A missing checkpoint stays missing (the system builds without it)
+                if os.path.exists(path):
+                    shutil.copyfile(path, copy)
+                copies.append(copy)
+            # Hash the copies, not the sources: those may change meanwhile
+            version = weights_fingerprint(copies)
+            target = os.path.join(self.root, version)
+            if not os.path.isdir(target):
+                # Registration order: "registered_at" only has second resolution
+                # and follows the clock's timezone, so it cannot order versions
+                sequence = 1 + max((m.get("sequence", 0) for m in self.versions()), default=0)
+                with open(os.path.join(staging, "manifest.json"), "w") as f:
+                    json.dump({
+                        "version": version,
+                        "classifier": os.path.basename(cls_path),
+                        "gate": os.path.basename(gate_path),
+                        "sources": [os.path.abspath(cls_path), os.path.abspath(gate_path)],
+                        "registered_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                        "sequence": sequence,
+                        "registered_ns": time.time_ns(),
+                    }, f, indent=2)
+                os.rename(staging, target)
+                staging = None
+                print(f"Registered model version {version}")
+            return version
+        finally:
+            if staging:
+                shutil.rmtree(staging, ignore_errors=True)
+
+    def _manifest(self, version):
+        if not VERSION_PATTERN.fullmatch(version or ""):
+            raise KeyError(version)
+        try:
+            with open(os.path.join(self.root, version, "manifest.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            raise KeyError(version)
+
+    def paths(self, version):
+        """(classifier, gate) checkpoint paths of `version`; KeyError if unknown."""
+        manifest = self._manifest(version)
+        directory = os.path.join(self.root, version)
+        return os.path.join(directory, manifest["classifier"]), os.path.join(directory, manifest["gate"])
+
+    def __contains__(self, version):
+        try:
+            self._manifest(version)
+            return True
+        except KeyError:
+            return False
+
+    def versions(self):
+        """Manifests of the registered versions, oldest first."""
+        manifests = []
+        for name in os.listdir(self.root):
+            try:
+                manifests.append(self._manifest(name))
+            except KeyError:
+                continue
+        # Manifests from before "sequence" existed sort first, by time
+        return sorted(manifests, key=lambda m: (m.get("sequence", 0), m.get("registered_ns", 0), m["registered_at"]))
+
+    def remove(self, version):
+        if version in self:
+            shutil.rmtree(os.path.join(self.root, version), ignore_errors=True)
+
+    def prune(self, protect=()):
+        """Delete all but the `keep` newest versions, never those in `protect`."""
+        versions = [m["version"] for m in self.versions()]
+        for version in versions[:-self.keep]:
+            if version not in protect:
+                shutil.rmtree(os.path.join(self.root, version), ignore_errors=True)
+
+
+# --- CHECKPOINT WATCHER ---
+def file_signature(paths):
+    signature = []
+    for path in paths:
+        try:
+            info = os.stat(path)
+            signature.append((info.st_size, info.st_mtime_ns))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+
+class CheckpointWatcher:
+    """
+    Polls checkpoint files every `interval_s` seconds and awaits `on_change()`
+    once they changed and then stayed unchanged for one more poll, so a copy
+    still in progress is not picked up half-written. A failed reload is not
+    retried until the files change again.
+    """
+
+    def __init__(self, paths, on_change, interval_s=10.0):
+        self.paths = list(paths)
+        self.on_change = on_change
+        self.interval_s = float(interval_s)
+        self._seen = None
+        self._task = None
+
+    def start(self):
+        self._seen = file_signature(self.paths)
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _watch(self):
+        pending = None
+        while True:
+            await asyncio.sleep(self.interval_s)
+            signature = file_signature(self.paths)
+            if signature == self._seen:
+                pending = None
+                continue
+            if signature != pending:
+                # Changed since the last poll: wait for it to settle
+                pending = signature
+                continue
+            self._seen, pending = signature, None
+            print(f"Checkpoints changed: {', '.join(self.paths)}")
+            try:
+                await self.on_change()
+            except Exception as e:
+                print(f"Model reload failed, keeping the current version: {e}")
+
+
+# --- LIVE DEPLOYMENTS ---
+class Deployment:
+    """
+    One model version in service: its InferencePool, MicroBatcher and
+    (optional) ResultCache. Calls hold it with `using()` so that, once
+    replaced, `retire()` only shuts it down after its last call finished.
+    """
+
+    def __init__(self, version, pool, batcher, cache=None, timings=None):
+        self.version = version
+        self.pool = pool
+        self.batcher = batcher
+        self.cache = cache
+        self.timings = timings or {}
+        self.activated_at = None
+        self._calls = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @contextmanager
+    def using(self):
+        self._calls += 1
+        self._idle.clear()
+        try:
+            yield self
+        finally:
+            self._calls -= 1
+            if not self._calls:
+                self._idle.set()
+
+    async def retire(self):
+        await self._idle.wait()
+        await self.batcher.stop()
+        await asyncio.to_thread(self.pool.shutdown)
+        print(f"Model version {self.version} shut down")
+
+    def info(self):
+        return {
+            "version": self.version,
+            "activated_at": self.activated_at,
+            "calls_inflight": self._calls,
+            "load_ms": self.timings,
+        }
@@ -1,8 +1,10 @@
 from flask import Flask, request, jsonify
 from tensorflow import keras
 import numpy as np
-from PIL import Image
 import os
+import threading
+
+from keras_serving import KerasBatchPredictor
 
 app = Flask(__name__)
 
@@ -11,32 +13,43 @@ app = Flask(__name__)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 MODEL_PATH = os.path.join(BASE_DIR, 'ml_model', 'chest_xray_pneumonia_final.keras')
 model = None
+predictor = None
+_load_lock = threading.Lock()
+
+# Concurrent requests are batched: up to N images, or T ms after the first one
+BATCH_MAX_SIZE = int(os.environ.get("ML_KERAS_BATCH_MAX_SIZE", "16"))
+BATCH_MAX_WAIT_MS = float(os.environ.get("ML_KERAS_BATCH_MAX_WAIT_MS", "5"))
 
 # Class order - CRITICAL
 CLASS_NAMES = ['Normal', 'Not_Xray', 'Pneumonia']
 CONFIDENCE_THRESHOLD = 0.70
 
 def load_model():
-    """Load the Keras model"""
-    global model
-    if model is None:
-        print("Starting ML Service...")
-        print(f"Model path: {MODEL_PATH}")
-        print(f"Model file exists: {os.path.exists(MODEL_PATH)}")
-        
-        try:
-            print("Loading model...")
-            # Load model with compile=False for TensorFlow 2.15
-            import tensorflow as tf
-            model = tf.keras.models.load_model(MODEL_PATH, compile=False)
-            print("Model loaded successfully!")
-            print(f"Model input shape: {model.input_shape}")
-            print(f"Model output shape: {model.output_shape}")
-        except Exception as e:
-            print(f"Error loading model: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            raise
+    """Load the Keras model and its batched predictor"""
+    global model, predictor
+    # Request threads may race to the first load
+    with _load_lock:
+        if model is None:
+            print("Starting ML Service...")
+            print(f"Model path: {MODEL_PATH}")
+            print(f"Model file exists: {os.path.exists(MODEL_PATH)}")
+            
+            try:
+                print("Loading model...")
+                # Load model with compile=False for TensorFlow 2.15
+                import tensorflow as tf
+                loaded = tf.keras.models.load_model(MODEL_PATH, compile=False)
+                print("Model loaded successfully!")
+                print(f"Model input shape: {loaded.input_shape}")
+                print(f"Model output shape: {loaded.output_shape}")
+                predictor = KerasBatchPredictor(loaded, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS)
+                print(f"Batched predictor ready (graph traced in {predictor.warmup_ms} ms)")
+                model = loaded
+            except Exception as e:
+                print(f"Error loading model: {str(e)}")
+                import traceback
+                traceback.print_exc()
+                raise
     return model
 
 def diagnose_chest_xray(image_path):
@@ -50,60 +63,14 @@ def diagnose_chest_xray(image_path):
         dict: Contains diagnosis, message, and confidence
     """
     try:
-        # Step A: Image Preprocessing
-        # 1. Load image
-        img = Image.open(image_path)
-        
-        # 2. Resize to 224x224
-        img = img.resize((224, 224))
-        
-        # 3. Convert to RGB (in case of grayscale or RGBA)
-        img = img.convert('RGB')
-        
-        # 4. Convert to NumPy array
-        img_array = np.array(img)
-        
-        # 5. Normalize pixel values to [0, 1]
-        img_array = img_array / 255.0
-        
-        # 6. Expand dimensions for batch (1, 224, 224, 3)
-        img_array = np.expand_dims(img_array, axis=0)
-        
-        # Step B: Model Prediction
-        model = load_model()
-        predictions = model.predict(img_array, verbose=0)
-        
-        # Get probabilities for each class
-        probabilities = predictions[0]
+        # Step A + B: Preprocessing (resize to 224x224, RGB) and prediction.
+        # The image joins the next batch of the traced model, which also
+        # scales pixel values to [0, 1] (see keras_serving)
+        load_model()
+        probabilities = predictor.predict_image(image_path)
         
         # Step C: Business Validation Logic
-        # 1. Identify max prediction
-        max_prob_index = np.argmax(probabilities)
-        max_prob = float(probabilities[max_prob_index])
-        predicted_class = CLASS_NAMES[max_prob_index]
-        
-        # 2. Validation Rule 1: Non-X-ray Check
-        if predicted_class == 'Not_Xray':
-            return {
-                "diagnosis": "Invalid Image",
-                "message": "Please upload a valid chest X-ray image.",
-                "confidence": max_prob
-            }
-        
-        # 3. Validation Rule 2: Confidence Threshold Check
-        if max_prob < CONFIDENCE_THRESHOLD:
-            return {
-                "diagnosis": "Uncertain",
-                "message": "Confidence is too low. Review by a specialist is required.",
-                "confidence": max_prob
-            }
-        
-        # 4. Final Diagnosis
-        return {
-            "diagnosis": predicted_class,
-            "message": "Diagnosis confirmed.",
-            "confidence": max_prob
-        }
+        return interpret(probabilities)
         
     except Exception as e:
         print(f"Error in diagnosis: {str(e)}")
@@ -113,6 +80,36 @@ def diagnose_chest_xray(image_path):
             "confidence": 0.0
         }
 
+def interpret(probabilities):
+    """Diagnosis for the model's class probabilities (also used by compare_stacks.py)"""
+    # 1. Identify max prediction
+    max_prob_index = np.argmax(probabilities)
+    max_prob = float(probabilities[max_prob_index])
+    predicted_class = CLASS_NAMES[max_prob_index]
+    
+    # 2. Validation Rule 1: Non-X-ray Check
+    if predicted_class == 'Not_Xray':
+        return {
+            "diagnosis": "Invalid Image",
+            "message": "Please upload a valid chest X-ray image.",
+            "confidence": max_prob
+        }
+    
+    # 3. Validation Rule 2: Confidence Threshold Check
+    if max_prob < CONFIDENCE_THRESHOLD:
+        return {
+            "diagnosis": "Uncertain",
+            "message": "Confidence is too low. Review by a specialist is required.",
+            "confidence": max_prob
+        }
+    
+    # 4. Final Diagnosis
+    return {
+        "diagnosis": predicted_class,
+        "message": "Diagnosis confirmed.",
+        "confidence": max_prob
+    }
+
 @app.route('/predict', methods=['POST'])
 def predict():
     """API endpoint for predictions"""
@@ -130,8 +127,14 @@ def predict():
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
-    return jsonify({"status": "healthy", "model_loaded": model is not None})
+    # Latency and batching stats of the serving path
+    return jsonify({
+        "status": "healthy",
+        "model_loaded": model is not None,
+        "serving": predictor.stats() if predictor else None
+    })
 
 if __name__ == '__main__':
     load_model()  # Pre-load model at startup
-    app.run(host='0.0.0.0', port=5001, debug=False)
+    # Threaded, so that concurrent requests can share a batch
+    app.run(host='0.0.0.0', port=5001, debug=False, threaded=True)
@@ -0,0 +1,105 @@
+import numpy as np
+
+
+def _cubic_weights(t, a=-0.75):
+    # Keys cubic kernel, same coefficient as cv2.INTER_CUBIC
+    w0 = ((a * (t + 1) - 5 * a) * (t + 1) + 8 * a) * (t + 1) - 4 * a
+    w1 = ((a + 2) * t - (a + 3)) * t * t + 1
+    w2 = ((a + 2) * (1 - t) - (a + 3)) * (1 - t) * (1 - t) + 1
+    w3 = 1.0 - w0 - w1 - w2
+    return np.stack([w0, w1, w2, w3]).astype(np.float32)
+
+
+# --- BOUNDED-MEMORY HEATMAP OVERLAY ---
+class OverlayRenderer:
+    """
+    Renders the JET Grad-CAM overlay into the image buffer itself, strip by strip.
+
+    Produces the same picture as resizing the CAM with cv2.INTER_CUBIC,
+    min-max normalizing it and calling show_cam_on_image(..., use_rgb=True,
+    image_weight=0.5), up to a few intensity levels on a handful of pixels
+    where the quantized colormap index lands on the other side of a
+    boundary. It never builds
+    a float copy of the full frame. The CAM is resized horizontally once
+    (cam height x image width). The vertical cubic pass, the uint8 JET
+    colormap lookup and the blend then run over row strips sized to fit
+    `memory_budget_bytes`.
+    """
+
+    # Transient bytes per output pixel inside a strip: float32 CAM rows plus
+    # one interpolation temporary, uint8 colormap index, uint8 BGR heat and
+    # the uint16 heat + image sum.
+    BYTES_PER_PIXEL = 4 + 4 + 1 + 3 + 6
+
+    def __init__(self, memory_budget_bytes=32 * 1024 * 1024):
+        self.memory_budget_bytes = int(memory_budget_bytes)
+
+    def render(self, frame, grayscale_cam):
+        """
+        Overlay `grayscale_cam` ([h, w] float, any scale) onto `frame`.
+
+        `frame` is a writable uint8 RGB [H, W, 3] array; on return it holds
+        the BGR overlay, ready for cv2.imencode. Returns the peak number of
+        bytes allocated for the render on top of `frame`.
+        """
+        # OpenCV is only loaded once the first overlay is rendered
+        import cv2
+
+        H, W = frame.shape[:2]
+        h0 = grayscale_cam.shape[0]
+
+        # Horizontal cubic pass once: [h0, W]
+        cam_rows = cv2.resize(np.float32(grayscale_cam), (W, h0), interpolation=cv2.INTER_CUBIC)
+
+        # Vertical cubic taps for every output row: 4 source rows + weights
+        src = (np.arange(H, dtype=np.float64) + 0.5) * (h0 / H) - 0.5
+        base = np.floor(src)
+        taps = np.clip(base.astype(np.int64)[None, :] + np.arange(-1, 3)[:, None], 0, h0 - 1)
+        weights = _cubic_weights(src - base)
+        fixed_bytes = cam_rows.nbytes + taps.nbytes + weights.nbytes
+
+        per_row = W * self.BYTES_PER_PIXEL
+        strip = max(1, min(H, (self.memory_budget_bytes - fixed_bytes) // max(1, per_row)))
+        peak_bytes = fixed_bytes + strip * per_row
+
+        def cam_strip(y0, y1):
+            rows = weights[0, y0:y1, None] * cam_rows[taps[0, y0:y1]]
+            for k in range(1, 4):
+                rows += weights[k, y0:y1, None] * cam_rows[taps[k, y0:y1]]
+            return rows
+
+        # Pass 1: range of the resized CAM
+        cam_min, cam_max = np.inf, -np.inf
+        for y0 in range(0, H, strip):
+            rows = cam_strip(y0, min(H, y0 + strip))
+            cam_min = min(cam_min, float(rows.min()))
+            cam_max = max(cam_max, float(rows.max()))
+        scale = 1.0 / (cam_max - cam_min) if cam_max > cam_min else 0.0
+
+        def heat_strip(y0, y1):
+            # Normalize to [0, 1] and quantize like show_cam_on_image: uint8(255 * mask)
+            rows = cam_strip(y0, y1)
+            rows -= cam_min
+            rows *= 255.0 * scale
+            np.clip(rows, 0, 255, out=rows)
+            return cv2.applyColorMap(rows.astype(np.uint8), cv2.COLORMAP_JET)
+
+        # Pass 2: swap the frame to BGR in place and find the brightest
+        # heat + image sum, the divisor of show_cam_on_image
+        sum_max = 1
+        for y0 in range(0, H, strip):
+            y1 = min(H, y0 + strip)
+            rows = frame[y0:y1]
+            cv2.cvtColor(rows, cv2.COLOR_RGB2BGR, dst=rows)
+            total = cv2.add(heat_strip(y0, y1), rows, dtype=cv2.CV_16U)
+            sum_max = max(sum_max, int(total.max()))
+
+        # Pass 3: blend in place (gamma -0.5 turns addWeighted's rounding into
+        # the truncation of np.uint8(255 * cam))
+        weight = 255.0 / sum_max
+        for y0 in range(0, H, strip):
+            y1 = min(H, y0 + strip)
+            rows = frame[y0:y1]
+            cv2.addWeighted(heat_strip(y0, y1), weight, rows, weight, -0.5, dst=rows)
+
+        return peak_bytes
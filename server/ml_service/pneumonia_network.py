@@ -1,6 +1,8 @@
+import copy
+
 import torch
 import torch.nn as nn
-from torchvision import models
+import torch.nn.functional as F
 
 # ============================================================
 # CBAM modules
@@ -45,10 +47,45 @@ class CBAM(nn.Module):
         x = self.sa(x)
         return x
 
+class FusedChannelAttention(nn.Module):
+    """
+    ChannelAttention for inference: the avg and max descriptors go through
+    the shared MLP as one stacked batch, and the max is a single reduction
+    over both spatial dims. Same parameters (and state_dict keys).
+    """
+    def __init__(self, mlp: nn.Module):
+        super().__init__()
+        self.mlp = mlp
+
+    def forward(self, x):
+        n = x.shape[0]
+        descriptors = torch.cat([x.mean(dim=(2, 3), keepdim=True), x.amax(dim=(2, 3), keepdim=True)])
+        attn = self.mlp(descriptors)
+        return x * torch.sigmoid(attn[:n] + attn[n:])
+
+class FusedSpatialAttention(nn.Module):
+    """
+    SpatialAttention for inference: the 2-channel conv is applied as two
+    1-channel convs (it is linear), so the [avg, max] map is never
+    concatenated. Same parameters (and state_dict keys).
+    """
+    def __init__(self, conv: nn.Conv2d):
+        super().__init__()
+        self.conv = conv
+
+    def forward(self, x):
+        weight, padding = self.conv.weight, self.conv.padding
+        attn = F.conv2d(x.mean(dim=1, keepdim=True), weight[:, :1], padding=padding) \
+            + F.conv2d(x.amax(dim=1, keepdim=True), weight[:, 1:], padding=padding)
+        return x * torch.sigmoid(attn)
+
 # ============================================================
 # EfficientNet-B0 + CBAM wrapper (single logit)
 # ============================================================
 class EfficientNetB0WithCBAM(nn.Module):
+    # inference_model() sets this: inputs are converted to channels_last
+    channels_last_input = False
+
     def __init__(self, base: nn.Module, cbam: nn.Module):
         super().__init__()
         self.base = base
@@ -57,47 +94,138 @@ class EfficientNetB0WithCBAM(nn.Module):
         self.cbam = cbam
 
     def forward(self, x):
-        x = self.base.features(x)
+        return self.forward_head(self.forward_features(x))
+
+    def forward_features(self, x):
+        # Backbone feature maps; the output of base.features[-1] is the CAM target
+        if self.channels_last_input:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return self.base.features(x)
+
+    def forward_head(self, x):
         x = self.cbam(x)
         x = self.base.avgpool(x)
         x = torch.flatten(x, 1)
         x = self.base.classifier(x)
         return x
 
-def build_pneumonia_model(device="cpu", weights_path=None) -> nn.Module:
+def load_checkpoint(weights_path, device="cpu"):
+    # Memory-map zipfile checkpoints instead of reading them into memory;
+    # legacy (non-zipfile) checkpoints cannot be mapped and are read normally
+    try:
+        return torch.load(weights_path, map_location=device, mmap=True)
+    except RuntimeError:
+        return torch.load(weights_path, map_location=device)
+
+# ============================================================
+# Inference-optimized build
+# ============================================================
+def fold_batchnorm(module: nn.Module) -> int:
+    """
+    Fold every BatchNorm2d that directly follows a Conv2d inside an
+    nn.Sequential (torchvision's Conv2dNormActivation) into the conv, in
+    place, using the running statistics. Eval-mode only. Returns the count.
+    """
+    from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+    folded = 0
+    for child in module.children():
+        folded += fold_batchnorm(child)
+    if isinstance(module, nn.Sequential):
+        for i in range(len(module) - 1):
+            if isinstance(module[i], nn.Conv2d) and isinstance(module[i + 1], nn.BatchNorm2d):
+                module[i] = fuse_conv_bn_eval(module[i], module[i + 1])
+                module[i + 1] = nn.Identity()
+                folded += 1
+    return folded
+
+def _max_logit_diff(reference, model, device):
+    generator = torch.Generator().manual_seed(0)
+    max_diff = 0.0
+    with torch.no_grad():
+        for n in (1, 3):
+            batch = torch.randn(n, 3, 224, 224, generator=generator).to(device)
+            max_diff = max(max_diff, (model(batch) - reference(batch)).abs().max().item())
+    return max_diff
+
+def inference_model(model: nn.Module, device="cpu", atol=1e-4) -> nn.Module:
+    """
+    Inference copy of a gate or classifier: BatchNorm folded into the convs,
+    weights (and classifier inputs) in channels_last, and the fused CBAM
+    modules. The copy is checked against `model` on fixed random inputs;
+    if a logit differs by more than `atol`, `model` is returned unchanged.
+    Gradients still flow (Grad-CAM), but training it is not supported.
+    """
+    model = model.eval()
+    optimized = copy.deepcopy(model)
+    folded = fold_batchnorm(optimized)
+    if isinstance(optimized, EfficientNetB0WithCBAM):
+        optimized.cbam.ca = FusedChannelAttention(optimized.cbam.ca.mlp)
+        optimized.cbam.sa = FusedSpatialAttention(optimized.cbam.sa.conv)
+        optimized.channels_last_input = True
+    optimized = optimized.to(memory_format=torch.channels_last)
+
+    max_diff = _max_logit_diff(model, optimized, device)
+    if max_diff > atol:
+        print(f"Warning: optimized model differs from the reference (max |logit diff| {max_diff:.2e} > {atol:.0e}), keeping the reference")
+        return model
+    print(f"Optimized for inference: {folded} BatchNorms folded, channels_last (max |logit diff| {max_diff:.2e})")
+    return optimized
+
+def build_gate_model(device="cpu", weights_path=None, optimize_for_inference=False) -> nn.Module:
+    # X-ray gate: plain EfficientNet-B0 with a 2-way head [non_xray, xray].
+    # No ImageNet weights: the gate checkpoint overwrites all of them.
+    from torchvision import models
+
+    # With a checkpoint, build on the meta device (no random init) and let
+    # load_state_dict(assign=True) adopt the checkpoint tensors directly
+    with torch.device("meta" if weights_path else device):
+        model = models.efficientnet_b0(weights=None)
+        in_features = model.classifier[1].in_features
+        model.classifier[1] = nn.Linear(in_features, 2)
+
+    if weights_path:
+        model.load_state_dict(load_checkpoint(weights_path, device), strict=True, assign=True)
+    model = model.to(device)
+    return inference_model(model, device) if optimize_for_inference else model
+
+def build_pneumonia_model(device="cpu", weights_path=None, optimize_for_inference=False) -> nn.Module:
+    from torchvision import models
+
     # We do NOT load ImageNet weights here because we will load our own state_dict
     # However, to match architecture, we need the structure.
     # The saved state_dict will contain the weights.
-    base = models.efficientnet_b0(weights=None)
-
-    # replace classifier -> single logit (Binary Classification)
-    in_features = base.classifier[1].in_features
-    base.classifier[1] = nn.Sequential(
-        nn.Dropout(0.2), # Default dropout from user config
-        nn.Linear(in_features, 1)
-    )
-
-    cbam = CBAM(channels=in_features,
-                reduction=16,
-                spatial_kernel=7)
-    
-    model = EfficientNetB0WithCBAM(base, cbam)
-    model.to(device)
+    with torch.device("meta" if weights_path else device):
+        base = models.efficientnet_b0(weights=None)
+
+        # replace classifier -> single logit (Binary Classification)
+        in_features = base.classifier[1].in_features
+        base.classifier[1] = nn.Sequential(
+            nn.Dropout(0.2), # Default dropout from user config
+            nn.Linear(in_features, 1)
+        )
+
+        cbam = CBAM(channels=in_features,
+                    reduction=16,
+                    spatial_kernel=7)
+
+        model = EfficientNetB0WithCBAM(base, cbam)
 
     if weights_path:
         try:
-            state_dict = torch.load(weights_path, map_location=device)
+            state_dict = load_checkpoint(weights_path, device)
             # Handle different checkpoint formats if necessary
             if isinstance(state_dict, dict) and 'model_state_dict' in state_dict:
                 state_dict = state_dict['model_state_dict']
             
-            model.load_state_dict(state_dict, strict=True)
+            model.load_state_dict(state_dict, strict=True, assign=True)
             print(f"Successfully loaded EfficientNetB0+CBAM weights from {weights_path}")
         except Exception as e:
             print(f"Error loading EfficientNetB0+CBAM weights: {e}")
             raise e
             
-    return model
+    model = model.to(device)
+    return inference_model(model, device) if optimize_for_inference else model
 
 def get_cam_target_layer(model: nn.Module) -> nn.Module:
     # If wrapped, the EfficientNet backbone lives in model.base
@@ -0,0 +1,404 @@
+import os
+import time
+import torch
+import traceback
+
+# Import the new model architecture
+from pneumonia_network import build_gate_model, build_pneumonia_model
+from explain import CamEngine
+from heatmap_formats import HeatmapOptions, OVERLAY_FORMATS, encode_heatmap
+from preprocessing import prepare_image, to_tensor_batch
+from overlay import OverlayRenderer
+from backends import load_backend
+from metrics import StageTimer, SampledProfiler, shared_stage
+
+# --- CORE LOGIC ENGINE ---
+class PneumoniaSystem:
+    def __init__(self, cls_path="best_pneumonia_model.pt", gate_path="xray_gate_efficientnet_b0.pth", overlay_memory_mb=32, jpeg_draft=True,
+                 backend="eager", backend_cache_dir=None, backend_parity_atol=1e-3,
+                 quant_calibration_dir=None, quant_calibration_limit=64,
+                 quant_min_agreement=0.99, quant_max_drift=0.05, snapshot_dir=None,
+                 profile_sample_rate=0.0, profile_dir=None, gate_threshold=0.9,
+                 optimize_models=False, shared_weights_dir=None, cam_batch_size=2):
+        started = time.perf_counter()
+        # Per-phase startup timings (ms), reported on /stats
+        self.startup_timings = {}
+        lap = [started]
+        def record(phase):
+            now = time.perf_counter()
+            self.startup_timings[phase] = round((now - lap[0]) * 1000.0, 1)
+            lap[0] = now
+
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        # Minimum X-ray probability for an image to pass the gate
+        self.gate_threshold = gate_threshold
+        # Most images explained by one Grad-CAM forward/backward (0 = the whole batch)
+        self.cam_batch_size = int(cam_batch_size)
+        print(f"Loading models on {self.device}...")
+        
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        cls_full_path = cls_path if os.path.isabs(cls_path) else os.path.join(base_dir, cls_path)
+        gate_full_path = gate_path if os.path.isabs(gate_path) else os.path.join(base_dir, gate_path)
+
+        # =========================================================
+        # 0. READY-TO-RUN SNAPSHOT (optional, see snapshot.py)
+        # =========================================================
+        snapshot = None
+        if snapshot_dir:
+            from snapshot import load_snapshot
+            from result_cache import weights_fingerprint
+
+            # Only check the snapshot against checkpoints that are actually deployed
+            checkpoints = [cls_full_path, gate_full_path]
+            expected = weights_fingerprint(checkpoints) if any(os.path.exists(p) for p in checkpoints) else None
+            snapshot = load_snapshot(snapshot_dir, self.device, expected)
+            record("snapshot_ms")
+
+        self.model_source = "snapshot" if snapshot else "checkpoints"
+        # Models loaded from shared memory-mapped weights (kind -> file key)
+        self.shared_weights = {}
+        if snapshot:
+            self.gate_model, self.cls_model = snapshot
+            print(f"Loaded gate and classifier from snapshot {snapshot_dir}")
+        else:
+            self._load_checkpoints(cls_full_path, gate_full_path, record, optimize_models, shared_weights_dir)
+        
+        # =========================================================
+        # PREPROCESSING (Standard ImageNet, shared by both models)
+        # =========================================================
+        # Gate and classifier take the same 224x224 normalized tensor, built
+        # once per image by preprocessing.to_tensor_batch. JPEGs are decoded
+        # at reduced size when `jpeg_draft` is set.
+        self.jpeg_draft = jpeg_draft
+
+        # =========================================================
+        # INFERENCE BACKENDS (eager / torchscript / compile / onnx / int8)
+        # =========================================================
+        # Plain no_grad forwards of both models go through the selected
+        # backend; Grad-CAM needs autograd and always uses the eager module.
+        backend_options = {}
+        thresholds = {}
+        if backend == "int8":
+            from quantization import decision_thresholds
+
+            # int8 parity is judged at the thresholds this system serves with
+            thresholds = decision_thresholds(self.gate_threshold)
+            backend_options = {
+                "calibration": self._load_calibration(quant_calibration_dir, quant_calibration_limit),
+                "min_agreement": quant_min_agreement,
+                "max_drift": quant_max_drift,
+            }
+        self.gate_backend = None
+        self.backend_info = {"gate": None}
+        if self.gate_model:
+            self.gate_backend, self.backend_info["gate"] = load_backend(
+                backend, self.gate_model, self.device, label="gate", threshold=thresholds.get("gate"),
+                cache_dir=backend_cache_dir, parity_atol=backend_parity_atol, **backend_options
+            )
+        self.cls_backend, self.backend_info["classifier"] = load_backend(
+            backend, self.cls_model, self.device, label="classifier", threshold=thresholds.get("classifier"),
+            cache_dir=backend_cache_dir, parity_atol=backend_parity_atol, **backend_options
+        )
+
+        record("backends_ms")
+
+        self.cam_engine = CamEngine(self.cls_model)
+
+        # Heatmap overlays are rendered strip by strip within this budget
+        self.overlay_renderer = OverlayRenderer(int(overlay_memory_mb * 1024 * 1024))
+
+        # Opt-in torch profiler traces for a sample of predict_batch calls
+        self.profiler = SampledProfiler(profile_sample_rate, profile_dir)
+
+        self.startup_timings["total_ms"] = round((time.perf_counter() - started) * 1000.0, 1)
+        print(f"Models ready from {self.model_source}: {self.startup_timings}")
+
+    def _build_model(self, kind, builder, weights_path, optimize, shared_dir):
+        build = lambda: builder(device=self.device, weights_path=weights_path, optimize_for_inference=optimize).eval()
+        if not shared_dir or self.device != "cpu":
+            return build()
+        from shared_weights import shared_model, shared_key
+        from result_cache import weights_fingerprint
+
+        # One memory-mapped copy of the finished module for all workers
+        key = shared_key(kind, weights_fingerprint([weights_path]), optimized=int(bool(optimize)))
+        try:
+            model = shared_model(key, build, shared_dir)
+        except OSError as e:
+            print(f"Warning: shared weights unavailable ({e}), loading a private copy")
+            return build()
+        self.shared_weights[kind] = key
+        return model
+
+    def _load_checkpoints(self, cls_full_path, gate_full_path, record, optimize=False, shared_dir=None):
+        # Architectures are built without pretrained weights (nothing is
+        # downloaded) and checkpoints are memory-mapped, see pneumonia_network.
+        # With `optimize`, both models get the inference build (folded
+        # BatchNorm, channels_last, fused CBAM), checked against the reference.
+        # With `shared_dir`, the finished modules are shared between worker
+        # processes through one memory-mapped file each (see shared_weights).
+
+        # =========================================================
+        # 1. LOAD GATE MODEL (EfficientNet-B0)
+        # =========================================================
+        print("Initializing X-ray Gate Model...")
+        self.gate_model = None
+        if os.path.exists(gate_full_path):
+            try:
+                self.gate_model = self._build_model("gate", build_gate_model, gate_full_path, optimize, shared_dir)
+                print(f"Successfully loaded Gate Model from {gate_full_path}")
+            except Exception as e:
+                print(f"Error loading Gate Model: {e}")
+                self.gate_model = None # Disable gate if load fails
+        else:
+            print(f"Warning: Gate Model weights not found at {gate_full_path}")
+        record("gate_ms")
+
+        # =========================================================
+        # 2. BUILD PNEUMONIA CLASSIFIER (EfficientNetB0 + CBAM)
+        # =========================================================
+        print("Building EfficientNetB0 + CBAM Classifier...")
+        
+        try:
+            if os.path.exists(cls_full_path):
+                self.cls_model = self._build_model("classifier", build_pneumonia_model, cls_full_path, optimize, shared_dir)
+            else:
+                print(f"Warning: Classifier weights not found at {cls_full_path}")
+                # Build without weights just in case, but it won't predict well
+                self.cls_model = build_pneumonia_model(device=self.device, weights_path=None)
+                self.cls_model.eval()
+        except Exception as e:
+            print(f"Error loading Classifier: {e}")
+            raise e
+        record("classifier_ms")
+
+    def _load_calibration(self, folder, limit):
+        # Sample X-rays for int8 calibration, preprocessed like live traffic
+        if not folder or not os.path.isdir(folder):
+            print(f"Warning: int8 calibration folder not found: {folder}")
+            return []
+        from quantization import list_images, load_batches
+        batches, paths = load_batches(list_images(folder, limit), device=self.device, draft=self.jpeg_draft)
+        print(f"Loaded {len(paths)} calibration images from {folder}")
+        return batches
+
+    def predict(self, image_bytes, heatmap=HeatmapOptions()):
+        return self.predict_batch([image_bytes], [heatmap])[0]
+
+    def predict_batch(self, images, heatmaps=None, telemetry=False):
+        """
+        Run the full pipeline over a list of raw image bytes.
+
+        `heatmaps` is an optional list of per-image HeatmapOptions (default:
+        PNG overlays for all); images whose entry is None skip Grad-CAM and
+        return "heatmap": None. Each image is decoded once into a shared
+        224x224 tensor (full resolution only for overlays). The gate sees a
+        single batched forward pass, and so does the classifier for the
+        images that need no heatmap; the others get their label and
+        Grad-CAM++ map from gradient-enabled passes over `cam_batch_size`
+        images at a time (one shared "cam" stage per chunk; a chunk that fails
+        is retried image by image). Returns one result dict per input, in
+        input order.
+
+        With `telemetry`, every result also carries "_telemetry": per-stage
+        timings in ms (a batched stage counts in full for every image in it)
+        and the events seen ("gate_rejection", "cam_fallback:<reason>",
+        "error:<kind>").
+        """
+        if heatmaps is None:
+            heatmaps = [HeatmapOptions()] * len(images)
+        timers = [StageTimer() for _ in images]
+        events = [[] for _ in images]
+        with self.profiler.maybe_profile():
+            prepared = []
+            for i, image_bytes in enumerate(images):
+                needs_overlay = heatmaps[i] is not None and heatmaps[i].format in OVERLAY_FORMATS
+                prepared.append(prepare_image(image_bytes, draft=self.jpeg_draft, keep_full=needs_overlay, timer=timers[i]))
+            results = self._predict_prepared(prepared, heatmaps, timers, events)
+        return self._with_telemetry(results, timers, events) if telemetry else results
+
+    def predict_prepared(self, prepared, heatmaps=None, telemetry=False, features=False):
+        """
+        predict_batch for images already decoded by preprocessing.prepare_image
+        (e.g. in loader processes); None entries are reported as invalid images.
+
+        With `features`, every image that passed the gate also returns the
+        classifier's backbone feature maps as "_features" (a float16
+        (1280, 7, 7) array, see feature_store.py); the classifier then runs
+        eagerly instead of on the configured backend.
+        """
+        if heatmaps is None:
+            heatmaps = [HeatmapOptions()] * len(prepared)
+        timers = [StageTimer() for _ in prepared]
+        events = [[] for _ in prepared]
+        with self.profiler.maybe_profile():
+            results = self._predict_prepared(prepared, heatmaps, timers, events, features)
+        return self._with_telemetry(results, timers, events) if telemetry else results
+
+    def _with_telemetry(self, results, timers, events):
+        for i, result in enumerate(results):
+            result["_telemetry"] = {
+                "timings_ms": {stage: round(ms, 3) for stage, ms in timers[i].timings.items()},
+                "events": events[i],
+            }
+        return results
+
+    def _predict_prepared(self, images, heatmaps, timers, events, keep_features=False):
+        results = [None] * len(images)
+        decoded = []
+        for i, image in enumerate(images):
+            if image is None:
+                results[i] = {"error": "Invalid Image Format"}
+                events[i].append("error:invalid_image")
+            else:
+                decoded.append((i, image))
+        if not decoded:
+            return results
+
+        # One normalized tensor per image, shared by the gate and the classifier
+        with shared_stage("preprocess", [timers[i] for i, _ in decoded]):
+            batch = to_tensor_batch([image.pixels for _, image in decoded], self.device)
+        batch_rows = {i: row for row, (i, _) in enumerate(decoded)}
+
+        # =========================================================
+        # STEP 1: GATE CHECK (Is this an X-ray?)
+        # =========================================================
+        xray_confidences = {i: 0.0 for i, _ in decoded}
+        passed = decoded
+
+        if self.gate_model:
+            with shared_stage("gate_forward", [timers[i] for i, _ in decoded]), torch.no_grad():
+                gate_output = self.gate_backend(batch)
+                gate_probs = torch.softmax(gate_output, dim=1) # [non_xray_prob, xray_prob]
+
+                # Index 1 is "xray" based on user description
+                xray_probs = gate_probs[:, 1].tolist()
+
+            passed = []
+            for (i, prepared), xray_prob in zip(decoded, xray_probs):
+                xray_confidences[i] = xray_prob
+
+                # Threshold check
+                if xray_prob < self.gate_threshold:
+                    print(f"Gate Rejection: Not an X-ray (Confidence: {xray_prob:.4f})")
+                    events[i].append("gate_rejection")
+                    results[i] = {
+                        "is_xray": False,
+                        "xray_confidence": round(xray_prob, 4),
+                        "message": "This image is not a chest X-ray. Please upload a chest X-ray image."
+                    }
+                else:
+                    print(f"Gate Passed: Is X-ray (Confidence: {xray_prob:.4f})")
+                    passed.append((i, prepared))
+
+        if not passed:
+            return results
+
+        # =========================================================
+        # STEP 2: CLASSIFY + GRAD-CAM (EfficientNetB0 - Single Logit)
+        # =========================================================
+        # For images that get a heatmap, the CAM engine reads the pneumonia
+        # probability from the same gradient-enabled forward that produces
+        # the Grad-CAM++ maps, one forward/backward per chunk of
+        # `cam_batch_size` images, so the classifier runs once per chunk.
+        cls_batch = batch[[batch_rows[i] for i, _ in passed]]
+        pneumonia_probs = [None] * len(passed)
+        grayscale_cams = [None] * len(passed)
+        feature_maps = [None] * len(passed)
+
+        plain = [k for k, (i, _) in enumerate(passed) if heatmaps[i] is None]
+        if plain:
+            with shared_stage("classifier_forward", [timers[passed[k][0]] for k in plain]), torch.no_grad():
+                if keep_features:
+                    # Eager, so the maps are the ones the eager head re-scores
+                    maps = self.cls_model.forward_features(cls_batch[plain])
+                    output = self.cls_model.forward_head(maps)
+                    for k, row in zip(plain, maps):
+                        feature_maps[k] = row
+                else:
+                    output = self.cls_backend(cls_batch[plain])
+                # Sigmoid for binary output
+                for k, prob in zip(plain, torch.sigmoid(output)[:, 0].tolist()):
+                    pneumonia_probs[k] = prob
+
+        explained = [k for k, (i, _) in enumerate(passed) if heatmaps[i] is not None]
+        step = self.cam_batch_size or len(explained)
+        for start in range(0, len(explained), step or 1):
+            chunk = explained[start:start + step]
+            # One batched forward/backward per chunk; if it fails, each image
+            # is retried alone so one bad input only costs its own heatmap
+            try:
+                with shared_stage("cam", [timers[passed[k][0]] for k in chunk]):
+                    outputs = [self.cam_engine(cls_batch[chunk])]
+                groups = [chunk]
+            except Exception as cam_err:
+                print(f"Batched Grad-CAM failed ({cam_err}), retrying per image")
+                outputs, groups = [], []
+                for k in chunk:
+                    i = passed[k][0]
+                    events[i].append("cam_fallback:per_image")
+                    tensor = cls_batch[k:k + 1]
+                    try:
+                        with timers[i].stage("cam"):
+                            outputs.append(self.cam_engine(tensor))
+                        groups.append([k])
+                    except Exception as cam_err:
+                        print(f"Grad-CAM CRASHED: {cam_err}")
+                        traceback.print_exc()
+                        events[i].append("cam_fallback:error")
+                        events[i].append("error:cam")
+                        with timers[i].stage("classifier_forward"), torch.no_grad():
+                            pneumonia_probs[k] = torch.sigmoid(self.cls_backend(tensor)).item()
+
+            for group, (probs, cams, methods) in zip(groups, outputs):
+                for n, k in enumerate(group):
+                    pneumonia_probs[k], grayscale_cams[k] = probs[n], cams[n]
+                    if methods[n] == "gradcam++":
+                        print("GradCAM++ Success")
+                    else:
+                        print("GradCAM++ produced a non-finite map, fell back to standard GradCAM")
+                        events[passed[k][0]].append("cam_fallback:gradcam")
+
+        # Maps of the images that went through Grad-CAM, in one extra backbone pass
+        missing = [k for k in range(len(passed)) if keep_features and feature_maps[k] is None]
+        if missing:
+            with shared_stage("features_forward", [timers[passed[k][0]] for k in missing]), torch.no_grad():
+                for k, row in zip(missing, self.cls_model.forward_features(cls_batch[missing])):
+                    feature_maps[k] = row
+
+        for k, (i, prepared) in enumerate(passed):
+            pneumonia_prob = pneumonia_probs[k]
+
+            # Threshold 0.5
+            if pneumonia_prob >= 0.5:
+                classification = "Pneumonia"
+                class_confidence = pneumonia_prob
+            else:
+                classification = "Normal"
+                class_confidence = 1.0 - pneumonia_prob
+
+            print(f"Analysis Complete: Class={classification} ({class_confidence:.2%})")
+            results[i] = {
+                "is_xray": True,
+                "xray_confidence": round(xray_confidences[i], 4),
+                "classification": classification,
+                "class_confidence": round(class_confidence, 4),
+                "image_width": prepared.size[0],
+                "image_height": prepared.size[1],
+                "heatmap": None
+            }
+            if grayscale_cams[k] is not None:
+                results[i].update(self._render_heatmap(prepared, grayscale_cams[k], heatmaps[i], timers[i], events[i]))
+            if feature_maps[k] is not None:
+                results[i]["_features"] = feature_maps[k].contiguous().to(torch.float16).cpu().numpy()
+        return results
+
+    def _render_heatmap(self, prepared, grayscale_cam, options, timer=None, events=None):
+        try:
+            return encode_heatmap(prepared.full_image, grayscale_cam, options, self.overlay_renderer, timer)
+        except Exception as cam_err:
+            print(f"Heatmap rendering CRASHED: {cam_err}")
+            traceback.print_exc()
+            if events is not None:
+                events.append("error:heatmap_render")
+            return {}
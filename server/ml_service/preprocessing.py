@@ -0,0 +1,112 @@
+import io
+import mmap
+
+import numpy as np
+import torch
+from PIL import Image, ImageOps
+
+from metrics import stage_of
+
+INPUT_SIZE = 224
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+# EXIF orientations that swap width and height
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+# --- SHARED PREPROCESSING ---
+def open_image(source):
+    """PIL image from upload bytes, or straight from a read-only mmap (no copy)."""
+    if isinstance(source, mmap.mmap):
+        source.seek(0)
+        return Image.open(source)
+    return Image.open(io.BytesIO(source))
+
+
+class PreparedImage:
+    """
+    One upload, decoded once for inference.
+
+    `pixels` is the [224, 224, 3] uint8 RGB model input shared by the gate
+    and the classifier; `size` is the (width, height) of the full image
+    after EXIF rotation, read from the header. The full-resolution image is
+    only decoded by `full_image()`, i.e. when a heatmap overlay needs it.
+    """
+    __slots__ = ("source", "size", "pixels", "_full", "_draft")
+
+    def __init__(self, source, size, pixels, full=None, draft=False):
+        self.source = source
+        self.size = size
+        self.pixels = pixels
+        self._full = full
+        self._draft = draft
+
+    def full_image(self, max_edge=0):
+        """
+        Full-resolution RGB PIL image, EXIF-transposed.
+
+        With `max_edge`, JPEGs may be DCT-scaled down towards that edge
+        length (never below it); callers still resize to the exact size.
+        """
+        if self._full is not None:
+            full, self._full = self._full, None
+            return full
+        img = open_image(self.source)
+        if self._draft and max_edge:
+            img.draft('RGB', (max_edge, max_edge))
+        return ImageOps.exif_transpose(img.convert('RGB'))
+
+
+def prepare_image(image_bytes, draft=True, keep_full=False, timer=None):
+    """
+    Decode an upload (bytes or a read-only mmap) into a PreparedImage, or
+    return None if it isn't an image.
+
+    With `draft`, JPEGs are decoded with DCT scaling to the smallest size
+    that is still at least 224x224, instead of at full resolution. Other
+    formats are decoded in full; with `keep_full` that decode is kept for
+    `full_image()` instead of being repeated. An optional metrics.StageTimer
+    records the "decode", "exif_transpose" and "resize" stages.
+    """
+    stage = stage_of(timer)
+    try:
+        with stage("decode"):
+            img = open_image(image_bytes)
+            width, height = img.size
+            if img.getexif().get(0x0112, 1) in _TRANSPOSED_ORIENTATIONS:
+                width, height = height, width
+
+            use_draft = draft and img.format == "JPEG"
+            if use_draft:
+                img.draft('RGB', (INPUT_SIZE, INPUT_SIZE))
+
+            img = img.convert('RGB')
+
+        with stage("exif_transpose"):
+            # Fix EXIF rotation (ensures Python sees the same orientation as the browser)
+            img = ImageOps.exif_transpose(img)
+
+        with stage("resize"):
+            # Same as transforms.Resize((224, 224)) on a PIL image
+            pixels = np.asarray(img.resize((INPUT_SIZE, INPUT_SIZE), Image.BILINEAR))
+    except Exception:
+        return None
+
+    full = img if keep_full and not use_draft else None
+    return PreparedImage(image_bytes, (width, height), pixels, full=full, draft=use_draft)
+
+
+_MEAN = torch.tensor(IMAGENET_MEAN).view(1, 3, 1, 1)
+_STD = torch.tensor(IMAGENET_STD).view(1, 3, 1, 1)
+
+
+def to_tensor_batch(pixels, device="cpu"):
+    """
+    Stack [224, 224, 3] uint8 arrays into one normalized [N, 3, 224, 224] tensor.
+
+    Vectorized equivalent of ToTensor() + Normalize(ImageNet) applied per image.
+    """
+    batch = torch.from_numpy(np.stack(pixels)).to(device)
+    batch = batch.permute(0, 3, 1, 2).float().div_(255)
+    return batch.sub_(_MEAN.to(device)).div_(_STD.to(device)).contiguous()
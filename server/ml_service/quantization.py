@@ -0,0 +1,266 @@
+"""
+INT8 static post-training quantization for the gate and the classifier,
+plus an fp32-vs-int8 parity harness.
+
+Serving uses this through ML_BACKEND=int8 (see backends.QuantizedBackend).
+The harness is meant to be run offline on a labeled set before enabling it:
+
+    python quantization.py --calibration-dir samples/ --eval-dir chest_xray/test --output int8_report.json
+
+Labels come from the parent directory name: NORMAL and PNEUMONIA are chest
+X-rays of that class, any other directory is treated as "not an X-ray".
+"""
+import os
+import copy
+import json
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from preprocessing import prepare_image, to_tensor_batch
+
+# Same classifier threshold as PneumoniaSystem.predict_batch; the gate's is
+# configurable (PneumoniaSystem.gate_threshold, ML_GATE_THRESHOLD)
+CLS_THRESHOLD = 0.5
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".webp")
+CLASS_LABELS = {"normal": 0, "pneumonia": 1}
+
+
+def gate_probs(logits):
+    # Index 1 is "xray"
+    return torch.softmax(logits, dim=1)[:, 1]
+
+
+def cls_probs(logits):
+    return torch.sigmoid(logits)[:, 0]
+
+
+# label -> probability of the positive decision
+PROB_FNS = {
+    "gate": gate_probs,
+    "classifier": cls_probs,
+}
+
+
+def decision_thresholds(gate_threshold):
+    """label -> threshold of the served decision, for a given gate threshold."""
+    return {"gate": gate_threshold, "classifier": CLS_THRESHOLD}
+
+
+def list_images(folder, limit=0):
+    """Image files under `folder`, sorted, at most `limit` of them (0 = all)."""
+    paths = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(root, name))
+                if limit and len(paths) >= limit:
+                    return paths
+    return paths
+
+
+def load_batches(paths, batch_size=16, device="cpu", draft=True):
+    """
+    Preprocess `paths` exactly like the service does.
+
+    Returns (batches, kept): a list of normalized [N, 3, 224, 224] tensors and
+    the paths that decoded, in order. Unreadable files are skipped.
+    """
+    batches, kept, pixels = [], [], []
+    for path in paths:
+        with open(path, "rb") as f:
+            prepared = prepare_image(f.read(), draft=draft)
+        if prepared is None:
+            print(f"Skipping unreadable image: {path}")
+            continue
+        kept.append(path)
+        pixels.append(prepared.pixels)
+        if len(pixels) == batch_size:
+            batches.append(to_tensor_batch(pixels, device))
+            pixels = []
+    if pixels:
+        batches.append(to_tensor_batch(pixels, device))
+    return batches, kept
+
+
+def _select_engine():
+    engines = torch.backends.quantized.supported_engines
+    engine = "x86" if "x86" in engines else "qnnpack"
+    torch.backends.quantized.engine = engine
+    return engine
+
+
+def quantize_static(model, calibration_batches):
+    """
+    INT8 copy of `model` (FX graph mode, per-channel weights, histogram
+    observers) calibrated on `calibration_batches`. `model` is not modified.
+    Ops without an int8 kernel (SiLU, sigmoid gates) stay in fp32.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    if not calibration_batches:
+        raise ValueError("static quantization needs at least one calibration batch")
+    engine = _select_engine()
+    example = (calibration_batches[0][:1].cpu(),)
+    prepared = prepare_fx(copy.deepcopy(model).cpu().eval(), get_default_qconfig_mapping(engine), example)
+    with torch.no_grad():
+        for batch in calibration_batches:
+            prepared(batch.cpu())
+    return convert_fx(prepared)
+
+
+def predict_probs(model, batches, prob_fn):
+    with torch.no_grad():
+        return torch.cat([prob_fn(model(batch)).float().cpu() for batch in batches]).numpy()
+
+
+def decision_parity(reference, candidate, threshold):
+    """Agreement of `probs >= threshold` decisions and probability drift."""
+    reference = np.asarray(reference, dtype=np.float64)
+    candidate = np.asarray(candidate, dtype=np.float64)
+    drift = np.abs(candidate - reference)
+    return {
+        "n": int(reference.size),
+        "agreement": float(np.mean((reference >= threshold) == (candidate >= threshold))) if reference.size else 1.0,
+        "mean_drift": float(drift.mean()) if reference.size else 0.0,
+        "p99_drift": float(np.percentile(drift, 99)) if reference.size else 0.0,
+        "max_drift": float(drift.max()) if reference.size else 0.0,
+    }
+
+
+def check_decision_parity(report, min_agreement, max_drift):
+    """Raise ValueError if a decision_parity report is out of bounds."""
+    if report["agreement"] < min_agreement:
+        raise ValueError(f"decision agreement {report['agreement']:.4f} below {min_agreement}")
+    if report["max_drift"] > max_drift:
+        raise ValueError(f"max probability drift {report['max_drift']:.4f} exceeds {max_drift}")
+
+
+# =========================================================
+# PARITY HARNESS
+# =========================================================
+def _label_of(path):
+    name = os.path.basename(os.path.dirname(path)).lower()
+    return CLASS_LABELS.get(name)
+
+
+def _time_per_image(model, batches):
+    images = sum(len(batch) for batch in batches)
+    started = time.perf_counter()
+    with torch.no_grad():
+        for batch in batches:
+            model(batch)
+    return round((time.perf_counter() - started) * 1000.0 / max(1, images), 3)
+
+
+def _accuracy(probs, threshold, labels):
+    return float(np.mean((probs >= threshold) == labels)) if len(labels) else None
+
+
+def run_harness(cls_path, gate_path, calibration_dir, eval_dir, calibration_limit=64,
+                eval_limit=0, batch_size=16, min_agreement=0.99, max_drift=0.05, gate_threshold=0.9):
+    from pneumonia_system import PneumoniaSystem
+
+    system = PneumoniaSystem(cls_path=cls_path, gate_path=gate_path, gate_threshold=gate_threshold)
+    thresholds = decision_thresholds(gate_threshold)
+    if system.device != "cpu":
+        raise RuntimeError("INT8 quantization targets CPU inference")
+
+    calibration, _ = load_batches(list_images(calibration_dir, calibration_limit), batch_size)
+    eval_batches, eval_paths = load_batches(list_images(eval_dir, eval_limit), batch_size)
+    if not eval_paths:
+        raise ValueError(f"No readable images under {eval_dir}")
+    labels = [_label_of(path) for path in eval_paths]
+    is_xray = np.array([label is not None for label in labels])
+    has_labels = any(label is not None for label in labels)
+
+    report = {
+        "calibration_images": sum(len(batch) for batch in calibration),
+        "eval_images": len(eval_paths),
+        "engine": _select_engine(),
+        "thresholds": thresholds,
+        "bounds": {"min_agreement": min_agreement, "max_drift": max_drift},
+    }
+    passed = True
+
+    models = {"gate": system.gate_model, "classifier": system.cls_model}
+    for label, model in models.items():
+        if model is None:
+            report[label] = None
+            continue
+        prob_fn, threshold = PROB_FNS[label], thresholds[label]
+        started = time.perf_counter()
+        quantized = quantize_static(model, calibration)
+        quantize_ms = round((time.perf_counter() - started) * 1000.0, 1)
+
+        fp32 = predict_probs(model, eval_batches, prob_fn)
+        int8 = predict_probs(quantized, eval_batches, prob_fn)
+        section = {
+            "quantize_ms": quantize_ms,
+            "all_images": decision_parity(fp32, int8, threshold),
+            "fp32_ms_per_image": _time_per_image(model, eval_batches),
+            "int8_ms_per_image": _time_per_image(quantized, eval_batches),
+        }
+
+        if label == "gate" and has_labels:
+            section["fp32_accuracy"] = _accuracy(fp32, threshold, is_xray)
+            section["int8_accuracy"] = _accuracy(int8, threshold, is_xray)
+        if label == "classifier" and has_labels:
+            # Only labeled chest X-rays reach the classifier in production
+            mask = is_xray
+            cls_labels = np.array([label for label in labels if label is not None])
+            section["xray_images"] = decision_parity(fp32[mask], int8[mask], threshold)
+            section["fp32_accuracy"] = _accuracy(fp32[mask], threshold, cls_labels)
+            section["int8_accuracy"] = _accuracy(int8[mask], threshold, cls_labels)
+
+        gated = section.get("xray_images", section["all_images"])
+        try:
+            check_decision_parity(gated, min_agreement, max_drift)
+            section["passed"] = True
+        except ValueError as e:
+            section["passed"] = False
+            section["failure"] = str(e)
+            passed = False
+        report[label] = section
+
+    report["passed"] = passed
+    return report
+
+
+def main():
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Compare INT8 and fp32 gate/classifier decisions on a labeled set")
+    parser.add_argument("--cls-path", default=os.path.join(base_dir, "..", "ml_model", "classifier", "best_pneumonia_model.pt"))
+    parser.add_argument("--gate-path", default=os.path.join(base_dir, "..", "ml_model", "gate", "xray_gate_efficientnet_b0.pth"))
+    parser.add_argument("--calibration-dir", required=True, help="Folder of sample X-rays for calibration")
+    parser.add_argument("--eval-dir", help="Labeled evaluation folder (default: the calibration folder)")
+    parser.add_argument("--calibration-limit", type=int, default=64)
+    parser.add_argument("--eval-limit", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--min-agreement", type=float, default=0.99)
+    parser.add_argument("--max-drift", type=float, default=0.05)
+    parser.add_argument("--gate-threshold", type=float, default=float(os.environ.get("ML_GATE_THRESHOLD", "0.9")),
+                        help="Gate decision threshold to check (default: ML_GATE_THRESHOLD or 0.9)")
+    parser.add_argument("--output", help="Write the JSON report here as well")
+    args = parser.parse_args()
+
+    report = run_harness(
+        args.cls_path, args.gate_path, args.calibration_dir, args.eval_dir or args.calibration_dir,
+        calibration_limit=args.calibration_limit, eval_limit=args.eval_limit, batch_size=args.batch_size,
+        min_agreement=args.min_agreement, max_drift=args.max_drift, gate_threshold=args.gate_threshold
+    )
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    raise SystemExit(0 if report["passed"] else 1)
+
+
+if __name__ == "__main__":
+    main()
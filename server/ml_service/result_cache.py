@@ -0,0 +1,149 @@
+import os
+import json
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+
+def weights_fingerprint(paths):
+    """Short content hash of the model checkpoints (missing files hash as such)."""
+    h = hashlib.sha256()
+    for path in paths:
+        h.update(os.path.basename(path).encode())
+        if not path or not os.path.exists(path):
+            h.update(b"<missing>")
+            continue
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()[:16]
+
+
+# --- CONTENT-ADDRESSED RESULT CACHE ---
+class ResultCache:
+    """
+    Two-tier cache for /predict results, keyed by image content + model weights.
+
+    The memory tier is an LRU bounded by the serialized size of its entries.
+    The optional disk tier (one JSON file per key under `disk_dir`) survives
+    restarts; entries read from disk are promoted back into memory. Concurrent
+    lookups of a key that is still being computed share one computation.
+    """
+
+    def __init__(self, fingerprint, max_bytes=256 * 1024 * 1024, disk_dir=None):
+        self.fingerprint = fingerprint
+        self.max_bytes = int(max_bytes)
+        self.disk_dir = disk_dir
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+        self._entries = OrderedDict() # key -> (result, size)
+        self._bytes = 0
+        self._inflight = {}
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def key_for(self, image_bytes, variant=""):
+        h = hashlib.sha256(image_bytes).hexdigest()
+        return hashlib.sha256(f"{h}:{self.fingerprint}:{variant}".encode()).hexdigest()
+
+    async def get_or_compute(self, key, compute):
+        """Return the cached result for `key`, or await `compute()` once and cache it."""
+        result = self._get_memory(key)
+        if result is not None:
+            self.memory_hits += 1
+            return dict(result)
+
+        task = self._inflight.get(key)
+        if task is None:
+            # Run as its own task so a disconnecting caller doesn't cancel the
+            # computation for everyone else waiting on the same key
+            task = asyncio.ensure_future(self._load_or_compute(key, compute))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finish_inflight(key, t))
+        else:
+            self.coalesced += 1
+        return dict(await asyncio.shield(task))
+
+    async def _load_or_compute(self, key, compute):
+        result = None
+        if self.disk_dir:
+            result = await asyncio.to_thread(self._read_disk, key)
+        if result is not None:
+            self.disk_hits += 1
+            self._put_memory(key, result, len(json.dumps(result)))
+            return result
+
+        self.misses += 1
+        result = await compute()
+        payload = json.dumps(result)
+        self._put_memory(key, result, len(payload))
+        if self.disk_dir:
+            await asyncio.to_thread(self._write_disk, key, payload)
+        return result
+
+    def _finish_inflight(self, key, task):
+        self._inflight.pop(key, None)
+        if not task.cancelled():
+            # Mark the exception as retrieved even if every waiter went away
+            task.exception()
+
+    def _get_memory(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _put_memory(self, key, result, size):
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (result, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def _read_disk(self, key):
+        try:
+            with open(self._disk_path(key), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, key, payload):
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Result cache write failed: {e}")
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "fingerprint": self.fingerprint,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "disk_tier": bool(self.disk_dir),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,106 @@
+"""
+Model weights shared by every worker process through one memory-mapped file.
+
+The first process to need a model builds it as usual (checkpoint load,
+optional inference build) and saves the finished module to a file in a
+shared directory, /dev/shm by default. Every process, the first one
+included, then loads it with torch.load(mmap=True): parameters and buffers
+stay backed by the same page-cache pages, so N workers hold one copy of
+the weights instead of N. This works for thread replicas, ProcessPool
+workers, `uvicorn --workers` and containers that share the directory.
+
+Only modules used as they are benefit: backends that rebuild the weights
+(torchscript freezing, onnx, int8) and snapshots keep private copies.
+"""
+import os
+import ctypes
+import fcntl
+import tempfile
+from contextlib import contextmanager
+
+import torch
+
+DEFAULT_DIR = "/dev/shm/pneumonia-weights" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "pneumonia-weights")
+
+
+def _private_dir(directory):
+    """Create `directory` (mode 0700), refusing one another user could write to."""
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.stat(directory)
+    if info.st_uid != os.getuid() or info.st_mode & 0o022:
+        raise PermissionError(f"{directory} is writable by other users")
+    return directory
+
+
+@contextmanager
+def _locked(path):
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def shared_model(key, build, directory=None):
+    """
+    The module `build()` returns, loaded memory-mapped from `<directory>/<key>.pt`.
+
+    `key` must identify everything the module depends on (checkpoint
+    content, build options, torch version). The first caller builds and
+    saves it, under a file lock so concurrent workers build it only once.
+    The file holds a pickled module written by this service; it is only
+    read from a directory owned by this user and closed to others.
+    """
+    directory = _private_dir(directory or DEFAULT_DIR)
+    path = os.path.join(directory, f"{key}.pt")
+    with _locked(path + ".lock"):
+        if not os.path.exists(path):
+            model = build()
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            torch.save(model, tmp_path)
+            os.replace(tmp_path, path)
+            print(f"Shared weights written to {path}")
+            del model
+            _release_freed_memory()
+    return torch.load(path, map_location="cpu", mmap=True, weights_only=False)
+
+
+def _release_freed_memory():
+    # glibc keeps freed heap pages (here: the private copy just written out)
+    # in the process; hand them back so the builder ends up as small as the rest
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def shared_key(kind, fingerprint, **options):
+    parts = [kind, fingerprint, torch.__version__.replace("+", "_")]
+    parts += [f"{name}-{value}" for name, value in sorted(options.items())]
+    return "_".join(parts)
+
+
+# --- PER-PROCESS MEMORY ---
+def process_memory(pid=None):
+    """
+    Resident memory of a process in bytes: "rss", "pss" (shared pages split
+    between the processes mapping them), "shared" and "private". None where
+    /proc/<pid>/smaps_rollup is unavailable.
+    """
+    fields = {}
+    try:
+        with open(f"/proc/{pid or os.getpid()}/smaps_rollup") as f:
+            for line in f:
+                name, _, rest = line.partition(":")
+                parts = rest.split()
+                if len(parts) == 2 and parts[1] == "kB":
+                    fields[name] = int(parts[0]) * 1024
+    except OSError:
+        return None
+    return {
+        "rss": fields.get("Rss", 0),
+        "pss": fields.get("Pss", 0),
+        "shared": fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0),
+        "private": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+    }
@@ -0,0 +1,100 @@
+"""
+Ready-to-run snapshot of the gate and the classifier.
+
+A snapshot is a directory of TorchScript archives traced from the
+checkpoints (gate.pt, classifier.pt) plus meta.json with the fingerprint of
+the checkpoints it was built from. Loading it needs neither torchvision nor
+the model-building code, which keeps the cold start of a worker short:
+
+    python snapshot.py --output ../ml_model/snapshot
+
+and start the service with ML_MODEL_SNAPSHOT_DIR=../ml_model/snapshot.
+"""
+import os
+import json
+import argparse
+
+import torch
+
+from result_cache import weights_fingerprint
+
+SNAPSHOT_VERSION = 1
+
+
+def _example_batch():
+    # Batch of 2 so nothing in the trace specializes on a batch of 1
+    return torch.randn(2, 3, 224, 224)
+
+
+def write_snapshot(out_dir, cls_path, gate_path):
+    from pneumonia_network import build_gate_model, build_pneumonia_model
+
+    os.makedirs(out_dir, exist_ok=True)
+    example = _example_batch()
+
+    with torch.no_grad():
+        cls_model = build_pneumonia_model(device="cpu", weights_path=cls_path).eval()
+        # forward_features / forward_head are what CamEngine calls
+        traced = torch.jit.trace_module(cls_model, {
+            "forward": example,
+            "forward_features": example,
+            "forward_head": cls_model.forward_features(example),
+        })
+        torch.jit.save(traced, os.path.join(out_dir, "classifier.pt"))
+
+        has_gate = bool(gate_path) and os.path.exists(gate_path)
+        if has_gate:
+            gate_model = build_gate_model(device="cpu", weights_path=gate_path).eval()
+            torch.jit.save(torch.jit.trace(gate_model, example), os.path.join(out_dir, "gate.pt"))
+
+    meta = {
+        "version": SNAPSHOT_VERSION,
+        "fingerprint": weights_fingerprint([cls_path, gate_path]),
+        "has_gate": has_gate,
+        "torch": torch.__version__,
+    }
+    with open(os.path.join(out_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def load_snapshot(snapshot_dir, device="cpu", expected_fingerprint=None):
+    """
+    Returns (gate_model or None, cls_model), or None if there is no usable
+    snapshot in `snapshot_dir` (missing, other format version, or built from
+    checkpoints other than `expected_fingerprint`).
+    """
+    meta_path = os.path.join(snapshot_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        print(f"Warning: no model snapshot at {snapshot_dir}")
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get("version") != SNAPSHOT_VERSION:
+        print(f"Warning: ignoring model snapshot format {meta.get('version')} (expected {SNAPSHOT_VERSION})")
+        return None
+    if expected_fingerprint and meta.get("fingerprint") != expected_fingerprint:
+        print("Warning: model snapshot was built from other checkpoints, ignoring it")
+        return None
+
+    cls_model = torch.jit.load(os.path.join(snapshot_dir, "classifier.pt"), map_location=device).eval()
+    gate_model = None
+    if meta.get("has_gate"):
+        gate_model = torch.jit.load(os.path.join(snapshot_dir, "gate.pt"), map_location=device).eval()
+    return gate_model, cls_model
+
+
+def main():
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Trace the gate and classifier checkpoints into a ready-to-run snapshot")
+    parser.add_argument("--cls-path", default=os.path.join(base_dir, "..", "ml_model", "classifier", "best_pneumonia_model.pt"))
+    parser.add_argument("--gate-path", default=os.path.join(base_dir, "..", "ml_model", "gate", "xray_gate_efficientnet_b0.pth"))
+    parser.add_argument("--output", default=os.path.join(base_dir, "..", "ml_model", "snapshot"))
+    args = parser.parse_args()
+
+    meta = write_snapshot(args.output, args.cls_path, args.gate_path)
+    print(f"Snapshot written to {args.output}: {meta}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import io
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+
+# --- SYNTHETIC TEST IMAGES ---
+# Deterministic stand-ins for uploads, so benchmarks need no dataset. They
+# are not meant to fool the models, only to cost the same to decode,
+# preprocess and render as real uploads of the same size and format.
+def _encode(img, fmt, quality):
+    buf = io.BytesIO()
+    if fmt == "jpeg":
+        img.save(buf, format="JPEG", quality=quality)
+    else:
+        img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def synthetic_xray(width, height, seed=0, fmt="png", quality=90):
+    """
+    Grayscale PA chest-X-ray-like image as encoded bytes (`fmt` png or jpeg).
+
+    Soft-tissue silhouette, two darker lung fields crossed by rib arcs, a
+    bright spine and mediastinum, plus film grain; `seed` varies the anatomy
+    and the noise.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    x = x / width * 2.0 - 1.0
+    y = y / height * 2.0 - 1.0
+
+    # Body silhouette on a dark background
+    img = np.where((x / 0.9) ** 2 + ((y - 0.1) / 1.1) ** 2 < 1.0, 0.55, 0.08).astype(np.float32)
+
+    # Lung fields, slightly different per seed
+    for side in (-1.0, 1.0):
+        cx = side * (0.38 + rng.uniform(-0.03, 0.03))
+        lung = ((x - cx) / (0.28 + rng.uniform(-0.02, 0.02))) ** 2 + ((y + 0.05) / 0.62) ** 2 < 1.0
+        img[lung] = 0.22
+
+        # Rib arcs over each lung
+        ribs = (np.sin((y * 9.0 + (x - cx) ** 2 * 4.0 * side + rng.uniform(0, np.pi)) * np.pi) > 0.85) & lung
+        img[ribs] += 0.18
+
+    # Spine / mediastinum and a diaphragm dome
+    img[np.abs(x) < 0.09] = 0.8
+    img[(y > 0.55 + 0.15 * x ** 2)] = np.maximum(img[(y > 0.55 + 0.15 * x ** 2)], 0.6)
+
+    img += rng.normal(0.0, 0.04, size=img.shape).astype(np.float32)
+    pixels = (np.clip(img, 0.0, 1.0) * 255.0).astype(np.uint8)
+
+    pil = Image.fromarray(pixels, mode="L").filter(ImageFilter.GaussianBlur(radius=max(1, width // 400)))
+    return _encode(pil, fmt, quality)
+
+
+def synthetic_photo(width, height, seed=0, fmt="jpeg", quality=90):
+    """Colorful non-X-ray image (smooth gradients + blobs) as encoded bytes."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    x /= width
+    y /= height
+
+    channels = []
+    for c in range(3):
+        fx, fy, phase = rng.uniform(1.0, 6.0), rng.uniform(1.0, 6.0), rng.uniform(0, 2 * np.pi)
+        channels.append(0.5 + 0.5 * np.sin(2 * np.pi * (fx * x + fy * y) + phase + c))
+    img = np.stack(channels, axis=-1)
+
+    for _ in range(6):
+        cx, cy, r = rng.uniform(0, 1), rng.uniform(0, 1), rng.uniform(0.05, 0.25)
+        blob = ((x - cx) ** 2 + (y - cy) ** 2) < r ** 2
+        img[blob] = rng.uniform(0, 1, size=3)
+
+    img += rng.normal(0.0, 0.03, size=img.shape)
+    pixels = (np.clip(img, 0.0, 1.0) * 255.0).astype(np.uint8)
+    return _encode(Image.fromarray(pixels, mode="RGB"), fmt, quality)
@@ -0,0 +1,92 @@
+import io
+import os
+import mmap
+import stat
+import zlib
+import zipfile
+
+ZIP_MAGIC = b"PK\x03\x04"
+
+
+# --- MULTI-IMAGE UPLOADS ---
+def is_zip(filename, contents):
+    return contents[:4] == ZIP_MAGIC or (filename or "").lower().endswith(".zip")
+
+
+def _zip_members(filename, contents, max_member_bytes):
+    try:
+        archive = zipfile.ZipFile(io.BytesIO(contents))
+    except (zipfile.BadZipFile, zipfile.LargeZipFile) as e:
+        raise ValueError(f"Cannot read {filename or 'zip archive'}: {e}")
+
+    with archive:
+        for info in archive.infolist():
+            base = os.path.basename(info.filename)
+            # Folders and macOS / hidden metadata files are not images
+            if info.is_dir() or not base or base.startswith(".") or info.filename.startswith("__MACOSX/"):
+                continue
+            # Declared size is checked before inflating anything (zip bombs)
+            if info.file_size > max_member_bytes:
+                yield info.filename, None, f"File too large ({info.file_size} bytes)"
+                continue
+            try:
+                yield info.filename, archive.read(info), None
+            except (zipfile.BadZipFile, zlib.error, EOFError, NotImplementedError, RuntimeError) as e:
+                # Corrupt (bad CRC, deflate data or truncated), encrypted or unsupported compression
+                yield info.filename, None, f"Cannot extract: {e}"
+
+
+def expand_uploads(uploads, max_files, max_member_bytes, max_total_bytes=None):
+    """
+    Flattens (filename, bytes) uploads into the images to score, expanding
+    zip archives into their members in archive order. Returns (filename,
+    bytes, error) tuples; a member that cannot be extracted carries an error
+    instead of failing the whole upload. Raises ValueError for an unreadable
+    archive, more than `max_files` images or more than `max_total_bytes` of
+    extracted images.
+    """
+    images = []
+    total = 0
+    for filename, contents in uploads:
+        members = _zip_members(filename, contents, max_member_bytes) if is_zip(filename, contents) else [(filename, contents, None)]
+        for member in members:
+            if len(images) >= max_files:
+                raise ValueError(f"Too many images in one batch (limit {max_files})")
+            total += len(member[1] or b"")
+            if max_total_bytes is not None and total > max_total_bytes:
+                raise ValueError(f"Images in one batch exceed {max_total_bytes} bytes once extracted")
+            images.append(member)
+    return images
+
+
+# --- SHARED-VOLUME UPLOADS ---
+def open_shared_upload(root, relative_path):
+    """
+    Memory-maps `relative_path` (read-only) from the shared upload `root`.
+
+    The path must stay inside `root` once symlinks are resolved, and must
+    name a regular file. Raises PermissionError for paths outside `root`,
+    FileNotFoundError for missing files and ValueError for anything else
+    that is not a non-empty regular file. The caller closes the mmap.
+    """
+    root = os.path.realpath(root)
+    if not relative_path or "\x00" in relative_path or os.path.isabs(relative_path):
+        raise PermissionError("image_path must be relative to the shared upload root")
+    full_path = os.path.realpath(os.path.join(root, relative_path))
+    if os.path.commonpath([root, full_path]) != root or full_path == root:
+        raise PermissionError("image_path is outside the shared upload root")
+
+    # O_NOFOLLOW: the resolved path must not have been swapped for a symlink since;
+    # O_NONBLOCK: opening a FIFO must not hang the request
+    flags = os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0) | getattr(os, "O_NONBLOCK", 0) | getattr(os, "O_CLOEXEC", 0)
+    fd = os.open(full_path, flags)
+    try:
+        info = os.fstat(fd)
+        if not stat.S_ISREG(info.st_mode):
+            raise ValueError("image_path is not a regular file")
+        if info.st_size == 0:
+            raise ValueError("image_path is an empty file")
+        return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    finally:
+        # The mapping stays valid after the descriptor is closed
+        os.close(fd)
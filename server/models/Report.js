@@ -30,6 +30,9 @@ const reportSchema = new mongoose.Schema({
     heatmap: {
         type: String // Base64 PNG
     },
+    modelVersion: {
+        type: String // ML service model version that produced the prediction
+    },
     createdAt: {
         type: Date,
         default: Date.now